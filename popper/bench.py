@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import multiprocessing
+from time import perf_counter
+from . util import Settings, calc_prog_size, format_prog
+from . generate import Generator, Grounder
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+EXAMPLES_DIR = 'examples'
+RUN_TIMEOUT = 60
+# extra time given to a task process beyond the learning timeout before it is killed
+GRACE_TIME = 30
+# relative slowdown reported as a regression
+THRESHOLD = 0.2
+# tasks faster than this (seconds) are too noisy to compare times
+MIN_TIME = 1.0
+
+def find_tasks(paths):
+    # a task is any directory that contains a bias file
+    tasks = []
+    for path in paths:
+        if os.path.isfile(os.path.join(path, 'bias.pl')):
+            tasks.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            task = os.path.join(path, name)
+            if os.path.isfile(os.path.join(task, 'bias.pl')):
+                tasks.append(task)
+    return tasks
+
+def startup_time(kbpath):
+    t1 = perf_counter()
+    settings = Settings(kbpath=kbpath, quiet=True)
+    t2 = perf_counter()
+    settings.nonoise = not settings.noisy
+    Generator(settings, Grounder(settings))
+    t3 = perf_counter()
+    return t2-t1, t3-t2
+
+def run_startup(args):
+    tasks = find_tasks(args.paths)
+    total_settings = total_generator = 0
+    print(f'{"task":<40} {"settings":>10} {"generator":>10}')
+    for task in tasks:
+        best = None
+        for _ in range(args.repeat):
+            times = startup_time(task)
+            if best == None or sum(times) < sum(best):
+                best = times
+        total_settings += best[0]
+        total_generator += best[1]
+        print(f'{task_name(task):<40} {best[0]:>10.3f} {best[1]:>10.3f}')
+    print(f'{"total":<40} {total_settings:>10.3f} {total_generator:>10.3f}')
+
+def task_name(task):
+    return os.path.basename(os.path.normpath(task))
+
+def peak_rss():
+    # peak resident set size of this process in MB
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / (1024*1024)
+    return rss / 1024
+
+def run_task(kbpath, options, conn):
+    # import here so that the parent process never loads pyswip
+    from . loop import learn_solution
+    t1 = perf_counter()
+    settings = Settings(kbpath=kbpath, quiet=True, **options)
+    prog, score, stats = learn_solution(settings)
+    result = {}
+    result['time'] = perf_counter() - t1
+    result['programs'] = stats.total_programs
+    summary = stats.to_json()
+    result['durations'] = summary['durations']
+    result['counters'] = summary['counters']
+    result['max_rss_mb'] = peak_rss()
+    result['solution'] = None
+    if prog != None:
+        tp, fn, tn, fp, size = score
+        result['solution'] = {'size': calc_prog_size(prog), 'tp': tp, 'fn': fn, 'tn': tn, 'fp': fp, 'program': format_prog(prog)}
+    conn.send(result)
+
+def run_isolated(task, options, timeout):
+    # each task runs in a fresh process, as pyswip and clingo keep global state and so that the peak RSS is per task
+    ctx = multiprocessing.get_context('spawn')
+    reader, writer = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=run_task, args=(task, options, writer))
+    t1 = perf_counter()
+    proc.start()
+    writer.close()
+    try:
+        if reader.poll(timeout):
+            result = reader.recv()
+        else:
+            result = {'error': 'timeout'}
+    except EOFError:
+        result = {'error': 'crashed'}
+    proc.join(GRACE_TIME)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+    if 'error' in result:
+        result['time'] = perf_counter() - t1
+        if proc.exitcode:
+            result['error'] += f' (exit code {proc.exitcode})'
+    return result
+
+def run_options(args):
+    options = {'timeout': args.timeout, 'noisy': args.noisy, 'bkcons': args.bkcons, 'solver': args.solver}
+    if args.max_literals:
+        options['max_literals'] = args.max_literals
+    return options
+
+def run_benchmarks(args):
+    tasks = find_tasks(args.paths)
+    if args.tasks:
+        tasks = [task for task in tasks if task_name(task) in args.tasks]
+    options = run_options(args)
+
+    out = {}
+    out['settings'] = options
+    out['machine'] = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+    out['tasks'] = {}
+
+    print(f'{"task":<40} {"time":>8} {"programs":>9} {"rss(MB)":>8} {"size":>5} {"tp":>5} {"fp":>5}')
+    for task in tasks:
+        name = task_name(task)
+        runs = [run_isolated(task, options, args.timeout + GRACE_TIME) for _ in range(args.repeat)]
+        # keep the fastest successful run
+        ok = [run for run in runs if 'error' not in run]
+        result = min(ok, key=lambda run: run['time']) if ok else runs[0]
+        result['times'] = [run['time'] for run in runs]
+        out['tasks'][name] = result
+        if 'error' in result:
+            print(f'{name:<40} {result["error"]}')
+            continue
+        rss = result['max_rss_mb']
+        rss = f'{rss:.0f}' if rss != None else '-'
+        sol = result['solution']
+        size, tp, fp = (sol['size'], sol['tp'], sol['fp']) if sol else ('-', '-', '-')
+        print(f'{name:<40} {result["time"]:>8.2f} {result["programs"]:>9} {rss:>8} {size:>5} {tp:>5} {fp:>5}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(baseline, out, args.threshold):
+            sys.exit(1)
+
+def solution_regressions(old, new):
+    if old == None:
+        return []
+    if new == None:
+        return ['no solution']
+    out = []
+    # a solution is worse if it misclassifies more examples, or has the same errors but is larger
+    old_errors = old['fn'] + old['fp']
+    new_errors = new['fn'] + new['fp']
+    if new_errors > old_errors:
+        out.append(f'errors {old_errors} -> {new_errors}')
+    elif new_errors == old_errors and new['size'] > old['size']:
+        out.append(f'size {old["size"]} -> {new["size"]}')
+    return out
+
+def compare(baseline, current, threshold):
+    if baseline['settings'] != current['settings']:
+        print(f'warning: baseline settings {baseline["settings"]} differ from {current["settings"]}')
+
+    regressions = 0
+    print()
+    print(f'{"task":<40} {"baseline":>9} {"current":>9} {"change":>8}')
+    for name, new in current['tasks'].items():
+        if name not in baseline['tasks']:
+            continue
+        old = baseline['tasks'][name]
+        problems = []
+        if 'error' in new and 'error' not in old:
+            problems.append(new['error'])
+        change = ''
+        if 'error' not in new and 'error' not in old:
+            change = f'{(new["time"] - old["time"]) / old["time"]:+.0%}'
+            if max(old['time'], new['time']) >= MIN_TIME and new['time'] > old['time'] * (1 + threshold):
+                problems.append('slower')
+            problems.extend(solution_regressions(old['solution'], new['solution']))
+        if problems:
+            regressions += 1
+        print(f'{name:<40} {old["time"]:>9.2f} {new["time"]:>9.2f} {change:>8} {", ".join(problems)}')
+
+    if regressions:
+        print(f'{regressions} regression(s) against the baseline (threshold {threshold:.0%})')
+    else:
+        print(f'no regressions against the baseline (threshold {threshold:.0%})')
+    return regressions == 0
+
+def run_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if not compare(baseline, current, args.threshold):
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Popper benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    startup = subparsers.add_parser('startup', help='Time settings and generator construction for each task')
+    startup.add_argument('paths', nargs='*', default=[EXAMPLES_DIR], help=f'Task directories or directories of tasks (default: {EXAMPLES_DIR})')
+    startup.add_argument('--repeat', type=int, default=3, help='Report the best of this many runs per task (default: 3)')
+    startup.set_defaults(func=run_startup)
+
+    run = subparsers.add_parser('run', help='Run Popper on each task and record times, statistics, and solutions')
+    run.add_argument('paths', nargs='*', default=[EXAMPLES_DIR], help=f'Task directories or directories of tasks (default: {EXAMPLES_DIR})')
+    run.add_argument('--tasks', nargs='+', help='Only run the tasks with these names')
+    run.add_argument('--timeout', type=float, default=RUN_TIMEOUT, help=f'Learning timeout in seconds for each task (default: {RUN_TIMEOUT})')
+    run.add_argument('--noisy', default=False, action='store_true', help='Run Popper with --noisy')
+    run.add_argument('--bkcons', default=False, action='store_true', help='Run Popper with --bkcons')
+    run.add_argument('--solver', default='rc2', choices=['clingo', 'rc2', 'uwr', 'wmaxcdcl'], help='Combine solver (default: rc2)')
+    run.add_argument('--max-literals', type=int, help='Maximum number of literals allowed in program')
+    run.add_argument('--repeat', type=int, default=1, help='Report the fastest of this many runs per task (default: 1)')
+    run.add_argument('--output', '-o', help='Write the results to this JSON file')
+    run.add_argument('--baseline', help='Compare the results against this JSON file and exit with status 1 on a regression')
+    run.add_argument('--threshold', type=float, default=THRESHOLD, help=f'Relative slowdown counted as a regression (default: {THRESHOLD})')
+    run.set_defaults(func=run_benchmarks)
+
+    cmp = subparsers.add_parser('compare', help='Compare two JSON files written by run')
+    cmp.add_argument('baseline')
+    cmp.add_argument('current')
+    cmp.add_argument('--threshold', type=float, default=THRESHOLD, help=f'Relative slowdown counted as a regression (default: {THRESHOLD})')
+    cmp.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
+import os
+import re
+import json
 import clingo
 import clingo.script
 import numbers
+import numpy as np
 import operator
 import pkg_resources
 import time
 from . core import Literal, RuleVar, VarVar, Var
 from . util import rule_is_recursive, format_rule, Constraint, format_prog, order_rule, order_prog
+from . cache import file_hash, cache_path
+from . symbols import arg_lookup
 from clingo import Function, Number, Tuple_
-from collections import defaultdict
-from itertools import permutations
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import permutations, groupby
 from pysat.card import *
 from pysat.formula import CNF
 from pysat.solvers import Solver
@@ -18,7 +25,6 @@ tmp_map = {}
 for i in range(1,20):
     tmp_map[i] = ','.join(f'V{j}' for j in range(i))
 
-arg_lookup = {clingo.Number(i):chr(ord('A') + i) for i in range(100)}
 
 TIDY_OUTPUT = """
 #defined body_literal/4.
@@ -28,34 +34,20 @@ TIDY_OUTPUT = """
 """
 
 def get_bias_preds(settings):
-    solver = clingo.Control(['-Wnone'])
-    with open(settings.bias_file) as f:
-        solver.add('bias', [], f.read())
-    solver.add('bias', [], TIDY_OUTPUT)
-    solver.ground([('bias', [])])
-
-    for x in solver.symbolic_atoms.by_signature('head_pred', arity=2):
-        args = x.symbol.arguments
-        symbol = args[0].name
-        arity = args[1].number
-        head_pred = symbol, arity
-
-    head_pred, head_arity=  head_pred
+    head_pred, head_arity = settings.bias.head_pred
     head_literal = Literal(head_pred, tuple(arg_lookup[clingo.Number(arg)] for arg in range(head_arity)))
     head_str =  f'{head_pred}({tmp_map[head_arity]})'
-
-    body_preds = set()
-    for x in solver.symbolic_atoms.by_signature('body_pred', arity=2):
-        args = x.symbol.arguments
-        symbol = args[0]
-        arity = args[1].number
-        body_preds.add((symbol, arity))
-    return (head_pred, arity), body_preds
+    return (head_pred, head_arity), set(settings.bias.body_preds)
 
 
 from itertools import permutations, combinations
 all_myvars = ['A','B','C','D','E','F','G','H']
 
+# a candidate property of the BK, such as not_ab_bc where P(A,B) never joins Q(B,C)
+# args are the variables of each literal, sym orders the predicate symbols of identical literals
+# subsumed lists the (key, literal positions) of pair properties that make this property redundant
+Prop = namedtuple('Prop', ['key', 'kind', 'args', 'sym', 'subsumed'])
+
 def connected(xs, ys):
     xs = set(xs)
     for y in ys:
@@ -70,29 +62,21 @@ def uses_in_order(xs, ys):
             return False
     return True
 
-def build_props(settings, arities, tester=None):
-
-    myvars = all_myvars[:settings.max_vars]
+def pair_patterns(settings, arities):
+    # two connected literals use at most a1+a2-1 distinct variables
+    myvars = all_myvars[:min(settings.max_vars, 2*max(arities))]
 
     pairs = set()
     for a1 in arities:
         xs = tuple(myvars[:a1])
-        xs_set = set(xs)
         for a2 in arities:
             for ys in permutations(myvars,a2):
                 if not connected(xs, ys):
                     continue
                 if not uses_in_order(xs, ys):
                     continue
-                # pairs.append((xs, ys))
                 pairs.add(tuple(sorted([xs, ys])))
 
-    # print('pairs1')
-    # for x in pairs:
-    #     print(x)
-
-    # print('len(pairs)',len(pairs))
-
     pairs = sorted(pairs)
     pairs2 = set()
     for xs, ys in pairs:
@@ -109,16 +93,8 @@ def build_props(settings, arities, tester=None):
         var_count = 0
         out_xs, var_count = tmp(xs, var_count)
         out_ys, var_count = tmp(ys, var_count)
-        # out_zs, var_count = tmp(zs, var_count)
         pairs2.add((out_xs, out_ys))
 
-    # for x in set(pairs) - pairs2:
-        # print('bad',x)
-
-    # for x in pairs2:
-        # print('good',x)
-    # print('len(pairs2)',len(pairs2))
-
     pairs3 = set()
     for xs, ys in pairs2:
         lookup = {}
@@ -134,35 +110,24 @@ def build_props(settings, arities, tester=None):
         var_count = 0
 
         zs = sorted([xs, ys], key=lambda x: len(x), reverse=True)
-        # xs1, ys1 = xs, ys
         xs, ys = zs
         out_xs, var_count = tmp(xs, var_count)
         out_ys, var_count = tmp(ys, var_count)
-        # out_zs, var_count = tmp(zs, var_count)
         k = (out_xs, out_ys)
         pairs3.add(k)
 
-    # for x in pairs2 - pairs3:
-        # print('bad3', x)
-
-    # for x in pairs3:
-        # print('good', x)
+    return sorted(pairs3)
 
-    # print('len(pairs3)',len(pairs3))
-
-    # print('implies_not2', len(pairs3))
+def build_props(settings, arities):
     props = []
     cons = []
-    for xs, ys in pairs3:
+    for xs, ys in pair_patterns(settings, arities):
         xs_set = set(xs)
         ys_set = set(ys)
 
         left = ''.join(x.lower() for x in xs)
         right = ''.join(y.lower() for y in ys)
 
-        t_left = ','.join(f'T{x}' for x in xs)
-        t_right = ','.join(f'T{y}' for y in ys)
-
         zs = []
         for y in ys:
             if y not in xs_set:
@@ -174,27 +139,20 @@ def build_props(settings, arities, tester=None):
         atom_right = ','.join(zs)
 
         if len(xs) == 1:
-            t_left += ','
             atom_left += ','
         if len(ys) == 1:
-            t_right += ','
             atom_right += ','
 
         # # IMPLIES NOT
-        # key = f'not_{left}_implies_{right}'
+        # P(xs) never joins with Q(ys)
         key = f'not_{left}_{right}'
 
-
-
         # if the vars are identical then remove symmetries
-        sym_con = ''
+        sym = []
         if xs == ys:
-            sym_con = 'P<Q,'
-
-        l1 = f'prop({key},(P,Q)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), type(P,({t_left})), type(Q,({t_right})), holds(P,({atom_left})), not {key}_aux((P,Q)).'
-        l2 = f'{key}_aux((P,Q)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), type(P,({t_left})), type(Q,({t_right})), holds(P,({atom_left})), holds(Q,({atom_right})).'
-        props.extend([l1, l2])
+            sym = [(0, 1, operator.lt)]
 
+        props.append(Prop(key, 'not', (xs, ys), sym, []))
 
         con1 = f':- prop({key},(P,Q)), body_literal(Rule,P,_,({atom_left})), body_literal(Rule,Q,_,({atom_right})).'
         cons.append(con1)
@@ -203,29 +161,21 @@ def build_props(settings, arities, tester=None):
             continue
 
         # IMPLIES
+        # every P(xs) implies Q(ys)
         key = f'{left}_{right}'
 
-
         # if the vars are identical then remove symmetries
-        sym_con = ''
+        sym = []
         if xs == ys:
-            sym_con = 'P!=Q,'
-
-        l1 = f'prop({key},(P,Q)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), type(P,({t_left})), type(Q,({t_right})), holds(P,({atom_left})), holds(Q,({atom_right})), not {key}_aux((P,Q)).'
-        l2 = f'{key}_aux((P,Q)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), type(P,({t_left})), type(Q,({t_right})), holds(P,({atom_left})), not holds(Q,({atom_right})).'
-        props.extend([l1, l2])
+            sym = [(0, 1, operator.ne)]
 
+        props.append(Prop(key, 'implies', (xs, ys), sym, []))
 
-        # rule_vars = xs_set | ys_set
-        rule_vars = ys_set
+        rule_vars = sorted(ys_set)
         checker = ','.join(f'valid_var(Rule,{v})' for v in rule_vars)
         con1 = f':- prop({key},(P,Q)), body_literal(Rule,P,_,({atom_left})), body_literal(Rule,Q,_,({atom_right})), {checker}.'
-        # con1 = f':- prop({key},(P,Q)), body_literal(Rule,P,_,({atom_left})), body_literal(Rule,Q,_,({atom_right})).'
-        # print(con1)
         cons.append(con1)
 
-
-
     return props, cons
 
 def has_unordered_vars(xs, ys):
@@ -402,18 +352,13 @@ def rename_variables(xs, ys):
     return xs, ys
 
 
-def build_props2(settings, arities):
-    premise1 = []
-
-    arities = [x for x in arities if x < 3]
-    # arities = [x for x in arities if x < 2]
-
-    myvars = all_myvars[:settings.max_vars]
+def triple_patterns(settings, arities):
+    # three connected literals use at most a1+a2+a3-2 distinct variables
+    myvars = all_myvars[:min(settings.max_vars, 3*max(arities))]
 
     pairs = []
     for a1 in arities:
         xs = tuple(myvars[:a1])
-        # xs_set = set(xs)
         for a2 in arities:
             for ys in permutations(myvars,a2):
                 if not connected(xs, ys):
@@ -427,12 +372,8 @@ def build_props2(settings, arities):
                             continue
                         if not uses_in_order(xs_ys, zs):
                             continue
-                        # print(xs,ys,zs)
-                        # TODO: RENAME VARIABLES
                         pairs.append((xs, ys, zs))
 
-    # for x in pairs:
-    #     print(x)
     pairs2 = set()
     for xs, ys, zs in pairs:
         lookup = {}
@@ -452,46 +393,25 @@ def build_props2(settings, arities):
         out_zs, var_count = tmp(zs, var_count)
         pairs2.add((out_xs, out_ys, out_zs))
 
-
+    # keep one ordering of each triple of literals
+    out = []
     seen = set()
-    seen_map = {}
-    pairs3 = set()
-
-
-
-    for xs, ys, zs in pairs2:
-        k = (frozenset((xs, ys)), zs)
+    for xs, ys, zs in sorted(pairs2):
+        k = frozenset([xs, ys, zs])
         if k in seen:
-            # print('match')
-            # print(xs, ys, zs)
-            # print(seen_map[k])
             continue
         seen.add(k)
-        seen_map[k] = (xs, ys, zs)
+        out.append((xs, ys, zs))
+    return out
 
-        # if len(xs) > len(ys):
-        #     # print('1', xs, ys, zs)
-        #     continue
-        # else:
-        # print(xs, ys, zs)
-        pairs3.add((xs, ys, zs))
+def build_props2(settings, arities):
+    arities = [x for x in arities if x < 3]
+    if len(arities) == 0:
+        return [], []
 
-    # for x in sorted(pairs3):
-        # print(x)
-    # print('p1',len(pairs))
-    # print('p2',len(pairs2))
-    # print('p3',len(pairs3))
-    pairs = pairs2
-    # for x in sorted(pairs2):
-    #     print(x)
-    # print(len(pairs))
-    # print(len(pairs2))
-    # for x in pairs:
-        # print(x)
     props = []
     cons = []
-    seen = set()
-    for xs, ys, zs in pairs:
+    for xs, ys, zs in triple_patterns(settings, arities):
         xs_set = set(xs)
         ys_set = set(ys)
         zs_set = set(zs)
@@ -500,86 +420,42 @@ def build_props2(settings, arities):
         a2 = ''.join(y.lower() for y in ys)
         a3 = ''.join(z.lower() for z in zs)
 
-        t1 = ','.join(f'T{x}' for x in xs)
-        t2 = ','.join(f'T{y}' for y in ys)
-        t3 = ','.join(f'T{z}' for z in zs)
-
-
-        smoothed = []
         xs_ys_set = xs_set | ys_set
-        for z in zs:
-            if z not in xs_ys_set:
-                smoothed.append('_')
-            else:
-                smoothed.append(z)
-
-        smoothed = ','.join(smoothed)
-        if len(zs) == 1:
-            smoothed += ','
-
 
         atom1 = ','.join(xs)
         atom2 = ','.join(ys)
         atom3 = ','.join(zs)
 
         if len(xs) == 1:
-            t1 += ','
             atom1 += ','
         if len(ys) == 1:
-            t2 += ','
             atom2 += ','
         if len(zs) == 1:
-            t3 += ','
             atom3 += ','
 
         # # IMPLIES NOT
+        # P(xs) and Q(ys) join but never with R(zs)
         key = f'not_{a1}_{a2}_{a3}'
 
-        if frozenset([a1, a2, a3]) in seen:
-            pass
-            # print('skip')
-            continue
-        seen.add(frozenset([a1, a2, a3]))
-
-
-
         # # if the vars are identical then remove symmetries
-        sym_con = ''
+        sym = []
         if xs == ys:
-            sym_con += 'P<Q,'
+            sym.append((0, 1, operator.lt))
         if xs == zs:
-            sym_con += 'P<R,'
+            sym.append((0, 2, operator.lt))
         if ys == zs:
-            sym_con += 'Q<R,'
-
-
-
-        aux_key = f'{key}_subsumed'
-        aux1 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a1}_{a2},(P,Q)).'
-        aux2 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a1}_{a3},(P,R)).'
-        aux3 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a2}_{a3},(Q,R)).'
-        props.extend([aux1, aux2, aux3])
-        # props.extend([aux2, aux3])
+            sym.append((1, 2, operator.lt))
 
+        # the property is redundant if a pair of the literals never join
+        subsumed = [(f'not_{a1}_{a2}', (0, 1)), (f'not_{a1}_{a3}', (0, 2)), (f'not_{a2}_{a3}', (1, 2))]
         a1_, a2_ = rename_variables(a1, a2)
-        aux1 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a1_}_{a2_},(P,Q)).'
+        subsumed.append((f'not_{a1_}_{a2_}', (0, 1)))
         a1_, a3_ = rename_variables(a1, a3)
-        aux2 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a1_}_{a3_},(P,R)).'
+        subsumed.append((f'not_{a1_}_{a3_}', (0, 2)))
         a2_, a3_ = rename_variables(a2, a3)
-        aux3 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop(not_{a2_}_{a3_},(Q,R)).'
-        props.extend([aux1, aux2, aux3])
-
-
-        l1 = f'prop({key},(P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), not {key}_aux((P,Q,R)), not {aux_key}(P,Q,R).'
-        l2 = f'{key}_aux((P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), holds(R,({atom3})), not {aux_key}(P,Q,R).'
-
-        # l1 = f'prop({key},(P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), not {key}_aux((P,Q,R)).'
-        # l2 = f'{key}_aux((P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), holds(R,({atom3})).'
+        subsumed.append((f'not_{a2_}_{a3_}', (1, 2)))
 
-        props.extend([l1, l2])
-
-        # print(l1)
-        # print(l2)
+        props.append(Prop(key, 'not', (xs, ys, zs), sym, subsumed))
 
         con1 = f':- prop({key},(P,Q,R)), body_literal(Rule,P,_,({atom1})), body_literal(Rule,Q,_,({atom2})), body_literal(Rule,R,_,({atom3})).'
         cons.append(con1)
@@ -588,46 +464,177 @@ def build_props2(settings, arities):
             continue
 
         # # IMPLIES
+        # P(xs) and Q(ys) imply R(zs)
         key = f'{a1}_{a2}_{a3}'
 
+        # the property is redundant if one of the literals alone implies R(zs)
+        subsumed = [(f'{a1}_{a3}', (0, 2)), (f'{a2}_{a3}', (1, 2))]
 
-        aux_key = f'{key}_subsumed'
-        aux1 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop({a1}_{a3},(P,R)).'
-        aux2 = f'{aux_key}(P,Q,R):- body_pred(P,_), body_pred(Q,_), body_pred(R,_), prop({a2}_{a3},(Q,R)).'
-        props.extend([aux1, aux2])
-
-
-        l1 = f'prop({key},(P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), not {key}_aux((P,Q,R)), not {aux_key}(P,Q,R).'
-        l2 = f'{key}_aux((P,Q,R)):- {sym_con} body_pred(P,{len(xs)}), body_pred(Q,{len(ys)}), body_pred(R,{len(zs)}), type(P,({t1})), type(Q,({t2})), type(R,({t3})), holds(P,({atom1})), holds(Q,({atom2})), not holds(R,({smoothed})).'
-
+        props.append(Prop(key, 'implies', (xs, ys, zs), sym, subsumed))
 
-        props.extend([l1, l2])
-
-
-        # rule_vars = xs_set | ys_set
-        rule_vars = zs_set
+        rule_vars = sorted(zs_set)
         checker = ','.join(f'valid_var(Rule,{v})' for v in rule_vars)
         con1 = f':- prop({key},(P,Q,R)), body_literal(Rule,P,_,({atom1})), body_literal(Rule,Q,_,({atom2})), body_literal(Rule,R,_,({atom3})), {checker}.'
-        # # con1 = f':- prop({key},(P,Q)), body_literal(Rule,P,_,({atom_left})), body_literal(Rule,Q,_,({atom_right})).'
-        # # print(con1)
         cons.append(con1)
 
-    props = sorted(list(set(props)))
     return props, cons
 
+def arg_cols(xs, vs):
+    return tuple(xs.index(v) for v in vs)
+
+class FactTable:
+    # the facts of the body predicates with their projections and join indexes built on demand
+    def __init__(self, facts):
+        self.facts = facts
+        self.projections = {}
+        self.indexes = {}
+
+    def project(self, pred, cols):
+        k = (pred, cols)
+        if k not in self.projections:
+            self.projections[k] = {tuple(args[i] for i in cols) for args in self.facts[pred]}
+        return self.projections[k]
+
+    def index(self, pred, cols, n):
+        # group the projected facts by their first n arguments
+        k = (pred, cols, n)
+        if k not in self.indexes:
+            index = defaultdict(list)
+            for args in self.project(pred, cols):
+                index[args[:n]].append(args[n:])
+            self.indexes[k] = index
+        return self.indexes[k]
+
+    def join(self, p, xs, q, ys, vs):
+        # yield the values of the variables vs for each way of joining P(xs) and Q(ys)
+        shared = tuple(x for x in xs if x in ys)
+        left = shared + tuple(v for v in vs if v in xs and v not in shared)
+        right = shared + tuple(v for v in vs if v in ys and v not in xs)
+        out = left + right[len(shared):]
+        out_cols = arg_cols(out, vs)
+        n = len(shared)
+        left_index = self.index(p, arg_cols(xs, left), n)
+        right_index = self.index(q, arg_cols(ys, right), n)
+        for k in left_index.keys() & right_index.keys():
+            for args in left_index[k]:
+                args = k + args
+                for rest in right_index[k]:
+                    row = args + rest
+                    if out == vs:
+                        yield row
+                    else:
+                        yield tuple(row[i] for i in out_cols)
+
+def check_pair(table, prop, p, q):
+    xs, ys = prop.args
+    if prop.kind == 'not':
+        shared = tuple(y for y in ys if y in xs)
+        return table.project(p, arg_cols(xs, shared)).isdisjoint(table.project(q, arg_cols(ys, shared)))
+    return table.project(p, arg_cols(xs, ys)) <= table.facts[q]
+
+def check_triples(table, prop, p, q, rs):
+    # join P and Q once, checking each joined row against every R until all of them fail
+    xs, ys, zs = prop.args
+    live = {}
+    if prop.kind == 'not':
+        vs = tuple(z for z in zs if z in xs or z in ys)
+        for r in rs:
+            live[r] = table.project(r, arg_cols(zs, vs))
+    else:
+        vs = zs
+        for r in rs:
+            live[r] = table.facts[r]
+    # P and Q must join at least once
+    found = False
+    for args in table.join(p, xs, q, ys, vs):
+        found = True
+        if prop.kind == 'not':
+            failed = [r for r, r_args in live.items() if args in r_args]
+        else:
+            failed = [r for r, r_args in live.items() if args not in r_args]
+        for r in failed:
+            del live[r]
+        if not live:
+            break
+    if not found:
+        return []
+    return [(p, q, r) for r in live]
+
+def prop_candidates(prop, preds_by_types, nonempty, pair_props):
+    # extend the candidates one literal at a time, pruning them with the cheap checks before looking at the facts
+    candidates = [((), {})]
+    for i, xs in enumerate(prop.args):
+        sym = [(j, op) for j, k, op in prop.sym if k == i]
+        subsumed = [(key, j) for key, (j, k) in prop.subsumed if k == i]
+        extended = []
+        for preds, var_types in candidates:
+            excluded = set()
+            for key, j in subsumed:
+                if key in pair_props:
+                    excluded.update(pair_props[key][preds[j]])
+            for types, xs_preds in preds_by_types[len(xs)].items():
+                if any(var_types.get(x, t) != t for x, t in zip(xs, types)):
+                    continue
+                xs_types = dict(var_types)
+                xs_types.update(zip(xs, types))
+                for pred in xs_preds:
+                    # every property needs facts for all but the last literal
+                    if i < len(prop.args)-1 and pred not in nonempty:
+                        continue
+                    if pred in excluded:
+                        continue
+                    if sym and any(not op(preds[j], pred) for j, op in sym):
+                        continue
+                    extended.append((preds + (pred,), xs_types))
+        candidates = extended
+    return [preds for preds, var_types in candidates]
+
+# the fact table of a bkcons worker process
+worker_table = None
+
+def init_worker(facts):
+    global worker_table
+    worker_table = FactTable(facts)
+
+def check_family(prop, candidates):
+    t1 = time.perf_counter()
+    if len(prop.args) == 2:
+        holds = [(p, q) for p, q in candidates if check_pair(worker_table, prop, p, q)]
+    else:
+        holds = []
+        # the candidates are ordered so those sharing P and Q are adjacent
+        for (p, q), group in groupby(candidates, key=lambda preds: preds[:2]):
+            holds.extend(check_triples(worker_table, prop, p, q, [r for _, _, r in group]))
+    return holds, time.perf_counter() - t1
+
+def check_props(settings, executor, props, candidates):
+    if executor:
+        results = executor.map(check_family, props, candidates)
+    else:
+        results = map(check_family, props, candidates)
+    out = {}
+    for prop, xs, (holds, duration) in zip(props, candidates, results):
+        out[prop.key] = set(holds)
+        family = 'pairs' if len(prop.args) == 2 else 'triples'
+        settings.stats.add_duration(f'bkcons {prop.kind} {family}', duration)
+        settings.logger.debug(f'bkcons {prop.key}: {len(holds)}/{len(xs)} candidates hold in {duration:0.3f}s')
+    return out
 
-def arg_to_symbol(arg):
-    if isinstance(arg, tuple):
-        return Tuple_(tuple(arg_to_symbol(a) for a in arg))
-    if isinstance(arg, numbers.Number):
-        return Number(arg)
-    if isinstance(arg, str):
-        return Function(arg)
-    assert False, f'Unhandled argtype({type(arg)}) in aspsolver.py arg_to_symbol()'
+def body_pred_types(settings, body_preds):
+    # predicates without a type only occur in properties when no body predicate is typed
+    head_pred = settings.bias.head_pred[0]
+    types = {}
+    for pred, arity in body_preds:
+        if pred in settings.bias.types:
+            xs = tuple(settings.bias.types[pred])
+        elif len(settings.body_types) == 0 or (pred == head_pred and settings.head_types == None):
+            xs = ('t',) * arity
+        else:
+            continue
+        if len(xs) == arity:
+            types[(pred, arity)] = xs
+    return types
 
-def atom_to_symbol(pred, args):
-    xs = tuple(arg_to_symbol(arg) for arg in args)
-    return Function(name = pred, arguments = xs)
 
 
 def tmpprint(body):
@@ -955,82 +962,100 @@ def tmpprint(body):
 
 
 
-def deduce_bk_cons(settings, tester):
-    prog = []
-    lookup2 = {k: f'({v})' for k,v in tmp_map.items()}
-    lookup1 = {k:v for k,v in lookup2.items()}
-    lookup1[1] = '(V0,)'
-    (head_pred, head_arity), body_preds = get_bias_preds(settings)
-
-    arities = set()
-    for p, a in body_preds:
-        arities.add(a)
-        arg_str = lookup1[a]
-        arg_str2 = lookup2[a]
-        rule = f'holds({p},{arg_str}):- {p}{arg_str2}.'
-        prog.append(rule)
-    prog = '\n'.join(prog)
-
-    with open(settings.bias_file) as f:
-        bias = f.read()
-    with open(settings.bk_file) as f:
-        bk = f.read()
-
-    cons = pkg_resources.resource_string(__name__, "lp/cons.pl").decode()
-    bk = bk.replace('\+','not')
-
-    new_props1, new_cons1 = build_props(settings, arities, tester)
-    new_props2, new_cons2 = build_props2(settings, arities)
-
-    new_props = new_props1 + new_props2
-    new_cons = new_cons1 + new_cons2
-
-    # print('\n'.join(new_cons))
-
-    new_props = '\n'.join(new_props)
-    encoding = [cons, prog, bias, bk, TIDY_OUTPUT, new_props]
-
-    if settings.head_types == None:
-        if head_arity == 1:
-            types = '(t,)'
+def find_props(settings, body_preds, pair_props, triple_props):
+    facts = load_bk_facts(settings, body_preds)
+    types = body_pred_types(settings, body_preds)
+
+    # group the typed predicates by arity and then by types
+    preds_by_types = defaultdict(lambda: defaultdict(list))
+    for pred in body_preds:
+        if pred in types:
+            preds_by_types[pred[1]][types[pred]].append(pred)
+    nonempty = set(pred for pred, xs in facts.items() if xs)
+
+    executor = None
+    if settings.bkcons_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=settings.bkcons_workers, initializer=init_worker, initargs=(facts,))
+    else:
+        init_worker(facts)
+
+    try:
+        # pairs of literals first, as they subsume many triples
+        candidates = [prop_candidates(prop, preds_by_types, nonempty, {}) for prop in pair_props]
+        found = check_props(settings, executor, pair_props, candidates)
+
+        # index the pair properties by their first predicate symbol to prune the triples
+        pair_index = {}
+        for key, holds in found.items():
+            pair_index[key] = defaultdict(set)
+            for p, q in holds:
+                pair_index[key][p].add(q)
+
+        candidates = [prop_candidates(prop, preds_by_types, nonempty, pair_index) for prop in triple_props]
+        found.update(check_props(settings, executor, triple_props, candidates))
+    finally:
+        if executor:
+            executor.shutdown()
         else:
-            types = tuple(['t'] * head_arity)
-        encoding.append(f'type({head_pred},{types}).')
-
-    if len(settings.body_types) == 0:
-        # exit()
-        for p, a in body_preds:
-            if a == 1:
-                types = '(t,)'
-            else:
-                types = tuple(['t'] * a)
-            encoding.append(f'type({p},{types}).')
+            # drop the projections and indexes built in this process
+            init_worker({})
+    return found
+
+def load_props(settings, body_preds, pair_props, triple_props):
+    # the properties that hold only depend on the BK, the bias, and which properties we look for
+    path = None
+    if settings.cache_dir:
+        keys = [prop.key for prop in pair_props + triple_props]
+        key = file_hash(settings.bk_file, settings.bias_file, extra=repr((body_preds, keys)))
+        path = cache_path(settings, f'bkcons-{key}.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return {key: set(tuple(tuple(pred) for pred in preds) for preds in holds) for key, holds in json.load(f)}
+
+    found = find_props(settings, body_preds, pair_props, triple_props)
+
+    if path:
+        tmp_path = f'{path}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump([[key, sorted(holds)] for key, holds in found.items()], f)
+        os.replace(tmp_path, path)
+    return found
+
+def deduce_bk_cons(settings):
+    (head_pred, head_arity), body_preds = get_bias_preds(settings)
+    body_preds = sorted(body_preds)
 
+    arities = set(a for p, a in body_preds)
+    if len(arities) == 0:
+        return []
 
-    encoding = '\n'.join(encoding)
-    # print(encoding)
-    # with open('bkcons-encoding.pl', 'w') as f:
-        # f.write(encoding)
-    # exit()
-    solver = clingo.Control(['-Wnone'])
-    solver.add('base', [], encoding)
-    solver.ground([('base', [])])
-    out = set()
+    pair_props, pair_cons = build_props(settings, arities)
+    triple_props, triple_cons = build_props2(settings, arities)
 
-    implies_not = []
+    found = load_props(settings, body_preds, pair_props, triple_props)
 
-    with solver.solve(yield_=True) as handle:
-        for m in handle:
-            for atom in m.symbols(shown = True):
-                args = atom.arguments
-                if atom.name == 'prop':
-                    out.add(str(atom))
-    xs = [x + '.' for x in out]
+    facts = []
+    for key, holds in found.items():
+        for preds in holds:
+            facts.append(('prop', (key, tuple(pred for pred, arity in preds))))
+    xs = [format_fact(pred, args) for pred, args in facts]
 
     if settings.showcons:
         for x in sorted(xs):
             print(x)
-    return xs + new_cons
+    if settings.bkcons_backend:
+        return facts + pair_cons + triple_cons
+    return xs + pair_cons + triple_cons
+
+def format_fact(pred, args):
+    return f'{pred}({",".join(format_term(arg) for arg in args)}).'
+
+def format_term(arg):
+    if isinstance(arg, tuple):
+        if len(arg) == 1:
+            return f'({format_term(arg[0])},)'
+        return f'({",".join(format_term(x) for x in arg)})'
+    return str(arg)
 
 
 def generate_binary_strings(bit_count):
@@ -1045,105 +1070,144 @@ def generate_binary_strings(bit_count):
     return binary_strings
 
 
-def deduce_recalls(settings):
-    # Jan Struyf, Hendrik Blockeel: Query Optimization in Inductive Logic Programming by Reordering Literals. ILP 2003: 329-346
-
-    # recall for a subset of arguments, e.g. when A and C are ground in a call to add(A,B,C)
-    counts = {}
-    # maximum recall for a predicate symbol
-    counts_all = {}
-
-    with open(settings.bk_file) as f:
-        bk = f.read()
+# a line holding a single fact whose arguments are constants, such as: edge(a,1).
+FACT_RE = re.compile(r'([a-z]\w*)\((.*)\)\s*\.')
+CONSTANT_RE = re.compile(r'-?\d+|[a-z]\w*')
+# a directive that clingo also accepts, such as: :-style_check(-discontiguous).
+DIRECTIVE_RE = re.compile(r':-\s*[a-z]\w*\([\w\s,()+-]*\)\s*\.')
+
+def read_facts(bk_file, preds):
+    # stream the BK and collect the facts of the given predicates
+    # returns None if the file is anything other than plain facts, such as rules or directives
+    facts = {k: set() for k in preds}
+    with open(bk_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('%') or DIRECTIVE_RE.fullmatch(line):
+                continue
+            m = FACT_RE.fullmatch(line)
+            if not m:
+                return None
+            args = []
+            for arg in m.group(2).split(','):
+                arg = arg.strip()
+                if not CONSTANT_RE.fullmatch(arg):
+                    return None
+                if arg[0].isdigit() or arg[0] == '-':
+                    arg = int(arg)
+                args.append(arg)
+            k = (m.group(1), len(args))
+            if k in facts:
+                facts[k].add(tuple(args))
+    return facts
+
+def ground_facts(bk, preds):
     solver = clingo.Control(['-Wnone'])
     solver.add('base', [], bk)
     solver.ground([('base', [])])
-
-    for pred, arity in settings.body_preds:
-        # print(pred, arity)
-        counts_all[pred] = 0
-        counts[pred] = {}
-        # we find all facts for a given predicate symbol
-
+    facts = {}
+    for pred, arity in preds:
+        facts[(pred, arity)] = xs = set()
         for atom in solver.symbolic_atoms.by_signature(pred, arity=arity):
             args = []
-            for i in range(arity):
-                arg = atom.symbol.arguments[i]
-                t = arg.type
-                if t == clingo.SymbolType.Number:
-                    x = arg.number
+            for arg in atom.symbol.arguments:
+                if arg.type == clingo.SymbolType.Number:
+                    args.append(arg.number)
                 else:
-                    x = arg.name
-                args.append(x)
-
-            # print('X', pred, args)
-            counts_all[pred] +=1
-            # x_args = [x[arg] for arg in args]
-            # we now enumerate all subsets of possible input/ground arguments
-            # for instance, for a predicate symbol p/2 we consider p(10) and p(01), where 1 denotes input
-            # note that p(00) is the max recall and p(11) is 1 since it is a boolean check
-            binary_strings = generate_binary_strings(arity)[1:-1]
-
-            for var_subset in binary_strings:
-                # print('var_subset', var_subset)
-                if var_subset not in counts[pred]:
-                    counts[pred][var_subset] = {}
-                key = []
-                value = []
-                for i in range(arity):
-                    if var_subset[i] == '1':
-                        key.append(args[i])
-                    else:
-                        value.append(args[i])
-                key = tuple(key)
-                value = tuple(value)
-                # print('\t', key, value)
-                if key not in counts[pred][var_subset]:
-                    counts[pred][var_subset][key] = set()
-                counts[pred][var_subset][key].add(value)
-
-    # we now calculate the maximum recall
+                    args.append(str(arg))
+            xs.add(tuple(args))
+    return facts
+
+def load_bk_facts(settings, preds):
+    facts = read_facts(settings.bk_file, preds)
+    if facts == None:
+        with open(settings.bk_file) as f:
+            facts = ground_facts(f.read().replace('\\+','not'), preds)
+    return facts
+
+def fact_recalls(facts):
     all_recalls = {}
-    for pred, arity in settings.body_preds:
-        d1 = counts[pred]
-        all_recalls[(pred, '0'*arity)] = counts_all[pred]
-        for args, d2 in d1.items():
-            recall = max(len(xs) for xs in d2.values())
-            all_recalls[(pred, args)] = recall
+    codes = {}
+    for (pred, arity), xs in facts.items():
+        all_recalls[(pred, '0'*arity)] = len(xs)
+        if len(xs) == 0:
+            continue
+        # encode the constants as integers so that numpy can sort and group the facts
+        rows = np.array([[codes.setdefault(x, len(codes)) for x in args] for args in xs], dtype=np.int64)
+        # we now enumerate all subsets of possible input/ground arguments
+        # for instance, for a predicate symbol p/2 we consider p(10) and p(01), where 1 denotes input
+        # note that p(00) is the max recall and p(11) is 1 since it is a boolean check
+        for var_subset in generate_binary_strings(arity)[1:-1]:
+            cols = [i for i, x in enumerate(var_subset) if x == '1']
+            # the facts are distinct so the recall is the size of the largest group of facts that agree on the input arguments
+            _, group_sizes = np.unique(rows[:, cols], axis=0, return_counts=True)
+            all_recalls[(pred, var_subset)] = int(group_sizes.max())
+    return all_recalls
+
+def load_recalls(settings):
+    path = None
+    if settings.cache_dir:
+        key = file_hash(settings.bk_file, extra=repr(sorted(settings.body_preds)))
+        path = cache_path(settings, f'recalls-{key}.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return {(pred, args): recall for pred, args, recall in json.load(f)}
+
+    all_recalls = fact_recalls(load_bk_facts(settings, settings.body_preds))
+
+    if path:
+        tmp_path = f'{path}.{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump([[pred, args, recall] for (pred, args), recall in all_recalls.items()], f)
+        os.replace(tmp_path, path)
+    return all_recalls
 
+def deduce_recalls(settings):
+    # Jan Struyf, Hendrik Blockeel: Query Optimization in Inductive Logic Programming by Reordering Literals. ILP 2003: 329-346
+    all_recalls = load_recalls(settings)
     settings.recall = all_recalls
 
     out = []
+    # with --bkcons-backend, one rule for each pattern of input arguments with the recalls as facts
+    pattern_cons = {}
 
     for (pred, key), recall in all_recalls.items():
         if recall > 4:
             continue
         if '1' not in key:
             continue
-        arity = len(key)
-        args = [f'V{i}' for i in range(arity)]
-        args_str = ','.join(args)
-        subset = []
-        fixer = []
-
-        for x, y in zip(key, args):
-            if x == '0':
-                subset.append(y)
-                fixer.append('_')
-            else:
-                fixer.append(y)
-
-
-        subset_str = ','.join(subset)
-        fixer_str = ','.join(fixer)
-        if len(fixer) == 1:
-            fixer_str+= ','
-
-        con2 = f':- body_literal(Rule,{pred},_,({fixer_str})), #count{{{subset_str}: body_literal(Rule,{pred},_,({args_str}))}} > {recall}.'
-        out.append(con2)
+        if settings.bkcons_backend:
+            pattern = tuple(int(x) for x in key)
+            out.append(('recall_bound', (pred, pattern, recall)))
+            if key not in pattern_cons:
+                pattern_cons[key] = f':- recall_bound(P,{format_term(pattern)},N), {recall_body(key, "P", "N")}.'
+            continue
+        out.append(f':- {recall_body(key, pred, recall)}.')
 
     # for x in settings.recall.items():
         # print(x)
     # print(out)
-    return out
+    return out + list(pattern_cons.values())
     # settings.deduced_bkcons += '\n' + '\n'.join(out)
+
+def recall_body(key, pred, recall):
+    # at most recall literals of pred agree on the input arguments, which are 1 in the key
+    arity = len(key)
+    args = [f'V{i}' for i in range(arity)]
+    args_str = ','.join(args)
+    subset = []
+    fixer = []
+
+    for x, y in zip(key, args):
+        if x == '0':
+            subset.append(y)
+            fixer.append('_')
+        else:
+            fixer.append(y)
+
+    subset_str = ','.join(subset)
+    fixer_str = ','.join(fixer)
+    if len(fixer) == 1:
+        fixer_str+= ','
+
+    return f'body_literal(Rule,{pred},_,({fixer_str})), #count{{{subset_str}: body_literal(Rule,{pred},_,({args_str}))}} > {recall}'
@@ -0,0 +1,117 @@
+import queue
+import threading
+from time import perf_counter
+from collections import defaultdict
+
+# seconds between messages from a process to the others
+PUBLISH_INTERVAL = 0.1
+
+class Relay:
+    # forwards each message that a process puts on the outbox to the inboxes of the other processes
+    # runs in a thread of the parent process
+    def __init__(self, ctx, n):
+        self.outbox = ctx.Queue()
+        self.inboxes = [ctx.Queue() for _ in range(n)]
+        # processes that no longer read their inbox
+        self.finished = set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            message = self.outbox.get()
+            if message == None:
+                return
+            sender = message[0]
+            for index, inbox in enumerate(self.inboxes):
+                if index != sender and index not in self.finished:
+                    inbox.put(message)
+
+    def stop(self):
+        self.outbox.put(None)
+        self.thread.join()
+        # do not wait to flush messages that no process will read
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+class ConstraintBus:
+    # publishes the ground constraints of a generator to the generators of the other processes and imports theirs
+    # a ground atom is sent once and then by an integer id, so a nogood is a tuple of signed ids
+    def __init__(self, index, outbox, inbox):
+        self.index = index
+        self.outbox = outbox
+        self.inbox = inbox
+        self.atom_ids = {}
+        self.new_atoms = []
+        self.nogoods = []
+        self.rules = []
+        self.peer_atoms = defaultdict(list)
+        # hashes of the nogoods and rules already in this generator
+        self.seen = set()
+        self.last = perf_counter()
+
+    def atom_id(self, atom):
+        k = self.atom_ids.get(atom)
+        if k == None:
+            k = self.atom_ids[atom] = len(self.atom_ids) + 1
+            self.new_atoms.append(atom)
+        return k
+
+    def publish(self, ground_bodies, rules):
+        for body in ground_bodies:
+            body = frozenset(body)
+            k = hash(body)
+            if k in self.seen:
+                continue
+            self.seen.add(k)
+            nogood = []
+            for sign, pred, args in body:
+                x = self.atom_id((pred, args))
+                nogood.append(x if sign else -x)
+            self.nogoods.append(tuple(nogood))
+        # rules that define seen_rule handles
+        for rule in rules:
+            k = hash(rule)
+            if k in self.seen:
+                continue
+            self.seen.add(k)
+            head, body = rule
+            self.rules.append((self.atom_id(head), tuple(self.atom_id(x) for x in body)))
+        if perf_counter() - self.last >= PUBLISH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.nogoods or self.rules:
+            self.outbox.put((self.index, self.new_atoms, self.nogoods, self.rules))
+            self.new_atoms = []
+            self.nogoods = []
+            self.rules = []
+        self.last = perf_counter()
+
+    def receive(self):
+        ground_bodies = []
+        rules = []
+        while True:
+            try:
+                sender, atoms, nogoods, peer_rules = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            table = self.peer_atoms[sender]
+            table.extend(atoms)
+            for nogood in nogoods:
+                body = frozenset((x > 0,) + table[abs(x)-1] for x in nogood)
+                k = hash(body)
+                if k in self.seen:
+                    continue
+                self.seen.add(k)
+                ground_bodies.append(body)
+            for head, body in peer_rules:
+                rule = table[head-1], frozenset(table[x-1] for x in body)
+                k = hash(rule)
+                if k in self.seen:
+                    continue
+                self.seen.add(k)
+                rules.append(rule)
+        return ground_bodies, rules
@@ -0,0 +1,15 @@
+import os
+import hashlib
+
+def file_hash(*paths, extra=''):
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(extra.encode())
+    return h.hexdigest()
+
+def cache_path(settings, name):
+    os.makedirs(settings.cache_dir, exist_ok=True)
+    return os.path.join(settings.cache_dir, name)
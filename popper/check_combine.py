@@ -0,0 +1,123 @@
+import sys
+import pickle
+import random
+import argparse
+from . util import Settings, num_examples
+from . core import Literal
+from . combine import Combiner
+from . combine_mdl import Combiner as MDLCombiner
+
+# any task works, the combiners only read its bias through the settings
+TASK = 'examples/trains1'
+TRIALS = 300
+
+# checks that --incremental-combine gives the combiners the same optimal costs as grounding each call from scratch
+# the coverage of each rule is random and the tester only takes unions of it, so no Prolog is needed
+# the incremental combiner is also checkpointed and restored halfway through each trial
+
+def rule_key(rule):
+    _head, body = rule
+    return tuple(literal.predicate for literal in body)
+
+class CoverageTester:
+    def __init__(self, pos, neg, weights, coverage):
+        self.num_pos = num_examples(pos, weights)
+        self.num_neg = num_examples(neg, weights)
+        # literals are compared by identity and the combiners rebuild the rules that they return, so a rule is keyed by its body predicates
+        self.coverage = {rule_key(rule): x for rule, x in coverage.items()}
+
+    def test_prog_all(self, prog):
+        pos_covered = frozenset().union(*(self.coverage[rule_key(rule)][0] for rule in prog))
+        neg_covered = frozenset().union(*(self.coverage[rule_key(rule)][1] for rule in prog))
+        return pos_covered, neg_covered
+
+    def is_inconsistent(self, prog):
+        return False
+
+def build_combiner(kbpath, noisy, incremental, pos, neg, weights, coverage):
+    settings = Settings(kbpath=kbpath, quiet=True, noisy=noisy, solver='clingo', incremental_combine=incremental)
+    settings.nonoise = not noisy
+    settings.pos_index, settings.neg_index, settings.example_weights = pos, neg, weights
+    tester = CoverageTester(pos, neg, weights, coverage)
+    settings.best_prog_score = None
+    settings.best_mdl = tester.num_pos if noisy else None
+    settings.last_combine_stage = False
+    if noisy:
+        return settings, MDLCombiner(settings, tester)
+    return settings, Combiner(settings, tester)
+
+def random_trial(rnd):
+    noisy = rnd.random() < 0.5
+    pos = list(range(1, rnd.randint(2, 8)))
+    neg = list(range(-1, -rnd.randint(2, 6), -1))
+    weights = {e: rnd.randint(2, 3) for e in pos + neg if rnd.random() < 0.2}
+    rules = []
+    for i in range(rnd.randint(2, 9)):
+        body = tuple(Literal(f'p{i}_{j}', ('A',)) for j in range(rnd.randint(1, 3)))
+        rules.append((Literal('f', ('A',)), body))
+    coverage = {}
+    for rule in rules:
+        pos_covered = frozenset(e for e in pos if rnd.random() < 0.4)
+        neg_covered = frozenset(e for e in neg if noisy and rnd.random() < 0.3)
+        coverage[rule] = pos_covered, neg_covered
+    # programs of one or two rules, given to the combiner in batches
+    progs = [frozenset([rule]) for rule in rules]
+    for _ in range(rnd.randint(0, 4)):
+        progs.append(frozenset(rnd.sample(rules, 2)))
+    rnd.shuffle(progs)
+    batches = []
+    while progs:
+        k = rnd.randint(1, 3)
+        batches.append(progs[:k])
+        progs = progs[k:]
+    return noisy, pos, neg, weights, coverage, batches
+
+def run_trial(kbpath, noisy, incremental, pos, neg, weights, coverage, batches):
+    # returns the optimal cost of every solver call for each batch
+    settings, combiner = build_combiner(kbpath, noisy, incremental, pos, neg, weights, coverage)
+    out = []
+    for i, batch in enumerate(batches):
+        if incremental and i == len(batches) // 2:
+            state = pickle.loads(pickle.dumps(combiner.checkpoint_state()))
+            _, combiner = build_combiner(kbpath, noisy, incremental, pos, neg, weights, coverage)
+            combiner.settings = settings
+            combiner.restore(state)
+        saved_progs = []
+        for prog in batch:
+            pos_covered, neg_covered = combiner.tester.test_prog_all(prog)
+            saved_progs.append([prog, pos_covered, neg_covered if noisy else frozenset()])
+        costs = []
+        find_combination = combiner.find_combination
+        def record(encoding):
+            x = find_combination(encoding)
+            costs.append(x[1] if noisy else x[1:])
+            return x
+        combiner.find_combination = record
+        x = combiner.update_best_prog(saved_progs)
+        del combiner.find_combination
+        out.append(tuple(costs))
+        if x and not noisy:
+            settings.best_prog_score = x[1]
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that --incremental-combine finds the same optimal costs as the default combiner')
+    parser.add_argument('--task', default=TASK, help=f'Task whose bias the combiners use (default: {TASK})')
+    parser.add_argument('--trials', type=int, default=TRIALS, help=f'Number of random trials (default: {TRIALS})')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first trial (default: 0)')
+    args = parser.parse_args()
+
+    failed = 0
+    for trial in range(args.seed, args.seed + args.trials):
+        noisy, pos, neg, weights, coverage, batches = random_trial(random.Random(trial))
+        expected = run_trial(args.task, noisy, False, pos, neg, weights, coverage, batches)
+        actual = run_trial(args.task, noisy, True, pos, neg, weights, coverage, batches)
+        if expected != actual:
+            failed += 1
+            print(f'trial {trial} (noisy={noisy}): expected {expected}, got {actual}')
+    print(f'{args.trials - failed}/{args.trials} trials agree')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import io
+import os
+import pickle
+import clingo
+from time import perf_counter
+from . core import Literal
+from . cache import file_hash
+
+# the settings that change during the search
+SEARCH_SETTINGS = ['solution', 'best_prog_score', 'best_mdl', 'max_literals', 'solution_found', 'last_combine_stage']
+
+def task_key(settings):
+    # a checkpoint only applies to the same input files and search settings
+    extra = repr((settings.noisy, settings.bkcons, settings.solver, settings.functional_test, settings.max_vars, settings.max_body, settings.max_rules))
+    return file_hash(settings.bk_file, settings.ex_file, settings.bias_file, extra=extra)
+
+class CheckpointPickler(pickle.Pickler):
+    # the generated programs share the literals in settings.cached_literals, which are compared by identity
+    # so we store a literal by its key and look it up again when loading
+    def __init__(self, f, settings):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.settings = settings
+
+    def persistent_id(self, obj):
+        if type(obj) != Literal or self.settings.pi_enabled or obj.meta:
+            return None
+        if obj is self.settings.head_literal:
+            return 'head'
+        return obj.predicate, tuple(ord(x) - ord('A') for x in obj.arguments)
+
+class CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, f, settings):
+        super().__init__(f)
+        self.settings = settings
+
+    def persistent_load(self, key):
+        if key == 'head':
+            return self.settings.head_literal
+        pred, args = key
+        return self.settings.cached_literals[(pred, tuple(clingo.Number(x) for x in args))]
+
+def dumps(obj, settings):
+    f = io.BytesIO()
+    CheckpointPickler(f, settings).dump(obj)
+    return f.getvalue()
+
+def loads(data, settings):
+    return CheckpointUnpickler(io.BytesIO(data), settings).load()
+
+class Checkpointer:
+    def __init__(self, settings):
+        self.settings = settings
+        self.path = settings.checkpoint_file
+        self.interval = settings.checkpoint_interval
+        self.key = task_key(settings)
+        self.last = perf_counter()
+
+    def due(self):
+        return perf_counter() - self.last >= self.interval
+
+    def save(self, state):
+        state['settings'] = {k: getattr(self.settings, k) for k in SEARCH_SETTINGS if hasattr(self.settings, k)}
+        state['total_programs'] = self.settings.stats.total_programs
+        with self.settings.stats.duration('checkpoint'):
+            # write to a temporary file first so that a crash never leaves a partial checkpoint
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickler = CheckpointPickler(f, self.settings)
+                pickler.dump(self.key)
+                pickler.dump(state)
+            os.replace(tmp, self.path)
+        self.last = perf_counter()
+        if self.settings.debug:
+            self.settings.logger.debug(f'Saved checkpoint after {self.settings.stats.total_programs} programs')
+
+    def load(self):
+        if not os.path.exists(self.path):
+            self.settings.logger.warn(f'No checkpoint {self.path}, starting from scratch')
+            return None
+        with open(self.path, 'rb') as f:
+            unpickler = CheckpointUnpickler(f, self.settings)
+            if unpickler.load() != self.key:
+                self.settings.logger.warn(f'Checkpoint {self.path} is for different input files or settings, starting from scratch')
+                return None
+            state = unpickler.load()
+        for k, v in state['settings'].items():
+            setattr(self.settings, k, v)
+        self.settings.stats.total_programs = state['total_programs']
+        self.settings.logger.info(f'Resuming from checkpoint {self.path} after {state["total_programs"]} programs')
+        return state
@@ -1,9 +1,11 @@
+import re
 import clingo
+from clingo import Function, Number
 import time
 import pickle
 import itertools
-from .util import format_rule, calc_prog_size, format_prog, flatten, reduce_prog, prog_is_recursive, rule_size, \
-    rule_is_recursive, order_rule, prog_is_recursive, prog_has_invention
+from .util import format_rule, calc_prog_size, format_prog, flatten, reduce_prog, prog_is_recursive, rule_size, next_model, \
+    rule_is_recursive, order_rule, prog_is_recursive, prog_has_invention, num_examples
 
 FIND_SUBSET_PROG3 = """
 #defined recursive/0.
@@ -14,6 +16,32 @@ FIND_SUBSET_PROG3 = """
 #show covered/1.
 """
 
+# an example stands for weight identical examples, and only examples with copies have an example_weight fact
+EXAMPLE_WEIGHTS = """
+#defined neg_example/1.
+#defined example_weight/2.
+weight(E,W):- example_weight(E,W).
+weight(E,1):- pos_example(E), not example_weight(E,_).
+weight(E,1):- neg_example(E), not example_weight(E,_).
+"""
+
+# the static part of an incremental encoding
+# clingo does not let a part define the atoms of a part that it has solved, so part N derives chain(N,E) for the examples E that its programs cover and those of the later parts
+INCREMENTAL_BASE = """
+#defined neg_example/1.
+#defined recursive_rule/1.
+#defined base_rule/1.
+#defined class/2.
+#defined class_ex/2.
+#show rule/1.
+example(E):- pos_example(E).
+example(E):- neg_example(E).
+covered(E):- chain(0,E).
+"""
+
+# the atoms that each call defines for itself, see guard
+CALL_ATOMS = re.compile(r'\b(uses_new|recursive|base)\b')
+
 
 def get_rule_hash(rule):
     head, body = rule
@@ -22,6 +50,93 @@ def get_rule_hash(rule):
     return hash((head, body))
 
 
+class IncrementalEncoding:
+    # grounds the encoding of a clingo combiner one part at a time in the same control, so each call only grounds the new programs
+    # programs that cover the same examples form a coverage class, whose examples are listed once
+    # a program adds one rule that derives its class from its rules
+    # the constraints of a call, which depend on the best solution so far, only hold while the external active(N) of the call is true
+    def __init__(self, base):
+        self.parts = []
+        # the lines to add in the next part
+        self.pending = [base]
+        self.classes = {}
+        self.rules = set()
+        self.num_calls = 0
+        self.solver = None
+
+    def __getstate__(self):
+        # the control cannot be saved in a checkpoint, so it is rebuilt from the parts
+        state = dict(self.__dict__)
+        state['solver'] = None
+        return state
+
+    def control(self):
+        if self.solver == None:
+            self.solver = clingo.Control([])
+            for i, part in enumerate(self.parts):
+                self.solver.add(f'part{i}', [], part)
+                self.solver.ground([(f'part{i}', [])])
+        return self.solver
+
+    def add(self, line):
+        self.pending.append(line)
+
+    def add_rule(self, rule_id, size):
+        # returns whether the rule is new
+        if rule_id in self.rules:
+            return False
+        self.rules.add(rule_id)
+        self.pending.append(f'{{rule({rule_id})}}.')
+        self.pending.append(f'size({rule_id},{size}).')
+        self.pending.append(f':~ rule({rule_id}). [{size}@1, ({rule_id},)]')
+        return True
+
+    def add_program(self, rule_ids, covered):
+        if not covered:
+            return
+        covered = frozenset(covered)
+        k = self.classes.get(covered)
+        if k == None:
+            k = self.classes[covered] = len(self.classes) + 1
+            examples = ';'.join(str(ex) for ex in sorted(covered))
+            self.pending.append(f'class_ex({k},({examples})).')
+        # the pending lines go in the next part
+        body = ','.join(f'rule({i})' for i in rule_ids)
+        self.pending.append(f'class({len(self.parts)},{k}):- {body}.')
+
+    def ground(self, call_lines=None):
+        # grounds the lines added since the last part and, for a new call, its constraints
+        solver = self.control()
+        i = len(self.parts)
+        lines = self.pending
+        self.pending = []
+        if call_lines != None:
+            if self.num_calls:
+                solver.release_external(Function('active', [Number(self.num_calls)]))
+            self.num_calls += 1
+            lines.append(f'#external active({self.num_calls}).')
+            lines.extend(guard(line, self.num_calls) for line in call_lines)
+        if lines:
+            lines.append(f'#external chain({i+1},E): example(E).')
+            lines.append(f'chain({i},E):- chain({i+1},E).')
+            lines.append(f'chain({i},E):- class({i},K), class_ex(K,E).')
+            self.parts.append('\n'.join(lines))
+            solver.add(f'part{i}', [], self.parts[i])
+            solver.ground([(f'part{i}', [])])
+        if call_lines != None:
+            solver.assign_external(Function('active', [Number(self.num_calls)]), True)
+        return solver
+
+def guard(line, n):
+    # makes a constraint of a call hold only while the call is active
+    # its atoms and aggregates must differ from those of earlier calls, which are already solved
+    line = CALL_ATOMS.sub(lambda m: f'{m.group(1)}({n})', line)
+    line = line.replace(' : ', f' : active({n}), ')
+    if line.startswith(':-') or line.startswith(':~'):
+        return f'{line[:2]} active({n}),{line[2:]}'
+    return line
+
+
 class Combiner:
     def __init__(self, settings, tester):
         self.prog_pos_covered = {}
@@ -38,19 +153,32 @@ class Combiner:
         self.big_encoding = set()
         self.programs_seen = 0
 
-        if self.settings.nonoise and (self.settings.recursion_enabled or self.settings.pi_enabled):
-            self.big_encoding.add(':- recursive, not base.')
+        self.incremental = None
+        if self.settings.incremental_combine:
+            self.incremental = IncrementalEncoding(INCREMENTAL_BASE + '#show covered/1.\n' + self.example_prog)
+        else:
+            if self.settings.nonoise and (self.settings.recursion_enabled or self.settings.pi_enabled):
+                self.big_encoding.add(':- recursive, not base.')
+
+            # add example atoms
+            self.big_encoding.add(self.example_prog)
 
-        # add example atoms
-        self.big_encoding.add(self.example_prog)
+    def add_encoding(self, line):
+        if self.incremental:
+            self.incremental.add(line)
+        else:
+            self.big_encoding.add(line)
 
     def build_example_encoding(self):
-        example_prog = []
+        example_prog = [EXAMPLE_WEIGHTS]
         for i in self.settings.pos_index:
             example_prog.append(f'pos_example({i}).')
         if not self.settings.nonoise:
             for i in self.settings.neg_index:
                 example_prog.append(f'neg_example({i}).')
+        for i, weight in self.settings.example_weights.items():
+            if i > 0 or not self.settings.nonoise:
+                example_prog.append(f'example_weight({i},{weight}).')
         self.example_prog = '\n'.join(example_prog)
 
     def update_prog_index(self, prog, pos_covered, neg_covered):
@@ -80,11 +208,13 @@ class Combiner:
             return
         ids = [self.rulehash_to_id[k] for k in ids]
         con = ':-' + ','.join(f'rule({x})' for x in ids) + '.'
-        self.big_encoding.add(con)
+        self.add_encoding(con)
 
     def find_combination(self, encoding):
         # with self.settings.stats.duration('combine.build.string'):
-        str_encoding = '\n'.join(encoding)
+        if not self.incremental:
+            str_encoding = '\n'.join(encoding)
+        call_lines = encoding
 
         # with open(f'sat/{self.programs_seen}', 'w') as f:
             # f.write(str_encoding)
@@ -95,21 +225,26 @@ class Combiner:
         best_size = False
 
         while True:
-            solver = clingo.Control([])
-            # with self.settings.stats.duration('combine.add'):
-            solver.add('base', [], str_encoding)
-            # with self.settings.stats.duration('combine.ground'):
-            solver.ground([('base', [])])
+            if self.incremental:
+                # only the first solve of a call adds its constraints
+                solver = self.incremental.ground(call_lines)
+                call_lines = None
+            else:
+                solver = clingo.Control([])
+                # with self.settings.stats.duration('combine.add'):
+                solver.add('base', [], str_encoding)
+                # with self.settings.stats.duration('combine.ground'):
+                solver.ground([('base', [])])
 
             model_found = False
             model_inconsistent = False
 
-            with solver.solve(yield_=True) as handle:
-                handle = iter(handle)
+            self.settings.stats.count('clingo solves')
+            with solver.solve(yield_=True, async_=True) as handle:
                 while True:
                     # loop over the models
                     # with self.settings.stats.duration('combine.solve'):
-                    m = next(handle, None)
+                    m = next_model(handle, self.settings.deadline)
 
                     if m is None:
                         break
@@ -127,8 +262,8 @@ class Combiner:
                         elif a.name == 'rule':
                             rules += [a.arguments[0].number]
 
-                    fn = len(self.settings.pos_index) - len(pos_covered)
-                    fp = len(neg_covered)
+                    fn = self.tester.num_pos - num_examples(pos_covered, self.settings.example_weights)
+                    fp = num_examples(neg_covered, self.settings.example_weights)
                     size = sum([self.ruleid_to_size[r] for r in rules])
 
                     # print(f'COST fn:{fn} fp:{fp} size:{size}')
@@ -163,8 +298,9 @@ class Combiner:
                     # other cost functions
                     smaller = self.tester.reduce_inconsistent(model_prog)
                     con = ':-' + ','.join(f'rule({self.rulehash_to_id[get_rule_hash(rule)]})' for rule in smaller) + '.'
-                    str_encoding += con + '\n'
-                    self.big_encoding.add(con)
+                    if not self.incremental:
+                        str_encoding += con + '\n'
+                    self.add_encoding(con)
                     # break to not consider no more models as we need to take into account the new constraint
                     break
 
@@ -177,7 +313,14 @@ class Combiner:
         self.programs_seen += 1
         # print("programs seen", self.programs_seen)
         this_encoding = set()
-        this_encoding.add(FIND_SUBSET_PROG3)
+        if self.incremental:
+            this_encoding.add(':- not uses_new.')
+            if self.settings.nonoise and (self.settings.recursion_enabled or self.settings.pi_enabled):
+                this_encoding.add('recursive:- rule(R), recursive_rule(R).')
+                this_encoding.add('base:- rule(R), base_rule(R).')
+                this_encoding.add(':- recursive, not base.')
+        else:
+            this_encoding.add(FIND_SUBSET_PROG3)
 
         # ugly current cost function that defines a lexicographical ordering
         # we want to maximum positive coverage (tp), minimise negative coverage (tn), and then optimise program size
@@ -197,22 +340,22 @@ class Combiner:
                         this_encoding.add(':- #sum{K,R : rule(R), size(R,K)} >= ' + f'{size}.')
                     else:
                         # otherwise add a weak over neg coverage and a hard constraint over neg coverage bound
-                        this_encoding.add(':~ neg_example(E), covered(E). [1@2, (E,)]')
-                        this_encoding.add(':- #sum{1,E : neg_example(E), covered(E)} >= ' + f'{fp}.')
+                        this_encoding.add(':~ neg_example(E), covered(E), weight(E,W). [W@2, (E,)]')
+                        this_encoding.add(':- #sum{W,E : neg_example(E), covered(E), weight(E,W)} >= ' + f'{fp}.')
                 else:
                     this_encoding.add(':- #sum{K,R : rule(R), size(R,K)} >= ' + f'{size}.')
             else:
                 # if the best solution does not cover all the positives
                 # then add weak constraints for pos and neg coverage and a hard constraint over pos coverage bound
-                this_encoding.add(':~ pos_example(E), not covered(E). [1@3, (E,)]')
-                this_encoding.add(':- #sum{1,E : pos_example(E), not covered(E)} >= ' + f'{fn}.')
+                this_encoding.add(':~ pos_example(E), not covered(E), weight(E,W). [W@3, (E,)]')
+                this_encoding.add(':- #sum{W,E : pos_example(E), not covered(E), weight(E,W)} >= ' + f'{fn}.')
                 if not self.settings.nonoise:
-                    this_encoding.add(':~ neg_example(E), covered(E). [1@2, (E,)]')
+                    this_encoding.add(':~ neg_example(E), covered(E), weight(E,W). [W@2, (E,)]')
         else:
             # otherwise add weak constraints for the pos and neg coverage
-            this_encoding.add(':~ pos_example(E), not covered(E). [1@3, (E,)]')
+            this_encoding.add(':~ pos_example(E), not covered(E), weight(E,W). [W@3, (E,)]')
             if not self.settings.nonoise:
-                this_encoding.add(':~ neg_example(E), covered(E). [1@2, (E,)]')
+                this_encoding.add(':~ neg_example(E), covered(E), weight(E,W). [W@2, (E,)]')
 
         for [new_prog, _, _] in new_progs:
             pos_examples_covered = self.prog_pos_covered[new_prog]
@@ -228,13 +371,28 @@ class Combiner:
                 this_encoding.add(f'uses_new:- rule({rule_id}).')
                 rule_size = self.ruleid_to_size[rule_id]
                 prog_rules.add(rule_id)
-                self.big_encoding.add(f'size({rule_id},{rule_size}).')
+                if self.incremental:
+                    if not self.incremental.add_rule(rule_id, rule_size):
+                        continue
+                else:
+                    self.big_encoding.add(f'size({rule_id},{rule_size}).')
                 if self.settings.nonoise and self.settings.recursion_enabled:
-                    if rule_is_recursive(rule):
+                    if self.incremental:
+                        # each call derives recursive and base, see build_encoding
+                        kind = 'recursive_rule' if rule_is_recursive(rule) else 'base_rule'
+                        self.incremental.add(f'{kind}({rule_id}).')
+                    elif rule_is_recursive(rule):
                         self.big_encoding.add(f'recursive:- rule({rule_id}).')
                     else:
                         self.big_encoding.add(f'base:- rule({rule_id}).')
 
+            if self.incremental:
+                covered = pos_examples_covered
+                if not self.settings.nonoise:
+                    covered = covered | neg_examples_covered
+                self.incremental.add_program(sorted(prog_rules), covered)
+                continue
+
             prog_rules = ','.join(f'rule({i})' for i in prog_rules)
             for ex in pos_examples_covered:
                 self.big_encoding.add(f'covered({ex}):- {prog_rules}.')
@@ -242,6 +400,8 @@ class Combiner:
                 for ex in neg_examples_covered:
                     self.big_encoding.add(f'covered({ex}):- {prog_rules}.')
 
+        if self.incremental:
+            return this_encoding
         return self.big_encoding.union(this_encoding)
 
     def select_solution(self, saved_progs):
@@ -249,6 +409,14 @@ class Combiner:
         model_rules, fp, fn, size = self.find_combination(encoding)
         return [self.ruleid_to_rule[k] for k in model_rules], fp, fn, size
 
+    def checkpoint_state(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ('settings', 'tester', 'rulehash_to_id')}
+
+    def restore(self, state):
+        self.__dict__.update(state)
+        # rule hashes depend on the hash seed of the process, so rebuild them
+        self.rulehash_to_id = {get_rule_hash(rule): k for k, rule in self.ruleid_to_rule.items()}
+
     def update_best_prog(self, saved_progs):
         # add the new prog to the set of seen programs
         for [prog, pos_covered, neg_covered] in saved_progs:
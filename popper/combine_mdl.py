@@ -4,18 +4,25 @@ import pickle
 import itertools
 import collections
 from . util import format_rule, calc_prog_size, format_prog, flatten, reduce_prog, prog_is_recursive, prog_has_invention, \
-    rule_size, rule_is_recursive, order_rule
+    rule_size, rule_is_recursive, order_rule, next_model, num_examples
 from clingo import Function, Number, Tuple_
+from . combine import IncrementalEncoding, INCREMENTAL_BASE, EXAMPLE_WEIGHTS
 
 FIND_SUBSET_PROG3 = """
 #show rule/1.
 {rule(R)}:-size(R,_).
 :~ rule(R),size(R,K). [K@1, (R,)]
 :- not uses_new.
-:~ pos_example(E), not covered(E). [1@1, (E,)]
-:~ neg_example(E), covered(E). [1@1, (E,)]
+:~ pos_example(E), not covered(E), weight(E,W). [W@1, (E,)]
+:~ neg_example(E), covered(E), weight(E,W). [W@1, (E,)]
 """
 
+# the constraints of each call of an incremental encoding, see IncrementalEncoding
+MDL_CALL = [
+    ':- not uses_new.',
+    ':~ pos_example(E), not covered(E), weight(E,W). [W@1, (E,)]',
+    ':~ neg_example(E), covered(E), weight(E,W). [W@1, (E,)]']
+
 
 def get_rule_hash(rule):
     head, body = rule
@@ -42,8 +49,12 @@ class Combiner:
         self.debug = 0
         self.best_cost = None
 
-        # add example atoms
-        self.big_encoding.add(self.example_prog)
+        self.incremental = None
+        if self.settings.incremental_combine:
+            self.incremental = IncrementalEncoding(INCREMENTAL_BASE + self.example_prog)
+        else:
+            # add example atoms
+            self.big_encoding.add(self.example_prog)
 
         # self.best_cost = None
 
@@ -62,8 +73,12 @@ class Combiner:
                     if all([prog in to_delete_progs for prog in self.rule_to_prog[rule]]):
                         to_delete.add(rule)
 
+                # an incremental encoding cannot remove its lines, so it rules out the deleted rules
+                if to_delete and self.incremental:
+                    for rule in to_delete:
+                        self.incremental.add(f':- rule({rule}).')
                 # now delete it from big encoding
-                if to_delete:
+                elif to_delete:
                     to_delete_lines = []
                     for line in self.big_encoding:
                         if line.startswith('size'):
@@ -85,16 +100,22 @@ class Combiner:
                         elif set(ids).issubset(to_delete_rules):
                             # otherwise add a constraint to not use the to-delete-program
                             other.add(ids)
-                            self.big_encoding.add(":-" + ','.join([f"rule({i})" for i in ids]) + ". \n")
+                            con = ":-" + ','.join([f"rule({i})" for i in ids]) + ". \n"
+                            if self.incremental:
+                                self.incremental.add(con)
+                            else:
+                                self.big_encoding.add(con)
                     for ids in del_k:
                         self.saved_progs[k].remove(ids)
 
     def build_example_encoding(self):
-        example_prog = []
+        example_prog = [EXAMPLE_WEIGHTS]
         for i in self.settings.pos_index:
             example_prog.append(f'pos_example({i}).')
         for i in self.settings.neg_index:
             example_prog.append(f'neg_example({i}).')
+        for i, weight in self.settings.example_weights.items():
+            example_prog.append(f'example_weight({i},{weight}).')
         self.example_prog = '\n'.join(example_prog)
 
     def update_prog_index(self, prog, pos_covered, neg_covered):
@@ -114,32 +135,35 @@ class Combiner:
             ids.append(k)
         for rule in prog:
             self.rule_to_prog[self.rulehash_to_id[get_rule_hash(rule)]].append(tuple(ids))
-        self.saved_progs[len(neg_covered)+calc_prog_size(prog)].add(tuple(ids))
+        self.saved_progs[num_examples(neg_covered, self.settings.example_weights)+calc_prog_size(prog)].add(tuple(ids))
 
 
     def find_combination(self, encoding):
-        # with self.settings.stats.duration('combine.build.string'):
-        str_encoding = '\n'.join(encoding)
-
-        # with open('sat/mdl.pl','w') as f:
-        #     f.write(str_encoding)
-
         best_prog = []
         best_cost = None
 
-        # solver = clingo.Control([f'-t{self.settings.threads}'])
-        solver = clingo.Control([])
-        # with self.settings.stats.duration('combine.add'):
-        solver.add('base', [], str_encoding)
-        # with self.settings.stats.duration('combine.ground'):
-        solver.ground([('base', [])])
+        if self.incremental:
+            solver = self.incremental.ground(encoding)
+        else:
+            # with self.settings.stats.duration('combine.build.string'):
+            str_encoding = '\n'.join(encoding)
+
+            # with open('sat/mdl.pl','w') as f:
+            #     f.write(str_encoding)
 
-        with solver.solve(yield_ = True) as handle:
-            handle = iter(handle)
+            # solver = clingo.Control([f'-t{self.settings.threads}'])
+            solver = clingo.Control([])
+            # with self.settings.stats.duration('combine.add'):
+            solver.add('base', [], str_encoding)
+            # with self.settings.stats.duration('combine.ground'):
+            solver.ground([('base', [])])
+
+        self.settings.stats.count('clingo solves')
+        with solver.solve(yield_ = True, async_ = True) as handle:
             while True:
                 # loop over the models
                 # with self.settings.stats.duration('combine.solve'):
-                m = next(handle, None)
+                m = next_model(handle, self.settings.deadline)
 
                 if m is None:
                     break
@@ -166,7 +190,10 @@ class Combiner:
         self.programs_seen += 1
         #print("programs seen", self.programs_seen)
         this_encoding = set()
-        this_encoding.add(FIND_SUBSET_PROG3)
+        if self.incremental:
+            this_encoding.update(MDL_CALL)
+        else:
+            this_encoding.add(FIND_SUBSET_PROG3)
 
         for [new_prog, _, _] in new_progs:
             pos_examples_covered = self.prog_pos_covered[new_prog]
@@ -181,7 +208,14 @@ class Combiner:
                 this_encoding.add(f'uses_new:- rule({rule_id}).')
                 rule_size = self.ruleid_to_size[rule_id]
                 prog_rules.add(rule_id)
-                self.big_encoding.add(f'size({rule_id},{rule_size}).')
+                if self.incremental:
+                    self.incremental.add_rule(rule_id, rule_size)
+                else:
+                    self.big_encoding.add(f'size({rule_id},{rule_size}).')
+
+            if self.incremental:
+                self.incremental.add_program(sorted(prog_rules), pos_examples_covered | neg_examples_covered)
+                continue
 
             prog_rules = ','.join(f'rule({i})' for i in prog_rules)
             for ex in pos_examples_covered:
@@ -189,6 +223,8 @@ class Combiner:
             for ex in neg_examples_covered:
                 self.big_encoding.add(f'covered({ex}):- {prog_rules}.')
 
+        if self.incremental:
+            return this_encoding
         return self.big_encoding.union(this_encoding)
 
     def select_solution(self, saved_progs):
@@ -196,6 +232,14 @@ class Combiner:
         model_rules, best_cost = self.find_combination(encoding)
         return [self.ruleid_to_rule[k] for k in model_rules], best_cost
 
+    def checkpoint_state(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ('settings', 'tester', 'rulehash_to_id')}
+
+    def restore(self, state):
+        self.__dict__.update(state)
+        # rule hashes depend on the hash seed of the process, so rebuild them
+        self.rulehash_to_id = {get_rule_hash(rule): k for k, rule in self.ruleid_to_rule.items()}
+
     def update_best_prog(self, saved_progs):
         # add the new prog to the set of seen programs
         for [prog, pos_covered, neg_covered] in saved_progs:
@@ -226,8 +270,8 @@ class Combiner:
         pos_covered, neg_covered = self.tester.test_prog_all(new_solution)
         # print('pos_covered',pos_covered)
         # print('neg_covered',neg_covered)
-        tp = len(pos_covered)
-        fp = len(neg_covered)
+        tp = num_examples(pos_covered, self.settings.example_weights)
+        fp = num_examples(neg_covered, self.settings.example_weights)
         tn = self.tester.num_neg - fp
         fn = self.tester.num_pos - tp
         size = calc_prog_size(new_solution)
@@ -5,7 +5,7 @@ import time
 import pickle
 import itertools
 from . util import format_rule, calc_prog_size, format_prog, flatten, reduce_prog, prog_is_recursive, prog_has_invention, \
-    rule_size, rule_is_recursive, order_rule
+    rule_size, rule_is_recursive, order_rule, num_examples
 import collections
 
 import sys
@@ -96,6 +96,12 @@ class Combiner:
                 self.programs_covering_example[i] = []
         self.rule_var = {}
 
+    def example_lits(self, examples, sign):
+        # one soft literal for each example, weighted by its number of copies
+        lits = [sign * self.example_covered_var[i] for i in examples]
+        weights = [self.settings.example_weights.get(i, 1) for i in examples]
+        return lits, weights
+
     def update_prog_index(self, prog, pos_covered, neg_covered):
         self.prog_pos_covered[prog] = pos_covered
         self.prog_neg_covered[prog] = neg_covered
@@ -113,7 +119,7 @@ class Combiner:
                 ids.append(self.rulehash_to_id[rule_hash])
         for rule in prog:
             self.rule_to_prog[self.rulehash_to_id[get_rule_hash(rule)]].append(tuple(ids))
-        self.saved_progs[len(neg_covered)+calc_prog_size(prog)].add(tuple(ids))
+        self.saved_progs[num_examples(neg_covered, self.settings.example_weights)+calc_prog_size(prog)].add(tuple(ids))
 
     def add_inconsistent(self, prog):
         should_add = True
@@ -148,11 +154,14 @@ class Combiner:
         # with self.settings.stats.duration('combine.add'):
         if self.settings.lex:
             soft_lit_groups = []
+            # the weights of the literals of each group but the last, which are the rules
+            group_weights = []
             rule_soft_lits = []
             for rule_id in self.rule_var:
                 if self.rule_var[rule_id] is not None:
                     rule_soft_lits.append(-self.rule_var[rule_id])
                     weights.append(self.ruleid_to_size[rule_id])
+            groups = []
             if self.settings.best_prog_score:
                 if fn_ == 0:
                     for i in self.settings.pos_index:
@@ -161,33 +170,34 @@ class Combiner:
                         if not self.settings.nonoise:
                             for i in self.settings.neg_index:
                                 encoding.append([-self.example_covered_var[i]])
-                        soft_lit_groups = [[lit for lit in rule_soft_lits]]
                     else:
                         assert(not self.settings.nonoise)
-                        soft_lit_groups = [[-self.example_covered_var[i] for i in self.settings.neg_index]]
-                        soft_lit_groups.append([lit for lit in rule_soft_lits])
+                        groups = [self.example_lits(self.settings.neg_index, -1)]
                 else:
-                    soft_lit_groups = [[self.example_covered_var[i] for i in self.settings.pos_index]]
+                    groups = [self.example_lits(self.settings.pos_index, 1)]
                     if not self.settings.nonoise:
-                        soft_lit_groups.append([-self.example_covered_var[i] for i in self.settings.neg_index])
-                    soft_lit_groups.append([lit for lit in rule_soft_lits])
+                        groups.append(self.example_lits(self.settings.neg_index, -1))
             else:
-                soft_lit_groups = [[self.example_covered_var[i] for i in self.settings.pos_index]]
+                groups = [self.example_lits(self.settings.pos_index, 1)]
                 if not self.settings.nonoise:
-                    soft_lit_groups.append([-self.example_covered_var[i] for i in self.settings.neg_index])
-                soft_lit_groups.append([lit for lit in rule_soft_lits])
+                    groups.append(self.example_lits(self.settings.neg_index, -1))
+            for lits, group in groups:
+                soft_lit_groups.append(lits)
+                group_weights.append(group)
+            soft_lit_groups.append([lit for lit in rule_soft_lits])
         else:
             for rule_id in self.rule_var:
                 if self.rule_var[rule_id] is not None:
                     soft_clauses.append([-self.rule_var[rule_id]])
                     weights.append(self.ruleid_to_size[rule_id])
+            example_weights = self.settings.example_weights
             for i in self.settings.pos_index:
                 soft_clauses.append([self.example_covered_var[i]])
-                weights.append(self.pos_example_weight)
+                weights.append(self.pos_example_weight * example_weights.get(i, 1))
             if not self.settings.nonoise:
                 for i in self.settings.neg_index:
                     soft_clauses.append([-self.example_covered_var[i]])
-                    weights.append(self.neg_example_weight)
+                    weights.append(self.neg_example_weight * example_weights.get(i, 1))
 
         while True:
             model_found = False
@@ -201,18 +211,18 @@ class Combiner:
                     cost, model = maxsat.anytime_maxsat_solve(encoding, soft_clauses, weights, self.settings, timeout)
             else:
                 if timeout is None or self.settings.last_combine_stage:
-                    cost, model = maxsat.exact_lex_solve(encoding, soft_lit_groups, weights, self.settings)
+                    cost, model = maxsat.exact_lex_solve(encoding, soft_lit_groups, weights, self.settings, group_weights)
                 else:
-                    cost, model = maxsat.anytime_lex_solve(encoding, soft_lit_groups, weights, self.settings, timeout)
+                    cost, model = maxsat.anytime_lex_solve(encoding, soft_lit_groups, weights, self.settings, timeout, group_weights)
 
             if model is None:
                 print("WARNING: No solution found, exit combiner.")
                 break
 
-            fn = sum([1 for i in self.settings.pos_index if model[self.example_covered_var[i]-1] < 0])
+            fn = num_examples([i for i in self.settings.pos_index if model[self.example_covered_var[i]-1] < 0], self.settings.example_weights)
             fp = 0
             if not self.settings.nonoise:
-                fp = sum([1 for i in self.settings.neg_index if model[self.example_covered_var[i]-1] > 0])
+                fp = num_examples([i for i in self.settings.neg_index if model[self.example_covered_var[i]-1] > 0], self.settings.example_weights)
             size = sum([self.ruleid_to_size[rule_id] for rule_id in self.ruleid_to_size if model[self.rule_var[rule_id]-1] > 0])
 
             if self.settings.lex:
@@ -339,6 +349,22 @@ class Combiner:
         model_rules, cost = self.find_combination(encoding, timeout)
         return [self.ruleid_to_rule[k] for k in model_rules], cost
 
+    def checkpoint_state(self):
+        state = {k: v for k, v in self.__dict__.items() if k not in ('settings', 'tester', 'rulehash_to_id', 'vpool')}
+        # an IDPool cannot be pickled
+        state['vpool'] = self.vpool.top, self.vpool.id2obj
+        return state
+
+    def restore(self, state):
+        top, id2obj = state.pop('vpool')
+        self.__dict__.update(state)
+        self.vpool = IDPool(start_from=top+1)
+        for k, obj in id2obj.items():
+            self.vpool.obj2id[obj] = k
+            self.vpool.id2obj[k] = obj
+        # rule hashes depend on the hash seed of the process, so rebuild them
+        self.rulehash_to_id = {get_rule_hash(rule): k for k, rule in self.ruleid_to_rule.items()}
+
     def update_best_prog(self, new_progs, timeout=None):
         if timeout is None:
             timeout = self.settings.maxsat_timeout
@@ -360,8 +386,8 @@ class Combiner:
 
         new_solution = reduce_prog(new_solution)
         pos_covered, neg_covered = self.tester.test_prog_all(new_solution)
-        tp = len(pos_covered)
-        fp = len(neg_covered)
+        tp = num_examples(pos_covered, self.settings.example_weights)
+        fp = num_examples(neg_covered, self.settings.example_weights)
         tn = self.tester.num_neg - fp
         fn = self.tester.num_pos - tp
         size = calc_prog_size(new_solution)
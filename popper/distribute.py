@@ -0,0 +1,137 @@
+import os
+import sys
+import queue
+import argparse
+import multiprocessing
+from time import perf_counter
+from . util import Settings, TIMEOUT, bias_order, print_prog_score
+from . checkpoint import dumps, loads
+from . portfolio import SharedBound, score_key
+from . bus import Relay, ConstraintBus
+
+# seconds between messages from a worker to the coordinator
+EXCHANGE_INTERVAL = 0.1
+POLL_TIME = 0.1
+# extra time given to the workers beyond the learning timeout before they are killed
+GRACE_TIME = 30
+
+class Exchange:
+    # sends the programs that this worker adds to the combiner to the other workers and receives theirs
+    # the constraints are shared by the generators, see bus.py
+    def __init__(self, settings, index, outbox, inbox):
+        self.settings = settings
+        self.index = index
+        self.outbox = outbox
+        self.inbox = inbox
+        self.programs = []
+        self.last = perf_counter()
+
+    def publish(self, programs):
+        self.programs.extend(programs)
+        if perf_counter() - self.last >= EXCHANGE_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.programs:
+            self.outbox.put((self.index, dumps(self.programs, self.settings)))
+            self.settings.stats.count('shared programs', len(self.programs))
+        self.programs = []
+        self.last = perf_counter()
+
+    def receive(self):
+        programs = []
+        while True:
+            try:
+                _sender, data = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            programs.extend(loads(data, self.settings))
+        self.settings.stats.count('received programs', len(programs))
+        return programs
+
+def assign_cells(settings, index, num_workers):
+    # split the cells of the search space, in order of size, round robin between the workers
+    max_size = (1 + settings.max_body) * settings.max_rules
+    cells = bias_order(settings, max_size)
+    return [cell for i, cell in enumerate(cells) if i % num_workers == index]
+
+def run_worker(index, num_workers, argv, bound, results, exchange, bus):
+    # import here so that the parent process never loads pyswip
+    from . loop import learn_solution
+    settings = Settings(cmd_line=True, argv=argv)
+    settings.assigned_cells = assign_cells(settings, index, num_workers)
+    # each worker solves one cell at a time and the workers do not search by increasing size overall
+    settings.single_solve = False
+    settings.order_space = True
+    settings.shared_bound = bound
+    settings.exchange = Exchange(settings, index, *exchange)
+    settings.constraint_bus = ConstraintBus(index, *bus)
+    def on_solution(prog, score):
+        bound.update(settings, score)
+        results.put((index, prog, score, False))
+    settings.on_solution = on_solution
+    prog, score, _stats = learn_solution(settings)
+    results.put((index, prog, score, True))
+
+def run_distributed(kbpath, num_workers, timeout, options, noisy):
+    ctx = multiprocessing.get_context('spawn')
+    bound = SharedBound(ctx)
+    results = ctx.Queue()
+    exchange = Relay(ctx, num_workers)
+    bus = Relay(ctx, num_workers)
+    exchange.start()
+    bus.start()
+    argv = [kbpath, '--quiet', '--timeout', str(timeout)] + options
+
+    workers = []
+    for index in range(num_workers):
+        endpoints = (exchange.outbox, exchange.inboxes[index]), (bus.outbox, bus.inboxes[index])
+        worker = ctx.Process(target=run_worker, args=(index, num_workers, argv, bound, results) + endpoints, daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    best = {}
+    finished = set()
+    deadline = perf_counter() + timeout + GRACE_TIME
+    while len(finished) < num_workers and perf_counter() < deadline:
+        try:
+            index, prog, score, final = results.get(timeout=POLL_TIME)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        if prog != None:
+            best[index] = prog, score
+        if final:
+            finished.add(index)
+            exchange.finished.add(index)
+            bus.finished.add(index)
+
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+    exchange.stop()
+    bus.stop()
+
+    if not best:
+        return None, None
+    return min(best.values(), key=lambda x: score_key(x[1], noisy))
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the hypothesis space of a Popper task with several processes that share constraints', epilog='Other options are passed to each Popper worker')
+    parser.add_argument('kbpath', help='Path to files to learn from')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Overall timeout in seconds (default: {TIMEOUT})')
+    args, options = parser.parse_known_args()
+    # the options are parsed as the workers parse them, so that an abbreviated --noisy is not missed
+    settings = Settings(cmd_line=True, argv=[args.kbpath] + options)
+
+    prog, score = run_distributed(args.kbpath, max(1, args.workers), args.timeout, options, settings.noisy)
+    if prog == None:
+        print('NO SOLUTION')
+        sys.exit(1)
+    print_prog_score(prog, score, settings.noisy)
+
+if __name__ == '__main__':
+    main()
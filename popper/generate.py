@@ -1,4 +1,6 @@
 import time
+import atexit
+import weakref
 from pysat.formula import CNF
 from pysat.solvers import Solver
 from pysat.card import *
@@ -9,26 +11,12 @@ import clingo.script
 import pkg_resources
 from . core import Literal, RuleVar, VarVar, Var
 from collections import defaultdict
-from . util import rule_is_recursive, format_rule, Constraint, format_prog, order_rule, order_prog, bias_order
+from . util import rule_is_recursive, format_rule, Constraint, format_prog, order_rule, order_prog, bias_order, next_model
 clingo.script.enable_python()
+from . symbols import SymbolTable, arg_to_symbol, atom_to_symbol
 from clingo import Function, Number, Tuple_
 from itertools import permutations
 
-arg_lookup = {clingo.Number(i):chr(ord('A') + i) for i in range(100)}
-
-def arg_to_symbol(arg):
-    if isinstance(arg, tuple):
-        return Tuple_(tuple(arg_to_symbol(a) for a in arg))
-    if isinstance(arg, numbers.Number):
-        return Number(arg)
-    if isinstance(arg, str):
-        return Function(arg)
-    assert False, f'Unhandled argtype({type(arg)}) in aspsolver.py arg_to_symbol()'
-
-def atom_to_symbol(pred, args):
-    xs = tuple(arg_to_symbol(arg) for arg in args)
-    return Function(name = pred, arguments = xs)
-
 def find_all_vars(body):
     all_vars = set()
     for literal in body:
@@ -255,6 +243,14 @@ def build_rule_ordering_literals(rule_index, rule_ordering):
             r2v = rule_index[r2]
             yield lt(r1v, r2v)
 
+# clingo aborts the process if the interpreter exits during an async solve, such as after an uncaught exception
+unfinished_solves = weakref.WeakSet()
+
+@atexit.register
+def cancel_unfinished_solves():
+    for handle in list(unfinished_solves):
+        handle.cancel()
+
 class Generator:
 
     def __init__(self, settings, grounder, bkcons=[]):
@@ -263,8 +259,15 @@ class Generator:
         self.grounder = grounder
         self.seen_handles = set()
         self.assigned = {}
-        self.seen_symbols = {}
-        self.cached_clingo_atoms = {}
+        # the clingo symbols and backend atoms of ground atoms, see symbols.py
+        self.symbols = SymbolTable(settings.stats)
+        # the rules added through the backend, as sets of backend literals, so that we never add a rule twice
+        # this lasts the whole run, as a repeat can come at any time, but it has one small entry per rule that the solver already holds, so it grows no faster than the solver
+        self.added_rule_ids = set()
+        # the bad handles whose bad_handle program we have grounded
+        self.grounded_bad_handles = set()
+        # the ground arguments of the seen_rule rules for each pattern of variables, see build_seen_rule2
+        self.seen_rule_templates = {}
         self.handle = None
 
         # handles for rules that are minimal and unsatisfiable
@@ -277,11 +280,19 @@ class Generator:
         # TODO: dunno
         self.new_ground_cons = set()
 
+        # shares ground constraints with the generators of other processes, see bus.py
+        self.bus = settings.constraint_bus
+
+        # rules added through the backend, kept to rebuild the solver when resuming from a checkpoint
+        # each checkpoint replaces the last one and a resumed run starts a new solver, so this holds every rule of the run, and only with --checkpoint
+        self.added_rules = None
+        if settings.checkpoint_file:
+            self.added_rules = []
+
         encoding = []
         alan = pkg_resources.resource_string(__name__, "lp/alan.pl").decode()
         encoding.append(alan)
-        with open(settings.bias_file) as f:
-            encoding.append(f.read())
+        encoding.append(settings.bias.text)
         encoding.append(f'max_clauses({settings.max_rules}).')
         encoding.append(f'max_body({settings.max_body}).')
         encoding.append(f'max_vars({settings.max_vars}).')
@@ -301,8 +312,14 @@ class Generator:
             program_size_at_least(M):- size(N), program_bounds(M), M <= N.
             """)
 
+        # the deduced constraints are rules as text and, with --bkcons-backend, ground facts (pred, args)
+        bk_facts = []
         if settings.bkcons:
-            encoding.extend(bkcons)
+            for x in bkcons:
+                if isinstance(x, str):
+                    encoding.append(x)
+                else:
+                    bk_facts.append(x)
 
         # FG Heuristic for single solve
         # - considering a default order of minimum rules, then minimum literals, and then minimum variables
@@ -355,6 +372,13 @@ class Generator:
             """
             solver.add('number_of_literals', ['n'], NUM_OF_LITERALS)
 
+            BAD_HANDLE = """
+            %%% A program cannot have two different bad rules, such as rule h, after the first rule %%%%%
+            bad_stuff(h,R):- seen_rule(h,R).
+            :- seen_rule(h,R1), bad_stuff(_,R2), R1 > 0, R2 > 0, R1 != R2.
+            """
+            solver.add('bad_handle', ['h'], BAD_HANDLE)
+
             if self.settings.no_bias:
                 NUM_OF_VARS = """
                 %%% External atom for number of variables in the program %%%%%
@@ -379,6 +403,12 @@ class Generator:
         solver.configuration.solve.models = 0
 
 
+        # add the facts before grounding so that the base program sees them, without formatting and parsing them
+        if bk_facts:
+            with solver.backend() as backend:
+                for pred, args in bk_facts:
+                    backend.add_rule([backend.add_atom(atom_to_symbol(pred, args))])
+
         solver.add('base', [], encoding)
         solver.ground([('base', [])])
         self.solver = solver
@@ -387,20 +417,30 @@ class Generator:
 
     def get_model(self):
         if self.handle == None:
-            self.handle = iter(self.solver.solve(yield_ = True))
-        return next(self.handle, None)
+            self.settings.stats.count('clingo solves')
+            self.handle = self.solver.solve(yield_ = True, async_ = True)
+            unfinished_solves.add(self.handle)
+        return next_model(self.handle, self.settings.deadline)
 
     def gen_symbol(self, literal, backend):
-        sign, pred, args = literal
-        k = hash(literal)
-        if k in self.seen_symbols:
-            symbol = self.seen_symbols[k]
-        else:
-            symbol = backend.add_atom(atom_to_symbol(pred, args))
-            self.seen_symbols[k] = symbol
-        return symbol
+        _sign, pred, args = literal
+        return self.symbols.backend_atom(backend, pred, args)
 
     def update_solver(self, size, num_vars, num_rules):
+        # the program cannot change while a solve is unfinished, such as when the loop leaves a cell early
+        if self.handle != None:
+            self.handle.cancel()
+            unfinished_solves.discard(self.handle)
+            self.handle = None
+
+        if self.bus:
+            self.bus.flush()
+            imported, rules = self.bus.receive()
+            self.all_ground_cons.update(imported)
+            # the rules define seen_rule handles, which cannot be defined again
+            self.all_handles.update(rule for rule in rules if rule[0][1][0] not in self.seen_handles)
+            self.settings.stats.count('imported nogoods', len(imported))
+
         self.update_number_of_literals(size)
         self.update_number_of_vars(num_vars)
         self.update_number_of_rules(num_rules)
@@ -429,29 +469,26 @@ class Generator:
             to_add.append((new_head, new_body))
 
 
+        self.add_rules(to_add)
+        if self.added_rules != None:
+            self.added_rules.extend(to_add)
+
         if self.settings.no_bias:
             self.bad_handles = []
-        for handle in self.bad_handles:
-            # if we know that rule_xyz is bad
-            # we add the groundings of bad_stuff(R,ThisSize):- seen_rule(rule_xyz, R), R=0..MaxRules.
-            for rule_id in range(0, self.settings.max_rules):
-                h = (True, 'bad_stuff', (rule_id, size))
-                b = (True, 'seen_rule', (handle, rule_id))
-                new_rule = (h, (b,))
-                to_add.append(new_rule)
-
-            # we now eliminate bad stuff
-            # :- seen_rule(rule_xyz,R1), bad_stuff(R2,Size), R1=0..MaxRules, R2=0..MaxRules, Size=0..ThisSize.
-            for smaller_size in range(1, size+1):
-                for r1 in range(1, self.settings.max_rules):
-                    atom1 = (True, 'seen_rule', (handle, r1))
-                    for r2 in range(1, self.settings.max_rules):
-                        if r1 == r2:
-                            continue
-                        atom2 = (True, 'bad_stuff', (r2, smaller_size))
-                        new_rule = ([], (atom1, atom2))
-                        to_add.append(new_rule)
+        # if we know that rule_xyz is bad, clingo grounds bad_stuff(rule_xyz,R):- seen_rule(rule_xyz,R) and the
+        # constraint against it and the other bad rules, after the seen_rule rules for rule_xyz are added
+        self.ground_bad_handles(self.bad_handles)
 
+        # for x in set(handle for handle, rule in handles):
+        self.seen_handles.update(new_seen_rules)
+
+
+        # RESET SO WE DO NOT KEEP ADDING THEM
+        self.all_ground_cons = set()
+        self.bad_handles = set()
+        self.all_handles = set()
+
+    def add_rules(self, to_add):
         with self.solver.backend() as backend:
             for head, body in to_add:
                 head_literal = []
@@ -462,18 +499,50 @@ class Generator:
                     sign, _pred, _args = literal
                     symbol = self.gen_symbol(literal, backend)
                     body_lits.append(symbol if sign else -symbol)
+                # the same constraint can be built again, such as from another process, before the solver sees it
+                k = (tuple(head_literal), frozenset(body_lits))
+                if k in self.added_rule_ids:
+                    self.settings.stats.count('repeated rules')
+                    continue
+                self.added_rule_ids.add(k)
                 backend.add_rule(head_literal, body_lits)
+        self.symbols.update_stats()
 
-        # for x in set(handle for handle, rule in handles):
-        self.seen_handles.update(new_seen_rules)
-
-
-        # RESET SO WE DO NOT KEEP ADDING THEM
-        self.all_ground_cons = set()
-        self.bad_handles = set()
-        self.all_handles = set()
-
-        self.handle = iter(self.solver.solve(yield_ = True))
+    def ground_bad_handles(self, bad_handles):
+        parts = []
+        for handle in bad_handles:
+            if handle in self.grounded_bad_handles:
+                continue
+            self.grounded_bad_handles.add(handle)
+            parts.append(('bad_handle', [arg_to_symbol(handle)]))
+        if parts:
+            self.solver.ground(parts)
+
+    def checkpoint_state(self):
+        return {
+            'added_rules': self.added_rules,
+            'seen_handles': self.seen_handles,
+            'all_ground_cons': self.all_ground_cons,
+            'all_handles': self.all_handles,
+            'bad_handles': self.bad_handles,
+            'grounded_bad_handles': self.grounded_bad_handles,
+        }
+
+    def restore(self, state, new_cons, ground_cons):
+        # called before the first solve
+        self.seen_handles = state['seen_handles']
+        self.all_ground_cons = state['all_ground_cons']
+        self.all_handles = state['all_handles']
+        self.bad_handles = state['bad_handles']
+        self.add_rules(state['added_rules'])
+        if self.added_rules != None:
+            self.added_rules.extend(state['added_rules'])
+        self.ground_bad_handles(state['grounded_bad_handles'])
+        self.all_ground_cons.update(ground_cons)
+        self.ground_constraints(new_cons)
+        # with a single solve, update_solver is never called and the constraints were only added as nogoods
+        if self.settings.single_solve:
+            self.add_rules(([], x) for x in self.all_ground_cons)
 
     def update_number_of_literals(self, size):
         # 1. Release those that have already been assigned
@@ -561,7 +630,33 @@ class Generator:
 
     # @profile
     def constrain(self, tmp_new_cons, model):
+        ground_bodies, new_handles = self.ground_constraints(tmp_new_cons)
+
+        if self.bus:
+            self.bus.publish(ground_bodies, new_handles)
+            # with a single solve there is no call to update_solver to import them at, so add them as nogoods now
+            if self.settings.single_solve:
+                imported, _rules = self.bus.receive()
+                self.all_ground_cons.update(imported)
+                ground_bodies.update(imported)
+                self.settings.stats.count('imported nogoods', len(imported))
+
+        nogoods = []
+        symbolic_atoms = self.solver.symbolic_atoms
+        for ground_body in ground_bodies:
+            nogood = self.symbols.nogood(symbolic_atoms, ground_body)
+            if nogood != None:
+                nogoods.append(nogood)
+        self.symbols.update_stats()
+
+        # with self.settings.stats.duration('constrain_clingo'):
+        for x in nogoods:
+            model.context.add_nogood(x)
+        self.settings.stats.count('nogoods', len(nogoods))
+
+    def ground_constraints(self, tmp_new_cons):
         new_cons = set()
+        new_handles = set()
         debug = True
         debug = False
 
@@ -579,12 +674,12 @@ class Generator:
             if con_type == Constraint.SPECIALISATION:
                 con_size = xs[3]
                 new_rule_handles2, con = self.build_specialisation_constraint2(con_prog, con_prog_ordering, spec_size=con_size)
-                self.all_handles.update(new_rule_handles2)
+                new_handles.update(new_rule_handles2)
                 new_cons.add(con)
             elif con_type == Constraint.GENERALISATION:
                 con_size = xs[3]
                 new_rule_handles2, con = self.build_generalisation_constraint2(con_prog, con_prog_ordering, gen_size=con_size)
-                self.all_handles.update(new_rule_handles2)
+                new_handles.update(new_rule_handles2)
                 new_cons.add(con)
             elif con_type == Constraint.UNSAT:
                 cons_ = self.unsat_constraint2(con_prog)
@@ -592,19 +687,20 @@ class Generator:
             elif con_type == Constraint.REDUNDANCY_CONSTRAINT1:
                 bad_handle, new_rule_handles2, con = self.redundancy_constraint1(con_prog, con_prog_ordering)
                 self.bad_handles.add(bad_handle)
-                self.all_handles.update(new_rule_handles2)
+                new_handles.update(new_rule_handles2)
                 new_cons.add(con)
             elif con_type == Constraint.REDUNDANCY_CONSTRAINT2:
                 new_rule_handles2, cons = self.redundancy_constraint2(con_prog, con_prog_ordering)
-                self.all_handles.update(new_rule_handles2)
+                new_handles.update(new_rule_handles2)
                 new_cons.update(cons)
             elif con_type == Constraint.TMP_ANDY:
                 new_cons.update(self.andy_tmp_con(con_prog))
             elif con_type == Constraint.BANISH:
                 new_rule_handles2, con = self.build_banish_constraint(con_prog, con_prog_ordering)
-                self.all_handles.update(new_rule_handles2)
+                new_handles.update(new_rule_handles2)
                 new_cons.add(con)
 
+        self.all_handles.update(new_handles)
         self.all_ground_cons.update(self.new_ground_cons)
         ground_bodies = set()
         ground_bodies.update(self.new_ground_cons)
@@ -616,24 +712,8 @@ class Generator:
                 ground_bodies.add(ground_body)
                 self.all_ground_cons.add(frozenset(ground_body))
 
-        nogoods = []
-        for ground_body in ground_bodies:
-            nogood = []
-            for sign, pred, args in ground_body:
-                k = hash((sign, pred, args))
-                try:
-                    x = self.cached_clingo_atoms[k]
-                except KeyError:
-                    x = (atom_to_symbol(pred, args), sign)
-                    self.cached_clingo_atoms[k] = x
-                nogood.append(x)
-            nogoods.append(nogood)
-
-        # with self.settings.stats.duration('constrain_clingo'):
-        for x in nogoods:
-            model.context.add_nogood(x)
-
         self.new_ground_cons = set()
+        return ground_bodies, new_handles
 
     def build_generalisation_constraint2(self, prog, rule_ordering=None, gen_size=False):
         new_handles = set()
@@ -684,39 +764,56 @@ class Generator:
 
         handle = make_rule_handle(rule)
         head, body = rule
+        body = list(body)
 
         head_vars = set(head.arguments)
-        body_vars = set(x for atom in body for x in atom.arguments if x not in head_vars)
 
-        possible_values = list(range(len(head_vars), self.settings.max_vars))
-        perms = list(permutations(possible_values, len(body_vars)))
-        indexes = {x:i for i, x in enumerate(list(body_vars))}
+        # the pattern of the body arguments: a head variable by its number and the other variables
+        # by -1, -2, ... in order of first occurrence
+        indexes = {}
+        pattern = []
+        for atom in body:
+            atom_pattern = []
+            for x in atom.arguments:
+                if x in head_vars:
+                    atom_pattern.append(ord(x) - ord('A'))
+                else:
+                    if x not in indexes:
+                        indexes[x] = -1 - len(indexes)
+                    atom_pattern.append(indexes[x])
+            pattern.append(tuple(atom_pattern))
+        pattern = tuple(pattern)
+
+        # rules with the same pattern ground to the same arguments for every assignment of the body variables
+        key = (len(head_vars), pattern, is_rec, self.settings.max_rules, self.settings.max_vars)
+        template = self.seen_rule_templates.get(key)
+        if template == None:
+            possible_values = list(range(len(head_vars), self.settings.max_vars))
+            ground_args = []
+            for xs in permutations(possible_values, len(indexes)):
+                ground_args.append(tuple(tuple(xs[-1-v] if v < 0 else v for v in atom_pattern) for atom_pattern in pattern))
+            rule_ids = [rule_id for rule_id in range(self.settings.max_rules) if not (is_rec and rule_id == 0)]
+            template = rule_ids, ground_args
+            self.seen_rule_templates[key] = template
+        else:
+            self.settings.stats.count('seen rule template hits')
+        rule_ids, ground_args = template
 
         ground_head_args = tuple(range(len(head_vars)))
+        head_arity = len(head.arguments)
+        body_preds = [(atom.predicate, len(atom.arguments)) for atom in body]
 
+        # the stamping stays in plain Python: the atoms must be hashable tuples for the symbol table
+        # and building them from numpy arrays (tolist or object arrays) was slower than this loop
         out = []
-        for rule_id in range(self.settings.max_rules):
-            if is_rec and rule_id == 0:
-                continue
-            # new_head = (True, 'seen_rule', (handle, rule_id))
+        for rule_id in rule_ids:
             new_head = ('seen_rule', (handle, rule_id))
-            for xs in perms:
-                new_body = []
-                # new_body.append((True, 'head_literal', (rule_id, head.predicate, len(head.arguments), ground_head_args)))
-                new_body.append(('head_literal', (rule_id, head.predicate, len(head.arguments), ground_head_args)))
-                for atom in body:
-                    new_args = []
-                    for x in atom.arguments:
-                        if x in head_vars:
-                            v = ord(x)- ord('A')
-                            new_args.append(v)
-                        else:
-                            new_args.append(xs[indexes[x]])
-                    new_args = tuple(new_args)
-                    # new_body.append((True, 'body_literal', (rule_id, atom.predicate, len(atom.arguments), new_args)))
-                    new_body.append(('body_literal', (rule_id, atom.predicate, len(atom.arguments), new_args)))
-                new_rule = (new_head, frozenset(new_body))
-                out.append(new_rule)
+            head_literal = ('head_literal', (rule_id, head.predicate, head_arity, ground_head_args))
+            for atom_args in ground_args:
+                new_body = [head_literal]
+                for (pred, arity), args in zip(body_preds, atom_args):
+                    new_body.append(('body_literal', (rule_id, pred, arity, args)))
+                out.append((new_head, frozenset(new_body)))
         return frozenset(out)
 
 
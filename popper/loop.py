@@ -1,5 +1,7 @@
 import time
+import queue
 import numbers
+import multiprocessing
 import collections
 from itertools import permutations
 from itertools import chain, combinations
@@ -7,14 +9,20 @@ from collections import deque
 from . explain import get_raw_prog as get_raw_prog2
 # from . combine import Combiner
 from . explain import Explainer, head_connected, get_raw_prog, seen_more_general_unsat, has_valid_directions, order_body, connected
-from . util import timeout, format_rule, rule_is_recursive, order_prog, prog_is_recursive, prog_has_invention, order_rule, calc_prog_size, format_literal, theory_subsumes, rule_subsumes, format_prog, format_prog2, order_rule2, Constraint, bias_order, mdl_score, suppress_stdout_stderr
+from . util import timeout, format_rule, rule_is_recursive, order_prog, prog_is_recursive, prog_has_invention, order_rule, calc_prog_size, format_literal, theory_subsumes, rule_subsumes, format_prog, format_prog2, order_rule2, Constraint, bias_order, mdl_score, num_examples, suppress_stdout_stderr
 from . core import Literal
 from . tester import Tester
-from . generate import Generator, Grounder, parse_model_pi, parse_model_recursion, parse_model_single_rule, atom_to_symbol, arg_to_symbol
+from . generate import Generator, Grounder, parse_model_pi, parse_model_recursion, parse_model_single_rule
+from . symbols import atom_to_symbol, arg_to_symbol
 from . bkcons import deduce_bk_cons, deduce_recalls
+from . trace import Tracer
+from . checkpoint import Checkpointer
+from . profiler import start_profiler
 from . variants import find_variants
 
 WITH_OPTIMISATIONS = True
+# the number of success sets that we check to find whether a rule is subsumed before we find every positive example that it covers
+LAZY_SUBSUMPTION_CHECKS = 1
 # WITH_OPTIMISATIONS = False
 
 pruned2 = set()
@@ -184,15 +192,10 @@ def subsumed_or_covers_too_few(prog, tester, success_sets, settings, check_cover
             out.update(xs)
             continue
 
-        sub_prog_pos_covered = tester.get_pos_covered(new_prog, ignore=True)
-
-
-        if settings.order_space:
-            # this check does not assume that we search by increasing program size
-            subsumed = is_subsumed(sub_prog_pos_covered, calc_prog_size(new_prog), success_sets)
-        else:
-            # this check assumes that we search by increasing program size
-            subsumed = sub_prog_pos_covered in success_sets or any(sub_prog_pos_covered.issubset(xs) for xs in success_sets)
+        new_prog_size = calc_prog_size(new_prog)
+        # we only need to know whether the subprogram is subsumed or covers one example
+        sub_prog_pos_covered, subsumed = test_pos_subsumed(tester, new_prog, new_prog_size, success_sets, settings, tester.get_pos_covered_from)
+        subsumed = subsumed or pos_subsumed(sub_prog_pos_covered, new_prog_size, success_sets, settings)
 
         prune = check_subsumed and subsumed
         prune = prune or (check_coverage and len(sub_prog_pos_covered) == 1)
@@ -415,11 +418,61 @@ def prune_subsumed_backtrack2(pos_covered, settings, could_prune_later, tester,
 
     return to_prune
 
+# whether the constraints for a program prune the program itself
+def prunes_prog(prog, cons):
+    for con in cons:
+        if con[1] is not prog:
+            continue
+        if con[0] == Constraint.BANISH:
+            return True
+        if con[0] in (Constraint.SPECIALISATION, Constraint.GENERALISATION) and con[3] == None:
+            return True
+    return False
+
 def is_subsumed(pos_covered, prog_size, success_sets):
     subsumed = pos_covered in success_sets and prog_size >= (success_sets[pos_covered])
     subsumed = subsumed or any(pos_covered.issubset(xs) and prog_size >= prog_size2 for xs, prog_size2 in success_sets.items())
     return subsumed
 
+def pos_subsumed(pos_covered, prog_size, success_sets, settings):
+    if settings.order_space:
+        # this check does not assume that we search by increasing program size
+        return is_subsumed(pos_covered, prog_size, success_sets)
+    # this check assumes that we search by increasing program size
+    return pos_covered in success_sets or any(pos_covered.issubset(xs) for xs in success_sets)
+
+def test_pos_subsumed(tester, prog, prog_size, success_sets, settings, test_pos_from):
+    # we only need every positive example that a program covers when a success set does not subsume it
+    # so we first check whether the largest success set with the first two examples that it covers subsumes it
+    # returns the first two examples if it does, and otherwise every example from test_pos_from, and whether we found it subsumed
+    # a complete success set could subsume a complete program, which we would then not know is complete
+    num_pos = len(settings.pos_index)
+    incomplete = [xs for xs, size in success_sets.items() if len(xs) < num_pos and (not settings.order_space or prog_size >= size)]
+    if len(incomplete) == 0:
+        return test_pos_from(prog, frozenset()), False
+    pos_covered = tester.test_prog_pos_at_most(prog, 2)
+    if len(pos_covered) < 2:
+        return pos_covered, False
+    candidates = [xs for xs in incomplete if pos_covered.issubset(xs)]
+    candidates.sort(key=len, reverse=True)
+    for xs in candidates[:LAZY_SUBSUMPTION_CHECKS]:
+        if not tester.covers_pos_outside(prog, xs):
+            settings.stats.count('lazy subsumption')
+            return pos_covered, True
+    # resume from the first two examples rather than test them again
+    return test_pos_from(prog, pos_covered), False
+
+def noisy_neg_budget(settings, prog, prog_size, num_pos_covered):
+    # the number of negative examples after which we stop counting the ones that a program covers
+    # maximum size of specialisations allowed
+    if len(prog) == 1:
+        k1 = min([settings.max_body-(prog_size-1), settings.max_literals-prog_size])
+    else:
+        k1 = settings.max_literals-prog_size
+    # conditions which determine whether a program can be part of a solution
+    k2 = min([settings.best_mdl - prog_size, num_pos_covered-prog_size])
+    return max([k1, k2, 1])
+
 def build_constraints_previous_hypotheses(generator, num_pos, num_neg, seen_hyp_spec, seen_hyp_gen, score, best_size):
     cons = []
     # print(f"new best score {score}")
@@ -467,7 +520,6 @@ def load_solver(settings, tester):
     elif settings.solver in ['rc2', 'uwr', 'wmaxcdcl']:
         from . combine_ms import Combiner
         settings.maxsat_timeout = None
-        settings.stats.maxsat_calls = 0
         if settings.solver == 'rc2':
             settings.exact_maxsat_solver = 'rc2'
         elif settings.solver == 'uwr':
@@ -512,6 +564,11 @@ def load_solver(settings, tester):
     return Combiner(settings, tester)
 
 def popper(settings):
+    exchange = settings.exchange
+    tracer = None
+    if settings.trace_file:
+        tracer = settings.tracer = Tracer(settings.trace_file)
+
     with settings.stats.duration('load data'):
         tester = Tester(settings)
 
@@ -521,8 +578,10 @@ def popper(settings):
     settings.nonoise = not settings.noisy
     settings.solution_found = False
 
-    num_pos = len(settings.pos_index)
-    num_neg = len(settings.neg_index)
+    # the indexes of identical examples are merged, so we count the examples with their weights
+    weights = settings.example_weights
+    num_pos = tester.num_pos
+    num_neg = tester.num_neg
 
     uncovered = set(settings.pos_index)
 
@@ -564,7 +623,7 @@ def popper(settings):
 
     if settings.bkcons:
         with settings.stats.duration('bkcons'):
-            bkcons.extend(deduce_bk_cons(settings, tester))
+            bkcons.extend(deduce_bk_cons(settings))
 
     # generator that builds programs
     with settings.stats.duration('init'):
@@ -582,9 +641,50 @@ def popper(settings):
 
     last_size = None
 
-    search_order = bias_order(settings, max_size)
+    # programs in the current part of the search space that are not pruned by their own constraints
+    # only tracked for checkpoints, so that a resumed search does not test them again
+    unpruned = []
+
+    checkpointer = None
+    start_cell = 0
+    if settings.checkpoint_file:
+        checkpointer = Checkpointer(settings)
+        state = None
+        if settings.resume:
+            state = checkpointer.load()
+        if state:
+            start_cell = state['cell']
+            success_sets = state['success_sets']
+            success_sets_noise = state['success_sets_noise']
+            rec_success_sets = state['rec_success_sets']
+            could_prune_later = state['could_prune_later']
+            to_combine = state['to_combine']
+            last_size = state['last_size']
+            uncovered = state['uncovered']
+            unpruned = state['unpruned']
+            if settings.noisy:
+                min_score, saved_scores, seen_hyp_spec, seen_hyp_gen = state['noisy']
+            combiner.restore(state['combiner'])
+            explainer.seen_prog, explainer.unsat = state['explainer']
+            size_cons = []
+            if settings.single_solve:
+                size_cons = [frozenset([(True, 'size', (i,))]) for i in range(settings.max_literals+1, max_size+1)]
+            banish = [(Constraint.BANISH, prog, rule_ordering) for prog, rule_ordering in unpruned]
+            generator.restore(state['generator'], banish, size_cons)
+    elif settings.resume:
+        settings.logger.warn('--resume needs --checkpoint FILE')
+
+    search_order = settings.assigned_cells
+    if search_order == None:
+        search_order = bias_order(settings, max_size)
+
+    for cell, (size, n_vars, n_rules, _) in enumerate(search_order):
+        if cell < start_cell:
+            continue
+
+        # grounding a cell can take a while, so do not start one after the deadline
+        settings.deadline.check()
 
-    for (size, n_vars, n_rules, _) in search_order:
         if size > settings.max_literals:
             #break # Here we have to continue the loop given that we might be jumping back and forth over the size
             continue
@@ -614,7 +714,9 @@ def popper(settings):
             gen_size = None
             size_change = False
             neg_covered = None
+            num_neg_covered = None
             inconsistent = None
+            combine_time = None
 
             new_cons = []
 
@@ -624,6 +726,16 @@ def popper(settings):
                 if model is None:
                     break
 
+            # another process in a portfolio found a better solution
+            if settings.shared_bound and settings.shared_bound.tighten(settings):
+                if not settings.single_solve and size > settings.max_literals:
+                    break
+                if settings.single_solve:
+                    for i in range(settings.max_literals+1, max_size+1):
+                        size_con = [(atom_to_symbol("size", (i,)), True)]
+                        model.context.add_nogood(size_con)
+                        settings.stats.count('nogoods')
+
             with settings.stats.duration('parse'):
                 atoms = model.symbols(shown = True)
                 if settings.pi_enabled:
@@ -659,22 +771,24 @@ def popper(settings):
             with settings.stats.duration('test'):
                 if settings.noisy:
                     if settings.recursion_enabled or settings.pi_enabled:
-                        pos_covered, neg_covered = tester.test_prog_all(prog)
-                        inconsistent = len(neg_covered) > 0
+                        # count the positive and negative examples in one pass
+                        # only a program that can go to the combiner needs the negative examples it covers
+                        neg_budget = noisy_neg_budget(settings, prog, prog_size, num_pos)
+                        neg_ids = not is_recursive and not has_invention
+                        num_pos_covered, num_neg_covered, pos_covered, neg_covered = tester.count_covered(prog, None, neg_budget, pos_ids=True, neg_ids=neg_ids)
+                        if num_neg_covered >= neg_budget:
+                            skip_early_neg = True
+                        inconsistent = num_neg_covered > 0
                     else:
                         pos_covered = tester.test_single_rule_pos(prog)
-                        num_pos_covered = len(pos_covered)
-                        if len(pos_covered) > prog_size:
-                            # maximum size of specialisations allowed
-                            test_at_most_k_neg1 = min([settings.max_body-(prog_size-1), settings.max_literals-prog_size])
-                            # conditions which determine whether a program can be part of a solution
-                            test_at_most_k_neg2 = min([settings.best_mdl - prog_size, num_pos_covered-prog_size])
-                            test_at_most_k_neg = max([test_at_most_k_neg1, test_at_most_k_neg2])
-                            neg_covered = tester.test_single_rule_neg_at_most_k(prog, test_at_most_k_neg)
-                            if len(neg_covered) == test_at_most_k_neg:
+                        num_pos_covered = num_examples(pos_covered, weights)
+                        if num_pos_covered > prog_size:
+                            neg_budget = noisy_neg_budget(settings, prog, prog_size, num_pos_covered)
+                            _, num_neg_covered, _, neg_covered = tester.count_covered(prog, 0, neg_budget, neg_ids=True)
+                            if num_neg_covered >= neg_budget:
                                 skip_early_neg = True
 
-                            inconsistent = len(neg_covered) > 0
+                            inconsistent = num_neg_covered > 0
                         else:
                             skipped = True
 
@@ -682,29 +796,32 @@ def popper(settings):
                     if settings.recursion_enabled or settings.pi_enabled:
                         pos_covered, inconsistent = tester.test_prog(prog)
                     else:
-                        # check pos examples
-                        pos_covered = tester.test_prog_pos(prog)
+                        # check pos examples, but not all of them if the program is subsumed
+                        pos_covered, subsumed = test_pos_subsumed(tester, prog, prog_size, success_sets, settings, tester.test_prog_pos_from)
                         inconsistent = True
                         # if no positive example is covered, no need to check negative examples
                         if len(pos_covered) > 0:
                             if not settings.solution_found or len(pos_covered) > 1:
                                 inconsistent = tester.test_prog_inconsistent(prog)
-
-            num_pos_covered = len(pos_covered)
+                    num_pos_covered = num_examples(pos_covered, weights)
 
             # if non-separable program covers all examples, stop
             if not skipped and not inconsistent and num_pos_covered == num_pos and not settings.order_space:
                 settings.solution = prog
                 settings.best_prog_score = num_pos, 0, num_neg, 0, prog_size
                 settings.best_mdl = prog_size
+                if settings.on_solution:
+                    settings.on_solution(prog, settings.best_prog_score)
+                if tracer:
+                    tracer.program(settings.stats, prog, prog_size, num_pos_covered, num_neg_covered, inconsistent, new_cons, combine_time, constrained=False)
                 return
 
             if settings.noisy:
-                tp = len(pos_covered)
+                tp = num_pos_covered
                 fn = num_pos-tp
                 fp, tn = None, None
                 if not skipped:
-                    fp = len(neg_covered)
+                    fp = num_neg_covered
                     tn = num_neg-fp
                     score = tp, fn, tn, fp, prog_size
                     mdl = mdl_score(fn, fp, prog_size)
@@ -747,7 +864,7 @@ def popper(settings):
 
             if not has_invention:
                 explainer.add_seen(prog)
-                if num_pos_covered == 0 or (settings.noisy and len(pos_covered) < prog_size):
+                if num_pos_covered == 0 or (settings.noisy and num_pos_covered < prog_size):
                     # if the programs does not cover any positive examples, check whether it is has an unsat core
                     with settings.stats.duration('find mucs'):
                         cons_ = explain_incomplete(settings, explainer, tester, prog, directions)
@@ -757,11 +874,9 @@ def popper(settings):
             if not settings.noisy:
                 if not is_recursive and num_pos_covered > 0:
                     # if we do not search by increasing size, we need to use a strict form of subsumption
-                    if settings.order_space:
-                        subsumed = is_subsumed(pos_covered, prog_size, success_sets)
-                    else:
-                        subsumed = pos_covered in success_sets
-                        subsumed = subsumed or any(pos_covered.issubset(xs) for xs in success_sets)
+                    # the test may have found that the program is subsumed before finding every example that it covers
+                    if not subsumed:
+                        subsumed = pos_subsumed(pos_covered, prog_size, success_sets, settings)
 
                     if subsumed:
                         add_spec = True
@@ -769,7 +884,7 @@ def popper(settings):
                     if not has_invention and WITH_OPTIMISATIONS:
                         # we check whether a program does not cover enough examples to be useful
                         # if the program only not cover enough examples, we prune it specialisations
-                        covers_too_few = settings.solution_found and not settings.order_space and num_pos_covered == 1
+                        covers_too_few = settings.solution_found and not settings.order_space and len(pos_covered) == 1
                         if covers_too_few:
                             add_spec = True
 
@@ -803,6 +918,7 @@ def popper(settings):
                     # if consistent, prune specialisations
                     add_spec = True
                     neg_covered = frozenset()
+                    num_neg_covered = 0
 
                 # if consistent and partially complete, test whether functional
                 if not inconsistent and settings.functional_test and num_pos_covered > 0 and not pruned_more_general:
@@ -946,8 +1062,8 @@ def popper(settings):
                     else:
                         settings.solution = prog
                     uncovered = uncovered-pos_covered
-                    tp = num_pos-len(uncovered)
-                    fn = len(uncovered)
+                    fn = num_examples(uncovered, weights)
+                    tp = num_pos-fn
                     tn = num_neg
                     fp = 0
                     hypothesis_size = calc_prog_size(settings.solution)
@@ -969,6 +1085,7 @@ def popper(settings):
                     # t1 = time.time()
                     is_new_solution_found = combiner.update_best_prog(to_combine)
                     # print(f'combine time: {time.time()-t1}')
+                combine_time = settings.stats.durations['combine'].last
 
                 to_combine=[]
 
@@ -997,6 +1114,7 @@ def popper(settings):
                             for i in range(best_score, max_size+1):
                                 size_con = [(atom_to_symbol("size", (i,)), True)]
                                 model.context.add_nogood(size_con)
+                                settings.stats.count('nogoods')
                     # print("HERE!!!", tp, fn, tn, fp)
                     if not settings.noisy and fp == 0 and fn == 0:
                         settings.solution_found = True
@@ -1010,6 +1128,7 @@ def popper(settings):
                         for i in range(hypothesis_size, max_size+1):
                             size_con = [(atom_to_symbol("size", (i,)), True)]
                             model.context.add_nogood(size_con)
+                            settings.stats.count('nogoods')
 
             # BUILD CONSTRAINTS
             if add_spec and not pruned_sub_incomplete and not pruned_more_general and not add_redund2:
@@ -1043,10 +1162,58 @@ def popper(settings):
             if settings.noisy and not add_spec and not add_gen:
                 new_cons.append((Constraint.BANISH, prog, rule_ordering))
 
+            if checkpointer and not prunes_prog(prog, new_cons):
+                unpruned.append((prog, rule_ordering))
+
             # CONSTRAIN
             with settings.stats.duration('constrain'):
                 generator.constrain(new_cons, model)
 
+            if tracer:
+                tracer.program(settings.stats, prog, prog_size, num_pos_covered, num_neg_covered, inconsistent, new_cons, combine_time)
+
+            if exchange:
+                shared = []
+                if add_to_combiner:
+                    shared.append((prog, pos_covered, neg_covered, prog_size, is_recursive))
+                exchange.publish(shared)
+                received_progs = exchange.receive()
+                # other processes search out of size order, so record the size of each success set
+                for prog2, pos2, neg2, size2, is_recursive2 in received_progs:
+                    to_combine.append((prog2, pos2, neg2))
+                    if settings.noisy:
+                        continue
+                    if pos2 not in success_sets or size2 < success_sets[pos2]:
+                        success_sets[pos2] = size2
+                    if is_recursive2 and (pos2 not in rec_success_sets or size2 < rec_success_sets[pos2]):
+                        rec_success_sets[pos2] = size2
+
+            if checkpointer and checkpointer.due():
+                noisy_state = None
+                if settings.noisy:
+                    noisy_state = min_score, saved_scores, seen_hyp_spec, seen_hyp_gen
+                checkpointer.save({
+                    'cell': cell,
+                    'success_sets': success_sets,
+                    'success_sets_noise': success_sets_noise,
+                    'rec_success_sets': rec_success_sets,
+                    'could_prune_later': could_prune_later,
+                    'to_combine': to_combine,
+                    'last_size': last_size,
+                    'uncovered': uncovered,
+                    'unpruned': unpruned,
+                    'noisy': noisy_state,
+                    'generator': generator.checkpoint_state(),
+                    'combiner': combiner.checkpoint_state(),
+                    'explainer': (explainer.seen_prog, explainer.unsat),
+                })
+
+        # programs from this part of the search space are not generated again
+        unpruned = []
+
+        if exchange:
+            exchange.flush()
+
         # if not pi_or_rec:
         if to_combine:
             # print('LAST CALL')
@@ -1087,5 +1254,60 @@ def popper(settings):
     assert(len(to_combine) == 0)
 
 def learn_solution(settings):
-    timeout(settings, popper, (settings,), timeout_duration=int(settings.timeout),)
+    profiler = None
+    if settings.profile_file:
+        profiler = start_profiler(settings)
+    timeout(settings, popper, (settings,), timeout_duration=settings.timeout)
+    if settings.tester:
+        settings.tester.update_stats()
+    if profiler:
+        profiler.stop()
+        profiler.write_collapsed(settings.profile_file)
+        print(profiler.summary())
+    settings.stats.snapshot(final=True)
+    if settings.tracer:
+        settings.tracer.close()
     return settings.solution, settings.best_prog_score, settings.stats
+
+def stream_solutions(settings, solutions):
+    sent = []
+    def on_solution(prog, score):
+        sent.append(prog)
+        solutions.put((prog, score))
+    settings.on_solution = on_solution
+    try:
+        prog, score, _stats = learn_solution(settings)
+        if prog != None and (not sent or sent[-1] is not prog):
+            solutions.put((prog, score))
+    finally:
+        # tells iter_solutions that no more solutions will come
+        solutions.put(None)
+
+def iter_solutions(settings):
+    # learns in a child process and yields each new best (prog, score) as soon as it is found
+    # the last one yielded is the final solution
+    # fork so that the settings, including the loaded bias, do not need to be pickled
+    ctx = multiprocessing.get_context('fork')
+    solutions = ctx.Queue()
+    process = ctx.Process(target=stream_solutions, args=(settings, solutions), daemon=True)
+    process.start()
+    try:
+        while True:
+            try:
+                solution = solutions.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                # the process can put its last solutions between the timeout and its exit
+                # so take what is left before giving up on the end marker
+                try:
+                    solution = solutions.get_nowait()
+                except queue.Empty:
+                    break
+            if solution == None:
+                break
+            yield solution
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
@@ -1,6 +1,8 @@
 %%%%%%%%%% EXAMPLE LOADING %%%%%%%%%%
 :- dynamic
-    neg_index/2.
+    neg_index/2,
+    ex_weight/2,
+    ex_exceeded/2.
 
 load_examples:-
     load_pos,
@@ -9,27 +11,50 @@ load_examples:-
 load_pos:-
     current_predicate(pos/1),!,
     findall(X, pos(X), Pos),
-    assert_pos_aux(Pos,1).
+    example_classes(Pos, Classes),
+    assert_pos_aux(Classes,1).
 load_pos.
 
 load_neg:-
     current_predicate(neg/1),!,
     findall(X, neg(X), Neg),
-    assert_neg_aux(Neg,-1).
+    example_classes(Neg, Classes),
+    assert_neg_aux(Classes,-1).
 load_neg.
 
+%% identical examples are covered by the same programs, so we index one example for each with its number of copies as its weight
+%% the examples keep the order of their first copy, so the indexes do not change when there are no copies
+example_classes(Xs, Classes):-
+    findall(X-I, nth1(I, Xs, X), Pairs),
+    keysort(Pairs, Sorted),
+    group_pairs_by_key(Sorted, Grouped),
+    findall(I-(X-W), (member(X-[I|Is], Grouped), length([I|Is], W)), Firsts),
+    keysort(Firsts, Ordered),
+    pairs_values(Ordered, Classes).
+
 assert_pos_aux([],_).
-assert_pos_aux([H|T],I1):-
+assert_pos_aux([H-W|T],I1):-
     assertz(pos_index(I1, H)),
+    assert_weight(I1, W),
     I2 is I1+1,
     assert_pos_aux(T,I2).
 
 assert_neg_aux([],_).
-assert_neg_aux([H|T],I1):-
+assert_neg_aux([H-W|T],I1):-
     assertz(neg_index(I1, H)),
+    assert_weight(I1, W),
     I2 is I1-1,
     assert_neg_aux(T,I2).
 
+%% only examples with copies have a weight fact
+assert_weight(_, 1):- !.
+assert_weight(ID, W):-
+    assertz(ex_weight(ID, W)).
+
+example_weight(ID, W):-
+    ex_weight(ID, W),!.
+example_weight(_, 1).
+
 %%%%%%%%%% EXAMPLE TESTING %%%%%%%%%%
 
 ex_index(ID,Atom):-
@@ -44,17 +69,38 @@ ex_index(ID,Atom):-
 %%     timeout(T),
 %%     catch(call_with_time_limit(T, call(Atom)),time_limit_exceeded,false),!.
 
+%% the limit is Factor times the largest cost of an example so far, between Min and Max inferences
+test_ex(X):-
+    current_predicate(inference_limit/3),!,
+    inference_limit(Min,Max,Factor),
+    flag(ex_max_inferences, M, M),
+    Limit is min(Max, max(Min, M*Factor)),
+    statistics(inferences, I0),
+    (call_with_inference_limit(X, Limit, Result) -> true ; Result = false),
+    statistics(inferences, I1),
+    Cost is I1-I0,
+    ex_cost(X, Cost, Result),
+    Result \== false,
+    Result \== inference_limit_exceeded,!.
+
 test_ex(X):-
     current_predicate(timeout/1),!,
     timeout(T),
     catch(call_with_time_limit(T, call(X)),time_limit_exceeded,false),!.
-    %% call_with_inference_limit(call(X), 100000, Result),!,
-    %% call_with_inference_limit(call(X), 10000, Result),!,
-    %% Result \= inference_limit_exceeded.
 
 test_ex(Atom):-
     call(Atom),!.
 
+%% records the cost of an example in flags, which are cheaper than the database, and the examples that exceed the limit
+ex_cost(X, _, inference_limit_exceeded):-!,
+    (retract(ex_exceeded(X,N0)) -> N is N0+1 ; N = 1),
+    assertz(ex_exceeded(X,N)).
+ex_cost(X, Cost, _):-
+    flag(ex_calls, N, N+1),
+    flag(ex_inferences, T, T+Cost),
+    flag(ex_max_inferences, M, M),
+    (Cost > M -> flag(ex_max_inferences, _, Cost), nb_setval(ex_max_atom, X) ; true).
+
 pos_covered(Xs):-
     findall(ID, (pos_index(ID,Atom),test_ex(Atom)), Xs).
 
@@ -69,6 +115,17 @@ is_more_inconsistent(Xs):-
     \+member(Id,Xs),
     test_ex(Atom),!.
 
+pos_covered_at_most(K,Xs):-
+    findfirstn(K, ID, (pos_index(ID,Atom),test_ex(Atom)), Xs).
+
+pos_covered_from(K,Xs):-
+    findall(ID, (pos_index(ID,Atom),ID > K,test_ex(Atom)), Xs).
+
+covers_any_pos(Xs):-
+    member(ID,Xs),
+    pos_index(ID,Atom),
+    test_ex(Atom),!.
+
 covers_any(Xs,Id):-
     member(Id,Xs),
     neg_index(Id,Atom),
@@ -106,10 +163,11 @@ sat:-
 
 covers_at_least_k_pos(K):-
     Counter = counter(0),
-    pos_index(_,Atom),
+    pos_index(ID,Atom),
     once(test_ex(Atom)),
+    example_weight(ID,W),
     arg(1, Counter, N0),
-    N is N0 + 1,
+    N is N0 + W,
     ((N>=K -> true,!);
     (nb_setarg(1, Counter, N),
     fail)).
@@ -118,12 +176,34 @@ covers_at_least_k_pos(K):-
 %%     pos_index(_,Atom),
 %%     test_ex(Atom),!.
 
-succeeds_k_times(Goal,Body,Times):-
+%% counts, with their weights, the examples ID of Goal for which Body holds, and stops once the count reaches Budget
+count_examples(ID,Goal,Body,Budget,Count):-
+    Counter = counter(0),
+    \+ \+ ((Goal, once(Body), counted(Counter,ID,Budget)) -> true ; true),
+    arg(1, Counter, Count).
+
+%% the same, but also returns the examples that it counted
+count_examples(ID,Goal,Body,Budget,Count,IDs):-
+    Counter = counter(0),
+    findall(ID, (Goal, once(Body), (counted(Counter,ID,Budget) -> ! ; true)), IDs),
+    arg(1, Counter, Count).
+
+%% adds the weight of example ID to the counter and succeeds once the count reaches Budget
+counted(Counter,ID,Budget):-
+    example_weight(ID,W),
+    arg(1, Counter, N0),
+    N is N0 + W,
+    nb_setarg(1, Counter, N),
+    N >= Budget.
+
+%% succeeds if Body holds for examples ID of Goal with a total weight of at least Times
+succeeds_k_times(ID,Goal,Body,Times):-
     Counter = counter(0),
     Goal,
     once(Body),
+    example_weight(ID,W),
     arg(1, Counter, N0),
-    N is N0 + 1,
+    N is N0 + W,
     ((N>=Times -> true,!);
     (nb_setarg(1, Counter, N),
     fail)).
@@ -4,6 +4,16 @@ import os, subprocess, sys, tempfile
 from pysat.formula import WCNF
 from pysat.examples.rc2 import RC2
 from pysat.card import *
+from .util import DeadlineExceeded
+
+try:
+    from pysat.pb import PBEnc
+except (ImportError, AssertionError):
+    # PBEnc needs pypblib
+    PBEnc = None
+
+# seconds, the shortest limit given to an anytime solver near the deadline
+MIN_ANYTIME_TIMEOUT = 0.01
 
 def old_wcnf_to_file(hard_clauses, soft_clauses, weights, file):
     n_vars = 0
@@ -35,9 +45,17 @@ def new_wcnf_to_file(hard_clauses, soft_clauses, weights, file):
         file.write(str(w) + " " + " ".join(map(str, clause)) + " 0" + "\n")
     file.flush()
 
+def exact_solver_output(args, settings):
+    try:
+        return subprocess.check_output(args, timeout=settings.deadline.remaining()).decode("utf-8").split("\n")
+    except subprocess.TimeoutExpired:
+        raise DeadlineExceeded()
+
 def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings):
     # print("Calling exact MaxSAT solver!")
-    settings.stats.maxsat_calls += 1
+    # RC2 cannot be interrupted, so we only check the deadline before calling it
+    settings.deadline.check()
+    settings.stats.count('maxsat calls')
     if settings.exact_maxsat_solver == "rc2":
         rc2 = RC2(WCNF())
         for clause in hard_clauses:
@@ -61,7 +79,7 @@ def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings):
                 # output = subprocess.check_output([os.path.join(os.path.dirname(__file__), settings.exact_maxsat_solver)] + settings.exact_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
                 args = [settings.exact_maxsat_solver] + settings.exact_maxsat_solver_params.split() + [tmp.name]
                 # print(args)
-                output = subprocess.check_output(args).decode("utf-8").split("\n")
+                output = exact_solver_output(args, settings)
             except subprocess.CalledProcessError as error:
                 output = error.output.decode("utf-8").split("\n")
         if "s UNSATISFIABLE" in output:
@@ -84,7 +102,7 @@ def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings):
             try:
                 # output = subprocess.check_output([os.path.join(os.path.dirname(__file__), settings.exact_maxsat_solver)] + settings.exact_maxsat_solver_params.split() + [tmp.name]).decode("utf-8").split("\n")
                 args = [settings.exact_maxsat_solver] + settings.exact_maxsat_solver_params.split() + [tmp.name]
-                output = subprocess.check_output(args).decode("utf-8").split("\n")
+                output = exact_solver_output(args, settings)
             except subprocess.CalledProcessError as error:
                 output = error.output.decode("utf-8").split("\n")
         if "UNSATISFIABLE" in output:
@@ -103,6 +121,10 @@ def exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings):
             return None, None
 
 def anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout):
+    settings.deadline.check()
+    # the solver returns its best solution when it is stopped, so stop it at the deadline at the latest
+    timeout = min(timeout, max(settings.deadline.remaining(), MIN_ANYTIME_TIMEOUT))
+    settings.stats.count('anytime maxsat calls')
     if settings.old_format is False:
         with tempfile.NamedTemporaryFile(mode="w", suffix=".wcnf") as tmp:
             new_wcnf_to_file(hard_clauses, soft_clauses, weights, tmp)
@@ -160,23 +182,34 @@ def anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout)
             #   print(line)
             return None, None
 
+def lex_bound(soft_lits, weights, bound, top_id):
+    # clauses that keep the total weight of the falsified soft literals of a group at most bound
+    lits = [-lit for lit in soft_lits]
+    if all(w == 1 for w in weights):
+        return CardEnc.atmost(lits, bound=bound, top_id=top_id, encoding=1).clauses
+    if PBEnc == None:
+        # without pypblib, a literal of weight w is repeated w times
+        lits = [lit for lit, w in zip(lits, weights) for _ in range(w)]
+        return CardEnc.atmost(lits, bound=bound, top_id=top_id, encoding=1).clauses
+    return PBEnc.atmost(lits, weights=weights, bound=bound, top_id=top_id).clauses
+
 # lexicographic optimization with non-unit weights on last group
-def exact_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings):
+def exact_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings, group_weights=None):
+    # group_weights holds the weights of the literals of each group but the last, which default to one
     assert(len(last_weights) == len(soft_lit_groups[-1]))
+    if group_weights == None:
+        group_weights = [[1 for _ in soft_lits] for soft_lits in soft_lit_groups[:-1]]
     if not settings.lex_via_weights:
         top_id = 0
         for soft_lits in soft_lit_groups:
             top_id = max(top_id, max([abs(lit) for lit in soft_lits]))
         for clause in hard_clauses:
             top_id = max(top_id, max([abs(lit) for lit in clause]))
-        i=0
-        for soft_lits in soft_lit_groups[:-1]:
-            i=i+1
-            cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], [1 for _ in soft_lits], settings)
+        for soft_lits, weights in zip(soft_lit_groups[:-1], group_weights):
+            cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], weights, settings)
             if model is None:
                 return cost, model
-            card = CardEnc.atmost([-lit for lit in soft_lits], bound=cost, top_id=top_id, encoding=1)
-            for clause in card.clauses:
+            for clause in lex_bound(soft_lits, weights, cost, top_id):
                 hard_clauses.append(clause)
                 top_id = max(top_id, max([abs(lit) for lit in clause]))
         cost, model = exact_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], last_weights, settings)
@@ -185,27 +218,29 @@ def exact_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings):
         soft_clauses = [[lit] for lit in soft_lit_groups[-1]]
         weights = [weight for weight in last_weights]
         next_weight = sum(last_weights)+1
-        for soft_lits in reversed(soft_lit_groups[:-1]):
+        for soft_lits, group in reversed(list(zip(soft_lit_groups[:-1], group_weights))):
             soft_clauses.extend([[lit] for lit in soft_lits])
-            weights.extend([next_weight for _ in soft_lits])
+            weights.extend([next_weight * w for w in group])
             next_weight = sum(weights)+1
         return exact_maxsat_solve(hard_clauses, soft_clauses, weights, settings)
 
 # lexicographic optimization with non-unit weights on last group
-def anytime_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings, timeout):
+def anytime_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings, timeout, group_weights=None):
+    # group_weights holds the weights of the literals of each group but the last, which default to one
     assert(len(last_weights) == len(soft_lit_groups[-1]))
+    if group_weights == None:
+        group_weights = [[1 for _ in soft_lits] for soft_lits in soft_lit_groups[:-1]]
     if not settings.lex_via_weights:
         top_id = 0
         for soft_lits in soft_lit_groups:
             top_id = max(top_id, max([abs(lit) for lit in soft_lits]))
         for clause in hard_clauses:
             top_id = max(top_id, max([abs(lit) for lit in clause]))
-        for soft_lits in soft_lit_groups[:-1]:
-            cost, model = anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], [1 for _ in soft_lits], settings, timeout)
+        for soft_lits, weights in zip(soft_lit_groups[:-1], group_weights):
+            cost, model = anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lits], weights, settings, timeout)
             if model is None:
                 return cost, model
-            card = CardEnc.atmost([-lit for lit in soft_lits], bound=cost, top_id=top_id, encoding=1)
-            for clause in card.clauses:
+            for clause in lex_bound(soft_lits, weights, cost, top_id):
                 hard_clauses.append(clause)
                 top_id = max(top_id, max([abs(lit) for lit in clause]))
         return anytime_maxsat_solve(hard_clauses, [[lit] for lit in soft_lit_groups[-1]], last_weights, settings, timeout)
@@ -213,8 +248,8 @@ def anytime_lex_solve(hard_clauses, soft_lit_groups, last_weights, settings, tim
         soft_clauses = [[lit] for lit in soft_lit_groups[-1]]
         weights = [weight for weight in last_weights]
         next_weight = sum(last_weights)+1
-        for soft_lits in reversed(soft_lit_groups[:-1]):
+        for soft_lits, group in reversed(list(zip(soft_lit_groups[:-1], group_weights))):
             soft_clauses.extend([[lit] for lit in soft_lits])
-            weights.extend([next_weight for _ in soft_lits])
+            weights.extend([next_weight * w for w in group])
             next_weight = sum(weights)+1
-        return anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings)
\ No newline at end of file
+        return anytime_maxsat_solve(hard_clauses, soft_clauses, weights, settings, timeout)
\ No newline at end of file
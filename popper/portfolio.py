@@ -0,0 +1,152 @@
+import os
+import sys
+import queue
+import shlex
+import argparse
+import multiprocessing
+from time import perf_counter
+from . util import Settings, TIMEOUT, mdl_score, print_prog_score
+from . bus import Relay, ConstraintBus
+
+# tried in this order, one per worker
+CONFIGS = ['', '--order-space', '--datalog', '--max-body 4', '--max-vars 4', '--solver clingo']
+# options that restrict the search space, so a worker with them does not prove that its solution is optimal for the task
+RESTRICTING_OPTIONS = ['--datalog', '--max-body', '--max-vars', '--max-rules', '--max-literals', '--no-bias']
+NO_BOUND = 2**31-1
+POLL_TIME = 1
+# extra time given to the workers beyond the learning timeout before they are killed
+GRACE_TIME = 30
+
+class SharedBound:
+    # the score of the best solution found by any worker: its size without noise and its MDL score with noise
+    # each worker uses it to tighten settings.max_literals, as only smaller programs can improve on it
+    def __init__(self, ctx):
+        self.best = ctx.Value('i', NO_BOUND)
+
+    def update(self, settings, score):
+        tp, fn, tn, fp, size = score
+        if settings.noisy:
+            value = mdl_score(fn, fp, size)
+        elif fn == 0 and fp == 0:
+            value = size
+        else:
+            return
+        with self.best.get_lock():
+            if value < self.best.value:
+                self.best.value = value
+
+    def tighten(self, settings):
+        best = self.best.value
+        if best - 1 < settings.max_literals:
+            settings.max_literals = best - 1
+            return True
+        return False
+
+def score_key(score, noisy):
+    tp, fn, tn, fp, size = score
+    if noisy:
+        return mdl_score(fn, fp, size), 0
+    return fn + fp, size
+
+def restricts_space(config):
+    return any(x.split('=')[0] in RESTRICTING_OPTIONS for x in shlex.split(config))
+
+def run_worker(index, argv, complete, bound, done, results, bus):
+    # import here so that the parent process never loads pyswip
+    from . loop import learn_solution
+    settings = Settings(cmd_line=True, argv=argv)
+    settings.shared_bound = bound
+    # the ground constraints of one configuration also hold for the others
+    settings.constraint_bus = ConstraintBus(index, *bus)
+    def on_solution(prog, score):
+        bound.update(settings, score)
+        results.put((index, prog, score, False))
+    settings.on_solution = on_solution
+    prog, score, _stats = learn_solution(settings)
+    results.put((index, prog, score, True))
+    # a worker that searched its whole space has the optimal solution for its configuration
+    # which is only optimal for the task if its configuration does not restrict the space of the others
+    if complete and prog != None and not settings.timed_out:
+        done.set()
+
+def run_portfolio(kbpath, configs, timeout, noisy):
+    ctx = multiprocessing.get_context('spawn')
+    bound = SharedBound(ctx)
+    done = ctx.Event()
+    results = ctx.Queue()
+    bus = Relay(ctx, len(configs))
+    bus.start()
+
+    common = ['--quiet', '--timeout', str(timeout)]
+    if noisy:
+        common.append('--noisy')
+
+    workers = []
+    for index, config in enumerate(configs):
+        argv = [kbpath] + common + shlex.split(config)
+        endpoints = bus.outbox, bus.inboxes[index]
+        complete = not restricts_space(config)
+        worker = ctx.Process(target=run_worker, args=(index, argv, complete, bound, done, results, endpoints), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    best = {}
+    finished = set()
+
+    def receive(wait):
+        index, prog, score, final = results.get(timeout=wait)
+        if prog != None:
+            best[index] = prog, score
+        if final:
+            finished.add(index)
+            bus.finished.add(index)
+
+    deadline = perf_counter() + timeout + GRACE_TIME
+    while len(finished) < len(workers) and not done.is_set() and perf_counter() < deadline:
+        try:
+            receive(POLL_TIME)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+
+    # collect the solutions sent before the workers stopped
+    try:
+        while True:
+            receive(0.1)
+    except queue.Empty:
+        pass
+
+    for worker in workers:
+        if worker.is_alive():
+            worker.terminate()
+        worker.join()
+    bus.stop()
+
+    if not best:
+        return None, None, None
+    index = min(best, key=lambda i: score_key(best[i][1], noisy))
+    prog, score = best[index]
+    return prog, score, configs[index]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several Popper configurations in parallel and keep the best solution')
+    parser.add_argument('kbpath', help='Path to files to learn from')
+    parser.add_argument('--config', action='append', default=None, help='Popper options for a worker, such as "--order-space --max-vars 4". Repeat for each worker (default: the first --workers of a built-in portfolio)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of workers when --config is not given (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Timeout of each worker in seconds (default: {TIMEOUT})')
+    parser.add_argument('--noisy', default=False, action='store_true', help='tell Popper that there is noise')
+    args = parser.parse_args()
+
+    configs = args.config
+    if not configs:
+        configs = CONFIGS[:max(1, args.workers)]
+
+    prog, score, config = run_portfolio(args.kbpath, configs, args.timeout, args.noisy)
+    if prog == None:
+        print('NO SOLUTION')
+        sys.exit(1)
+    print(f'Best configuration: {config or "default"}')
+    print_prog_score(prog, score, args.noisy)
+
+if __name__ == '__main__':
+    main()
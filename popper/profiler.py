@@ -0,0 +1,92 @@
+import os
+import sys
+import signal
+from time import process_time
+from collections import Counter
+
+# CPU seconds between samples
+INTERVAL = 0.005
+TOP = 20
+
+# the leaf Python frame decides where a sample goes, as calls into clingo and SWI-Prolog go through these packages
+LIBRARIES = {'clingo': 'clingo', 'pyswip': 'pyswip/prolog', 'pysat': 'pysat'}
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def frame_category(frame):
+    parts = frame.f_code.co_filename.replace('\\', '/').split('/')
+    for name, category in LIBRARIES.items():
+        if name in parts:
+            return category
+    return 'python'
+
+class Profiler:
+    # samples the stack of the main thread on SIGPROF
+    # a signal that arrives during a C call (a clingo solve or a Prolog query) is only handled when the call returns,
+    # so each sample is weighted by the CPU time since the previous one rather than counted once
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.last = None
+
+    def start(self):
+        self.last = process_time()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        now = process_time()
+        weight = now - self.last
+        self.last = now
+        if frame == None:
+            return
+        self.categories[frame_category(frame)] += weight
+        stack = []
+        while frame != None:
+            stack.append(frame_label(frame))
+            frame = frame.f_back
+        self.stacks[tuple(reversed(stack))] += weight
+
+    def write_collapsed(self, path):
+        # one line per stack, root first, with its weight in microseconds, as read by flamegraph.pl and speedscope
+        with open(path, 'w') as f:
+            for stack, weight in self.stacks.most_common():
+                f.write(f'{";".join(stack)} {int(weight * 1e6)}\n')
+
+    def summary(self, top=TOP):
+        total = sum(self.stacks.values())
+        if total == 0:
+            return 'Profile: no samples'
+        self_time = Counter()
+        cumulative = Counter()
+        for stack, weight in self.stacks.items():
+            self_time[stack[-1]] += weight
+            # count recursive functions once per stack
+            for label in set(stack):
+                cumulative[label] += weight
+
+        message = f'Profile: {total:0.2f}s CPU\n'
+        for category, weight in self.categories.most_common():
+            message += f'\t{category}: {weight:0.2f}s ({int(weight/total*100)}%)\n'
+        message += f'Top {top} functions by self time:\n'
+        for label, weight in self_time.most_common(top):
+            message += f'\t{weight:8.2f}s {int(weight/total*100):3}%  {label}\n'
+        message += f'Top {top} functions by cumulative time:\n'
+        for label, weight in cumulative.most_common(top):
+            message += f'\t{weight:8.2f}s {int(weight/total*100):3}%  {label}\n'
+        return message.rstrip()
+
+def start_profiler(settings):
+    if not hasattr(signal, 'setitimer'):
+        settings.logger.warn('--profile needs signal.setitimer, which is not available on this platform')
+        return None
+    profiler = Profiler()
+    profiler.start()
+    return profiler
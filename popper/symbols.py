@@ -0,0 +1,99 @@
+import numbers
+import clingo
+from clingo import Function, Number, Tuple_
+from . util import MAX_CACHE_SIZE
+
+arg_lookup = {clingo.Number(i):chr(ord('A') + i) for i in range(100)}
+
+def arg_to_symbol(arg):
+    if isinstance(arg, tuple):
+        return Tuple_(tuple(arg_to_symbol(a) for a in arg))
+    if isinstance(arg, numbers.Number):
+        return Number(arg)
+    if isinstance(arg, str):
+        return Function(arg)
+    assert False, f'Unhandled argtype({type(arg)}) in aspsolver.py arg_to_symbol()'
+
+def atom_to_symbol(pred, args):
+    xs = tuple(arg_to_symbol(arg) for arg in args)
+    return Function(name = pred, arguments = xs)
+
+class SymbolTable:
+    # interns the ground atoms (pred, args) of a solver as clingo symbols, atoms of its backend, and solver literals
+    # the keys are the atoms themselves rather than their hash(), which can collide
+    # like the other caches, it drops the oldest entry when full, which is safe as clingo returns the same
+    # atom for the same symbol
+    def __init__(self, stats, maxsize=MAX_CACHE_SIZE):
+        self.stats = stats
+        self.maxsize = maxsize
+        self.symbols = {}
+        self.backend_atoms = {}
+        self.literals = {}
+        self.hits = 0
+        self.misses = 0
+
+    def symbol(self, pred, args):
+        k = pred, args
+        symbol = self.symbols.get(k)
+        # not ==, which calls Symbol.__eq__
+        if symbol is None:
+            self.misses += 1
+            symbol = atom_to_symbol(pred, args)
+            if len(self.symbols) >= self.maxsize:
+                del self.symbols[next(iter(self.symbols))]
+            self.symbols[k] = symbol
+        else:
+            self.hits += 1
+        return symbol
+
+    def backend_atom(self, backend, pred, args):
+        k = pred, args
+        atom = self.backend_atoms.get(k)
+        if atom is None:
+            atom = backend.add_atom(self.symbol(pred, args))
+            if len(self.backend_atoms) >= self.maxsize:
+                del self.backend_atoms[next(iter(self.backend_atoms))]
+            self.backend_atoms[k] = atom
+        else:
+            self.hits += 1
+        return atom
+
+    def literal(self, symbolic_atoms, pred, args):
+        k = pred, args
+        literal = self.literals.get(k)
+        if literal is None:
+            atom = symbolic_atoms[self.symbol(pred, args)]
+            if atom is None:
+                # the atom is not in the program, which the caller treats as false
+                # do not keep it, as a later step can add it
+                return None
+            literal = atom.literal
+            if len(self.literals) >= self.maxsize:
+                del self.literals[next(iter(self.literals))]
+            self.literals[k] = literal
+        else:
+            self.hits += 1
+        return literal
+
+    def nogood(self, symbolic_atoms, ground_body):
+        # a nogood of solver literals, which add_nogood takes without looking up each symbol again
+        # like add_nogood with symbols, an atom that is not in the program is false
+        # so a nogood with such a positive literal never applies (None) and such a negative literal always holds
+        nogood = []
+        for sign, pred, args in ground_body:
+            literal = self.literal(symbolic_atoms, pred, args)
+            if literal is None:
+                if sign:
+                    return None
+                continue
+            nogood.append(literal if sign else -literal)
+        return nogood
+
+    def update_stats(self):
+        # counted here rather than in stats on every lookup, which is in the inner loop of constrain
+        if self.hits:
+            self.stats.count('symbol cache hits', self.hits)
+        if self.misses:
+            self.stats.count('symbol cache misses', self.misses)
+        self.hits = 0
+        self.misses = 0
@@ -5,15 +5,28 @@ import pkg_resources
 from pyswip import Prolog
 from pyswip.prolog import PrologError
 from contextlib import contextmanager
-from . util import format_rule, order_rule, order_prog, prog_is_recursive, format_prog, format_literal, rule_is_recursive, rule_size, calc_prog_size
+from . util import MIN_EVAL_INFERENCES, EVAL_INFERENCE_FACTOR, format_rule, order_rule, order_prog, prog_is_recursive, format_prog, format_literal, rule_is_recursive, rule_size, calc_prog_size, num_examples
 
 import clingo
 import clingo.script
 import pkg_resources
 from . core import Literal
 from . explain import prog_hash, get_raw_prog
+from . cache import file_hash, cache_path
 from collections import defaultdict
 
+class StatsProlog:
+    # counts the queries made to Prolog, everything else (assertz, consult, ...) goes straight to pyswip
+    def __init__(self, stats):
+        self.stats = stats
+
+    def query(self, *args, **kwargs):
+        self.stats.count('prolog queries')
+        return Prolog.query(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(Prolog, name)
+
 class Tester():
 
     def query(self, query, key):
@@ -25,25 +38,29 @@ class Tester():
 
     def __init__(self, settings):
         self.settings = settings
-        self.prolog = Prolog()
+        self.prolog = StatsProlog(settings.stats)
 
         bk_pl_path = self.settings.bk_file
         exs_pl_path = self.settings.ex_file
         test_pl_path = pkg_resources.resource_filename(__name__, "lp/test.pl")
 
         # with self.settings.stats.duration('load data'):
-        for x in [exs_pl_path, bk_pl_path, test_pl_path]:
-            if os.name == 'nt': # if on Windows, SWI requires escaped directory separators
-                x = x.replace('\\', '\\\\')
-            self.prolog.consult(x)
+        for x in [exs_pl_path, bk_pl_path]:
+            if self.settings.cache_dir and self.load_qlf(x):
+                continue
+            self.consult(x)
+        self.consult(test_pl_path)
 
         # load examples
         self.bool_query(f'load_examples')
         self.pos_index = self.query('findall(K,pos_index(K,Atom),Xs)', 'Xs')
         self.neg_index = self.query('findall(K,neg_index(K,Atom),Xs)', 'Xs')
 
-        self.num_pos = len(self.pos_index)
-        self.num_neg = len(self.neg_index)
+        # an index stands for weight identical examples, see example_classes in test.pl
+        self.example_weights = {k: w for k, w in next(self.prolog.query('findall([K,W],ex_weight(K,W),Xs)'))['Xs']}
+
+        self.num_pos = num_examples(self.pos_index, self.example_weights)
+        self.num_neg = num_examples(self.neg_index, self.example_weights)
 
 
         # self.cached_covers_any = {}
@@ -55,13 +72,82 @@ class Tester():
         self.cached_neg_covers = {}
         self.savings = 0
 
+        # the programs that stay asserted under fresh names, see using
+        # maps the text of a program to its slot and the fresh name and arity of each of its head predicates, oldest first
+        # a program takes the slot of the program that it evicts, so there are at most settings.resident_programs sets of names
+        self.resident_progs = {}
+        # the head predicates that currently call a resident program, mapped to its fresh name
+        self.dispatched = {}
+
         # weird
         self.settings.pos_index = self.pos_index
         self.settings.neg_index = self.neg_index
+        self.settings.example_weights = self.example_weights
 
-        if self.settings.recursion_enabled:
-            self.prolog.assertz(f'timeout({self.settings.eval_timeout})')
+        self.settings.tester = self
 
+        if self.settings.recursion_enabled:
+            if self.settings.eval_inferences:
+                min_inferences = min(MIN_EVAL_INFERENCES, self.settings.eval_inferences)
+                self.prolog.assertz(f'inference_limit({min_inferences},{self.settings.eval_inferences},{EVAL_INFERENCE_FACTOR})')
+            else:
+                self.prolog.assertz(f'timeout({self.settings.eval_timeout})')
+
+    def update_stats(self):
+        # reads the costs of the examples evaluated with an inference limit, see test_ex in test.pl
+        if not self.settings.recursion_enabled or not self.settings.eval_inferences:
+            return
+        stats = self.settings.stats
+        x = next(self.prolog.query('flag(ex_calls,C,C),flag(ex_inferences,T,T),flag(ex_max_inferences,M,M)'))
+        calls, inferences, max_inferences = x['C'], x['T'], x['M']
+        max_example = None
+        for x in self.prolog.query('nb_current(ex_max_atom,Atom),(pos_index(ID,Atom);neg_index(ID,Atom))'):
+            max_example = x['ID']
+        exceeded = {}
+        for x in self.prolog.query('ex_exceeded(Atom,N),(pos_index(ID,Atom);neg_index(ID,Atom))'):
+            exceeded[x['ID']] = x['N']
+        stats.counters['example evaluations'] = calls
+        stats.counters['example inferences'] = inferences
+        stats.counters['inference limit exceeded'] = sum(exceeded.values())
+        stats.example_costs = {
+            'mean inferences': inferences / calls if calls else 0,
+            'max inferences': max_inferences,
+            'max example': max_example,
+            'exceeded': exceeded}
+
+
+    def consult(self, path):
+        if os.name == 'nt': # if on Windows, SWI requires escaped directory separators
+            path = path.replace('\\', '\\\\')
+        self.prolog.consult(path)
+
+    def load_qlf(self, path):
+        # the quick-load file is keyed by the file contents and the SWI version, so it can be shared by every tester (and worker process) that loads the same data
+        version = next(self.prolog.query('current_prolog_flag(version,V)'))['V']
+        key = file_hash(path, extra=str(version))
+        qlf_path = cache_path(self.settings, f'{key}.qlf')
+        try:
+            if os.path.exists(qlf_path):
+                self.consult(qlf_path)
+                return True
+            # compile a private stub that includes the original file, so that relative paths in it still resolve, and then move the quick-load file into place so that concurrent workers never load a partial file
+            tmp_path = cache_path(self.settings, f'{key}.{os.getpid()}.pl')
+            src = os.path.abspath(path)
+            if os.name == 'nt':
+                src = src.replace('\\', '\\\\')
+            src = src.replace("'", "\\'")
+            with open(tmp_path, 'w') as f:
+                f.write(f":- include('{src}').\n")
+            try:
+                x = tmp_path.replace('\\', '\\\\') if os.name == 'nt' else tmp_path
+                list(self.prolog.query(f"qcompile('{x}')"))
+                os.replace(tmp_path[:-3] + '.qlf', qlf_path)
+            finally:
+                os.remove(tmp_path)
+            return True
+        except (PrologError, OSError) as err:
+            self.settings.logger.warn(f'Failed to use quick-load file for {path}: {err}')
+            return False
 
     def tmp(self):
         len(list(self.prolog.query("true"))) > 0
@@ -97,6 +183,51 @@ class Tester():
             neg_covered = set()
         return pos_covered, neg_covered
 
+    def count_covered(self, prog, pos_budget, neg_budget, pos_ids=False, neg_ids=False):
+        # counts, with their weights, the positive and then the negative examples that the program covers in one query
+        # each count stops once it reaches its budget, which is None to count every example and 0 to not count them
+        # with pos_ids (neg_ids), it also returns the positive (negative) examples that it counted and otherwise None
+        if len(prog) == 1:
+            rule = list(prog)[0]
+            head, ordered_body = order_rule(rule, self.settings)
+            atom_str = format_literal(head)
+            body_str = format_rule((None,ordered_body))[2:-1]
+            goals = f'pos_index(ID1,{atom_str})', f'neg_index(ID2,{atom_str})'
+            bodies = f'({body_str})', f'({body_str})'
+        else:
+            goals = 'pos_index(ID1,Atom1)', 'neg_index(ID2,Atom2)'
+            bodies = 'test_ex(Atom1)', 'test_ex(Atom2)'
+        budgets = pos_budget, neg_budget
+        totals = self.num_pos, self.num_neg
+        with_ids = pos_ids, neg_ids
+        query = []
+        for var, goal, body, budget, total, ids, count, covered in zip(['ID1', 'ID2'], goals, bodies, budgets, totals, with_ids, ['PosCount', 'NegCount'], ['Xs', 'Ys']):
+            if budget == 0:
+                continue
+            if budget == None or budget > total:
+                budget = total + 1
+            if ids:
+                query.append(f'count_examples({var},{goal},{body},{budget},{count},{covered})')
+            else:
+                query.append(f'count_examples({var},{goal},{body},{budget},{count})')
+
+        result = {}
+        if query:
+            try:
+                if len(prog) == 1:
+                    result = next(self.prolog.query(','.join(query)))
+                else:
+                    with self.using(prog):
+                        result = next(self.prolog.query(','.join(query)))
+            except PrologError as err:
+                print('PROLOG ERROR',err)
+        pos_covered, neg_covered = None, None
+        if pos_ids:
+            pos_covered = frozenset(result.get('Xs', []))
+        if neg_ids:
+            neg_covered = frozenset(result.get('Ys', []))
+        return result.get('PosCount', 0), result.get('NegCount', 0), pos_covered, neg_covered
+
     def test_prog_pos(self, prog):
         if len(prog) == 1:
             return self.test_single_rule_pos(prog)
@@ -108,6 +239,62 @@ class Tester():
             pos_covered = set()
         return pos_covered
 
+    def test_prog_pos_at_most(self, prog, k):
+        # the first k positive examples that the program covers, which are all of them if there are fewer than k
+        try:
+            if len(prog) == 1:
+                rule = list(prog)[0]
+                head, ordered_body = order_rule(rule, self.settings)
+                atom_str = format_literal(head)
+                body_str = format_rule((None,ordered_body))[2:-1]
+                q = f'findfirstn({k}, ID, (pos_index(ID,{atom_str}),({body_str}->  true)), Xs)'
+                return frozenset(next(self.prolog.query(q))['Xs'])
+            with self.using(prog):
+                return frozenset(self.query(f'pos_covered_at_most({k},Xs)', 'Xs'))
+        except PrologError as err:
+            print('PROLOG ERROR',err)
+            return frozenset()
+
+    def test_prog_pos_from(self, prog, found):
+        # every positive example that the program covers, given the first ones that it covers from test_prog_pos_at_most
+        # the examples are tested in order, so we only test the ones after the last one found
+        if not found:
+            return self.test_prog_pos(prog)
+        last = max(found)
+        try:
+            if len(prog) == 1:
+                rule = list(prog)[0]
+                head, ordered_body = order_rule(rule, self.settings)
+                atom_str = format_literal(head)
+                body_str = format_rule((None,ordered_body))[2:-1]
+                q = f'findall(ID, (pos_index(ID,{atom_str}),ID > {last},({body_str}->  true)), Xs)'
+                xs = next(self.prolog.query(q))['Xs']
+            else:
+                with self.using(prog):
+                    xs = self.query(f'pos_covered_from({last},Xs)', 'Xs')
+        except PrologError as err:
+            print('PROLOG ERROR',err)
+            xs = []
+        return found | frozenset(xs)
+
+    def covers_pos_outside(self, prog, xs):
+        # whether the program covers a positive example that is not in xs, which stops at the first one
+        outside = [i for i in self.pos_index if i not in xs]
+        if len(outside) == 0:
+            return False
+        try:
+            if len(prog) == 1:
+                rule = list(prog)[0]
+                head, ordered_body = order_rule(rule, self.settings)
+                atom_str = format_literal(head)
+                body_str = format_rule((None,ordered_body))[2:-1]
+                return self.bool_query(f'member(ID,{outside}),pos_index(ID,{atom_str}),{body_str},!')
+            with self.using(prog):
+                return self.bool_query(f'covers_any_pos({outside})')
+        except PrologError as err:
+            print('PROLOG ERROR',err)
+            return True
+
     # @profile
     def test_prog_inconsistent(self, prog):
         if len(prog) == 1:
@@ -307,6 +494,15 @@ class Tester():
         return pos_covered
 
 
+    def get_pos_covered_from(self, prog, found):
+        # as get_pos_covered, but resumes from the first examples that the program covers
+        k = prog_hash(prog)
+        if k in self.cached_pos_covered:
+            return self.cached_pos_covered[k]
+        pos_covered = self.test_prog_pos_from(prog, found)
+        self.cached_pos_covered[k] = pos_covered
+        return pos_covered
+
     # def get_pos_covered2(self, prog):
     #     if len(prog) == 1:
     #         rule = list(prog)[0]
@@ -508,8 +704,63 @@ class Tester():
     #     inconsistent = len(list(self.prolog.query(q))) > 0
 
 
+    def resident_names(self, prog):
+        # asserts a program with its head predicates renamed to fresh names, unless it is already asserted
+        # the program stays asserted until it is the least recently used of more than settings.resident_programs programs
+        if self.settings.recursion_enabled:
+            prog = order_prog(prog)
+        rules = [order_rule(rule, self.settings) for rule in prog]
+        k = tuple(format_rule(rule) for rule in rules)
+        x = self.resident_progs.pop(k, None)
+        if x != None:
+            self.settings.stats.count('resident program hits')
+            self.resident_progs[k] = x
+            return x[1]
+
+        self.settings.stats.count('resident program misses')
+        if len(self.resident_progs) >= self.settings.resident_programs:
+            slot, old_names = self.resident_progs.pop(next(iter(self.resident_progs)))
+            for name, arity in old_names.values():
+                args = ','.join(['_'] * arity)
+                self.prolog.retractall(f'{name}({args})')
+        else:
+            slot = len(self.resident_progs) + 1
+        names = {}
+        for head, _body in rules:
+            names[head.predicate] = f'{head.predicate}_slot{slot}', head.arity
+        def rename(literal):
+            if literal.predicate not in names:
+                return literal
+            return Literal(names[literal.predicate][0], literal.arguments)
+        for head, body in rules:
+            x = format_rule((rename(head), tuple(rename(literal) for literal in body)))[:-1]
+            self.prolog.assertz(x)
+        self.resident_progs[k] = slot, names
+        return names
+
     @contextmanager
     def using(self, prog):
+        if self.settings.resident_programs:
+            # only a clause that calls the resident program is asserted and retracted for each test
+            # a nested use of the same program, as in reduce_inconsistent, reuses the clauses of the outer one
+            names = self.resident_names(prog)
+            current = {}
+            try:
+                for predicate, (name, arity) in names.items():
+                    if self.dispatched.get(predicate) == name:
+                        continue
+                    args = ','.join(chr(ord('A') + i) for i in range(arity))
+                    self.prolog.assertz(f'{predicate}({args}):- {name}({args})')
+                    self.dispatched[predicate] = name
+                    current[predicate] = arity
+                yield
+            finally:
+                for predicate, arity in current.items():
+                    args = ','.join(['_'] * arity)
+                    self.prolog.retractall(f'{predicate}({args})')
+                    del self.dispatched[predicate]
+            return
+
         if self.settings.recursion_enabled:
             prog = order_prog(prog)
         current_clauses = set()
@@ -549,7 +800,7 @@ class Tester():
             if noise:
                 new_head = f'pos_index(ID,{format_literal(head)})'
                 x = format_rule((None,ordered_body))[2:-1]
-                x = f'succeeds_k_times({new_head},({x}),{rule_size(rule)}),!'
+                x = f'succeeds_k_times(ID,{new_head},({x}),{rule_size(rule)}),!'
                 return self.bool_query(x)
             else:
                 head = f'pos_index(_,{format_literal(head)})'
@@ -0,0 +1,112 @@
+import sys
+import json
+import argparse
+from time import perf_counter
+from collections import defaultdict
+from . util import format_prog
+
+PHASES = ['generate', 'test', 'constrain', 'combine']
+TOP = 10
+
+def last_duration(stats, operation):
+    if operation not in stats.durations:
+        return None
+    return stats.durations[operation].last
+
+class Tracer:
+    # writes one JSON line per event, such as each program generated by popper()
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.start = perf_counter()
+
+    def event(self, kind, **fields):
+        fields['event'] = kind
+        fields['time'] = perf_counter() - self.start
+        self.file.write(json.dumps(fields) + '\n')
+
+    def program(self, stats, prog, prog_size, num_pos_covered, num_neg_covered, inconsistent, cons, combine_time, constrained=True):
+        constrain_time = None
+        if constrained:
+            constrain_time = last_duration(stats, 'constrain')
+        self.event('program',
+            n = stats.total_programs,
+            prog = format_prog(prog),
+            size = prog_size,
+            pos = num_pos_covered,
+            neg = num_neg_covered,
+            inconsistent = inconsistent,
+            cons = [con[0].name for con in cons],
+            generate = last_duration(stats, 'generate'),
+            test = last_duration(stats, 'test'),
+            constrain = constrain_time,
+            combine = combine_time)
+
+    def close(self):
+        self.file.close()
+
+def load_events(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+def print_table(header, rows):
+    print(f'{header[0]:<24}' + ''.join(f'{x:>12}' for x in header[1:]))
+    for row in rows:
+        print(f'{row[0]:<24}' + ''.join(f'{x:>12.3f}' if isinstance(x, float) else f'{x:>12}' for x in row[1:]))
+
+def summarise(path, top):
+    by_size = defaultdict(lambda: defaultdict(float))
+    by_con = defaultdict(lambda: defaultdict(float))
+    programs = []
+    for event in load_events(path):
+        if event['event'] != 'program':
+            continue
+        programs.append(event)
+        times = {phase: event[phase] or 0.0 for phase in PHASES}
+        xs = by_size[event['size']]
+        xs['programs'] += 1
+        xs['combines'] += event['combine'] != None
+        for phase, t in times.items():
+            xs[phase] += t
+        for con in set(event['cons']):
+            xs = by_con[con]
+            xs['programs'] += 1
+            xs['test'] += times['test']
+            xs['constrain'] += times['constrain']
+        for con in event['cons']:
+            by_con[con]['constraints'] += 1
+
+    if not programs:
+        print('no programs in trace')
+        return
+
+    print(f'{len(programs)} programs')
+    print()
+    rows = []
+    for size, xs in sorted(by_size.items()):
+        total = sum(xs[phase] for phase in PHASES)
+        rows.append([size, int(xs['programs']), int(xs['combines'])] + [xs[phase] for phase in PHASES] + [total])
+    print_table(['size', 'programs', 'combines'] + PHASES + ['total'], rows)
+
+    # a program can add several types of constraints, so the times of the types overlap
+    print()
+    rows = []
+    for con, xs in sorted(by_con.items(), key=lambda x: x[1]['constrain'], reverse=True):
+        rows.append([con.lower(), int(xs['constraints']), int(xs['programs']), xs['test'], xs['constrain']])
+    print_table(['constraint', 'constraints', 'programs', 'test', 'constrain'], rows)
+
+    print()
+    print(f'slowest {top} programs to test:')
+    for event in sorted(programs, key=lambda x: x['test'], reverse=True)[:top]:
+        prog = event['prog'].replace('\n', ' ')
+        print(f'{event["test"]:>10.3f}s  size:{event["size"]} pos:{event["pos"]} neg:{event["neg"]}  {prog}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarise a Popper trace written with --trace')
+    parser.add_argument('trace', help='Trace file')
+    parser.add_argument('--top', type=int, default=TOP, help=f'Number of slowest programs to show (default: {TOP})')
+    args = parser.parse_args()
+    summarise(args.trace, args.top)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 from enum import Enum
 import clingo
 import clingo.script
-import signal
 import argparse
 import os
+import json
+import math
 import logging
-from itertools import permutations
 from collections import defaultdict
 from time import perf_counter
 from contextlib import contextmanager
@@ -16,6 +16,9 @@ clingo.script.enable_python()
 
 TIMEOUT=600
 EVAL_TIMEOUT=0.001
+# the inference limit of an example is this many times the largest cost of an example so far, and at least MIN_EVAL_INFERENCES
+EVAL_INFERENCE_FACTOR=10
+MIN_EVAL_INFERENCES=10000
 MAX_LITERALS=40
 MAX_SOLUTIONS=1
 CLINGO_ARGS=''
@@ -25,6 +28,9 @@ MAX_BODY=6
 MAX_EXAMPLES=10000
 BATCH_SIZE=20000
 ANYTIME_TIMEOUT=10
+BKCONS_WORKERS=1
+CHECKPOINT_INTERVAL=60
+MAX_CACHE_SIZE=100000
 
 
 # class syntax
@@ -38,19 +44,27 @@ class Constraint(Enum):
     BANISH = 7
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Popper is an ILP system based on learning from failures')
 
     parser.add_argument('kbpath', help='Path to files to learn from')
     parser.add_argument('--noisy', default=False, action='store_true', help='tell Popper that there is noise')
     parser.add_argument('--bkcons', default=False, action='store_true', help='deduce background constraints from Datalog background (EXPERIMENTAL!)')
+    parser.add_argument('--bkcons-backend', default=False, action='store_true', help='add the deduced background constraints to the generator through the clingo backend as ground facts rather than as text')
+    parser.add_argument('--bkcons-workers', type=int, default=BKCONS_WORKERS, help=f'Number of processes used to deduce background constraints (default: {BKCONS_WORKERS})')
     parser.add_argument('--timeout', type=float, default=TIMEOUT, help=f'Overall timeout in seconds (default: {TIMEOUT})')
     parser.add_argument('--max-literals', type=int, default=MAX_LITERALS, help=f'Maximum number of literals allowed in program (default: {MAX_LITERALS})')
     parser.add_argument('--max-body', type=int, default=MAX_BODY, help=f'Maximum number of body literals allowed in rule (default: {MAX_BODY})')
     parser.add_argument('--max-vars', type=int, default=MAX_VARS, help=f'Maximum number of variables allowed in rule (default: {MAX_VARS})')
     parser.add_argument('--max-rules', type=int, default=MAX_RULES, help=f'Maximum number of rules allowed in a recursive program (default: {MAX_RULES})')
     parser.add_argument('--eval-timeout', type=float, default=EVAL_TIMEOUT, help=f'Prolog evaluation timeout in seconds (default: {EVAL_TIMEOUT})')
+    parser.add_argument('--eval-inferences', type=int, default=None, help='Bound the evaluation of each example by Prolog inferences rather than by --eval-timeout, with a limit learned from the costs of the examples so far and at most this many inferences (default: use --eval-timeout)')
+    parser.add_argument('--resident-programs', type=int, default=0, help='Keep up to this many tested multi-rule programs asserted under fresh predicate names, so that testing a program again reuses its compiled clauses (default: 0, assert and retract each program)')
     parser.add_argument('--stats', default=False, action='store_true', help='Print statistics at end of execution')
+    parser.add_argument('--stats-json', default=None, help='Write statistics as JSON lines to this file at the end of execution')
+    parser.add_argument('--trace', default=None, help='Write an event for each generated program as JSON lines to this file, summarise it with: python -m popper.trace FILE')
+    parser.add_argument('--profile', default=None, help='Profile Popper by sampling the stack, write the collapsed stacks to this file and print a summary')
+    parser.add_argument('--stats-interval', type=float, default=0, help='Also write statistics to --stats-json every this many seconds (default: only at the end)')
     parser.add_argument('--quiet', '-q', default=False, action='store_true', help='Hide information during learning')
     parser.add_argument('--debug', default=False, action='store_true', help='Print debugging information to stderr')
     parser.add_argument('--showcons', default=False, action='store_true', help='Show constraints deduced during the search')
@@ -58,39 +72,61 @@ def parse_args():
     parser.add_argument('--anytime-solver', default=None, choices=['wmaxcdcl', 'nuwls'], help='Select an anytime MaxSAT solver (default: None)')
     parser.add_argument('--anytime-timeout', type=int, default=ANYTIME_TIMEOUT, help=f'Maximum timeout (seconds) for each anytime MaxSAT call (default: {ANYTIME_TIMEOUT})')
     parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help=f'Combine batch size (default: {BATCH_SIZE})')
+    parser.add_argument('--incremental-combine', default=False, action='store_true', help='With --solver clingo, group the programs by the examples they cover and ground only the new programs in each combine call')
     parser.add_argument('--functional-test', default=False, action='store_true', help='Run functional test')
     parser.add_argument('--datalog', default=False, action='store_true', help='EXPERIMENTAL FEATURE: use recall to order literals in rules')
     parser.add_argument('--no-bias', default=False, action='store_true', help='EXPERIMENTAL FEATURE: do not use language bias')
     parser.add_argument('--order-space', default=False, action='store_true', help='EXPERIMENTAL FEATURE: search space ordered by size')
-
-
-    return parser.parse_args()
+    parser.add_argument('--cache-dir', default=None, help='Directory to cache compiled background knowledge and examples (default: no caching)')
+    parser.add_argument('--checkpoint', default=None, help='Periodically save the search state to this file')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL, help=f'Seconds between checkpoints (default: {CHECKPOINT_INTERVAL})')
+    parser.add_argument('--resume', default=False, action='store_true', help='Resume the search from the file given by --checkpoint')
+
+
+    return parser.parse_args(argv)
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    # the time when learning must stop
+    # the search loop, the combiners, and the solvers check it, so a learner stops at a safe point without
+    # a signal, which only works in the main thread, and several learners can run in one process
+    def __init__(self, seconds):
+        self.end = perf_counter() + seconds
+
+    def remaining(self):
+        return max(0, self.end - perf_counter())
+
+    def expired(self):
+        return perf_counter() >= self.end
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded()
+
+def next_model(handle, deadline):
+    # the next model of a clingo solve started with yield_ and async_, or None when there are no more
+    # waits in the background so that a long solve stops at the deadline
+    if not deadline.expired():
+        handle.resume()
+        # the wait can end early without a model, so only stop once the deadline has passed
+        while not handle.wait(deadline.remaining()):
+            if deadline.expired():
+                break
+        else:
+            return handle.model()
+    handle.cancel()
+    raise DeadlineExceeded()
 
 def timeout(settings, func, args=(), kwargs={}, timeout_duration=1):
-    result = None
-    class TimeoutError(Exception):
-        pass
-
-    def handler(signum, frame):
-        raise TimeoutError()
-
-    # set the timeout handler
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(timeout_duration)
+    settings.deadline = Deadline(timeout_duration)
     try:
-        result = func(*args, **kwargs)
-    except TimeoutError as _exc:
+        return func(*args, **kwargs)
+    except DeadlineExceeded:
         settings.logger.warn(f'TIMEOUT OF {int(settings.timeout)} SECONDS EXCEEDED')
-        return result
-    except AttributeError as moo:
-        if '_SolveEventHandler' in str(moo):
-            settings.logger.warn(f'TIMEOUT OF {int(settings.timeout)} SECONDS EXCEEDED')
-            return result
-        raise moo
-    finally:
-        signal.alarm(0)
-
-    return result
+        settings.timed_out = True
+        return None
 
 def load_kbpath(kbpath):
     def fix_path(filename):
@@ -98,17 +134,67 @@ def load_kbpath(kbpath):
         return full_filename.replace('\\', '\\\\') if os.name == 'nt' else full_filename
     return fix_path("bk.pl"), fix_path("exs.pl"), fix_path("bias.pl")
 
+# durations are counted in log2 buckets starting at HISTOGRAM_MIN seconds, the last bucket holds anything longer
+HISTOGRAM_MIN=1e-6
+HISTOGRAM_BUCKETS=32
+
+class DurationStats:
+    # a fixed-size summary of the durations of an operation
+    def __init__(self):
+        self.called = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.last = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, duration):
+        self.called += 1
+        self.last = duration
+        self.total += duration
+        if duration > self.maximum:
+            self.maximum = duration
+        bucket = 0
+        if duration >= HISTOGRAM_MIN:
+            bucket = min(math.frexp(duration / HISTOGRAM_MIN)[1], HISTOGRAM_BUCKETS-1)
+        self.histogram[bucket] += 1
+
+    def quantile(self, q):
+        # an upper bound from the histogram
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= q * self.called:
+                return min(HISTOGRAM_MIN * 2**bucket, self.maximum)
+        return self.maximum
+
 class Stats:
-    def __init__(self, info = False, debug = False):
+    def __init__(self, info = False, debug = False, json_file = None, snapshot_interval = 0):
         self.exec_start = perf_counter()
         self.total_programs = 0
         self.durations = {}
+        self.counters = {}
+        # the costs of evaluating the examples with an inference limit, see Tester.update_stats
+        self.example_costs = {}
+        self.json_file = json_file
+        self.snapshot_interval = snapshot_interval
+        self.num_snapshots = 0
+        self.next_snapshot = None
+        if json_file and snapshot_interval > 0:
+            self.next_snapshot = self.exec_start + snapshot_interval
 
     def total_exec_time(self):
         return perf_counter() - self.exec_start
 
     def show(self):
         message = f'Num. programs: {self.total_programs}\n'
+        for counter, value in sorted(self.counters.items()):
+            message += f'{counter.capitalize()}: {value}\n'
+        if self.example_costs:
+            x = self.example_costs
+            message += f'Example inferences:\n\tMean: {x["mean inferences"]:0.1f} \t Max: {x["max inferences"]} \t Max example: {x["max example"]}\n'
+            exceeded = sorted(x['exceeded'].items(), key=lambda y: y[1], reverse=True)
+            for example, n in exceeded[:10]:
+                message += f'\tExample {example} exceeded the inference limit {n} times\n'
         total_op_time = sum(summary.total for summary in self.duration_summary())
 
         for summary in self.duration_summary():
@@ -122,13 +208,10 @@ class Stats:
 
     def duration_summary(self):
         summary = []
-        stats = sorted(self.durations.items(), key = lambda x: sum(x[1]), reverse=True)
+        stats = sorted(self.durations.items(), key = lambda x: x[1].total, reverse=True)
         for operation, durations in stats:
-            called = len(durations)
-            total = sum(durations)
-            mean = sum(durations)/len(durations)
-            maximum = max(durations)
-            summary.append(DurationSummary(operation.title(), called, total, mean, maximum))
+            mean = durations.total/durations.called
+            summary.append(DurationSummary(operation.title(), durations.called, durations.total, mean, durations.maximum))
         return summary
 
     @contextmanager
@@ -138,12 +221,38 @@ class Stats:
             yield
         finally:
             end = perf_counter()
-            duration = end - start
-
-            if operation not in self.durations:
-                self.durations[operation] = [duration]
-            else:
-                self.durations[operation].append(duration)
+            self.add_duration(operation, end - start)
+
+    def add_duration(self, operation, duration):
+        if operation not in self.durations:
+            self.durations[operation] = DurationStats()
+        self.durations[operation].add(duration)
+        if self.next_snapshot and perf_counter() >= self.next_snapshot:
+            self.snapshot()
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def to_json(self):
+        durations = {}
+        for operation, x in self.durations.items():
+            durations[operation] = {'called': x.called, 'total': x.total, 'mean': x.total/x.called, 'max': x.maximum, 'p50': x.quantile(0.5), 'p95': x.quantile(0.95), 'histogram': x.histogram}
+        out = {'time': self.total_exec_time(), 'programs': self.total_programs, 'counters': dict(self.counters), 'durations': durations}
+        if self.example_costs:
+            out['examples'] = self.example_costs
+        return out
+
+    def snapshot(self, final=False):
+        # append the current statistics as one JSON line, the first snapshot of a run truncates the file
+        if not self.json_file:
+            return
+        out = self.to_json()
+        out['final'] = final
+        with open(self.json_file, 'a' if self.num_snapshots else 'w') as f:
+            f.write(json.dumps(out) + '\n')
+        self.num_snapshots += 1
+        if self.next_snapshot:
+            self.next_snapshot = perf_counter() + self.snapshot_interval
 
 def format_prog(prog):
     return '\n'.join(format_rule(order_rule(rule)) for rule in order_prog(prog))
@@ -220,6 +329,12 @@ def mdl_score(fn, fp, size):
     # _, fn, _, fp, size = score
     return fn + fp + size
 
+def num_examples(xs, weights):
+    # the number of examples with the indexes xs, where an index stands for weights[index] identical examples, or one if it has no weight
+    if not weights:
+        return len(xs)
+    return sum(weights.get(x, 1) for x in xs)
+
 def order_rule(rule, settings=None):
 
     if settings and settings.datalog:
@@ -336,19 +451,103 @@ class DurationSummary:
 def flatten(xs):
     return [item for sublist in xs for item in sublist]
 
+class LazyCache(dict):
+    # maxsize=None never drops an entry, which a cache of objects compared by identity needs
+    def __init__(self, build, maxsize=MAX_CACHE_SIZE):
+        self.build = build
+        self.maxsize = maxsize
+
+    def __missing__(self, k):
+        v = self.build(k)
+        if self.maxsize != None and len(self) >= self.maxsize:
+            # drop the oldest entry
+            del self[next(iter(self))]
+        self[k] = v
+        return v
+
+def build_atom_args(k):
+    return tuple(chr(ord('A') + x.number) for x in k)
+
+BIAS_DEFINED = """
+#defined body_literal/4.
+#defined clause/1.
+#defined clause_var/2.
+#defined var_type/3.
+#defined body_size/2.
+#defined recursive/0.
+#defined var_in_literal/4.
+"""
+
+# the bias file parsed and grounded once and shared by everything that needs it
+class Bias:
+    def __init__(self, bias_file):
+        with open(bias_file) as f:
+            self.text = f.read()
+
+        solver = clingo.Control(['-Wnone'])
+        solver.add('bias', [], self.text)
+        solver.add('bias', [], BIAS_DEFINED)
+        solver.ground([('bias', [])])
+        atoms = solver.symbolic_atoms
+
+        self.recursion_enabled = any(True for _ in atoms.by_signature('enable_recursion', arity=0))
+        self.pi_enabled = any(True for _ in atoms.by_signature('enable_pi', arity=0))
+
+        self.head_preds = []
+        for x in atoms.by_signature('head_pred', arity=2):
+            self.head_preds.append((x.symbol.arguments[0].name, x.symbol.arguments[1].number))
+        self.head_pred = self.head_preds[-1] if self.head_preds else (None, 0)
+
+        self.body_preds = set()
+        for x in atoms.by_signature('body_pred', arity=2):
+            self.body_preds.add((x.symbol.arguments[0].name, x.symbol.arguments[1].number))
+
+        self.types = {}
+        for x in atoms.by_signature('type', arity=2):
+            self.types[x.symbol.arguments[0].name] = [y.name for y in x.symbol.arguments[1].arguments]
+
+        self.directions = defaultdict(dict)
+        for x in atoms.by_signature('direction', arity=2):
+            pred = x.symbol.arguments[0].name
+            for i, y in enumerate(x.symbol.arguments[1].arguments):
+                if y.name == 'in':
+                    self.directions[pred][i] = '+'
+                elif y.name == 'out':
+                    self.directions[pred][i] = '-'
+
+        self.max_body = None
+        for x in atoms.by_signature('max_body', arity=1):
+            self.max_body = x.symbol.arguments[0].number
+
+        self.max_vars = None
+        for x in atoms.by_signature('max_vars', arity=1):
+            self.max_vars = x.symbol.arguments[0].number
+
+        self.max_clauses = None
+        for x in atoms.by_signature('max_clauses', arity=1):
+            self.max_clauses = x.symbol.arguments[0].number
+
 class Settings:
-    def __init__(self, cmd_line=False, info=True, debug=False, show_stats=False, bkcons=False, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, max_examples=MAX_EXAMPLES, max_body=MAX_BODY, max_rules=MAX_RULES, max_vars=MAX_VARS, functional_test=False, kbpath=False, ex_file=False, bk_file=False, bias_file=False, datalog=False, showcons=False, no_bias=False, order_space=False, noisy=False, batch_size=BATCH_SIZE, solver='rc2', anytime_solver=None, anytime_timeout=ANYTIME_TIMEOUT):
+    def __init__(self, cmd_line=False, info=True, debug=False, show_stats=False, bkcons=False, bkcons_backend=False, max_literals=MAX_LITERALS, timeout=TIMEOUT, quiet=False, eval_timeout=EVAL_TIMEOUT, eval_inferences=None, resident_programs=0, max_examples=MAX_EXAMPLES, max_body=MAX_BODY, max_rules=MAX_RULES, max_vars=MAX_VARS, functional_test=False, kbpath=False, ex_file=False, bk_file=False, bias_file=False, datalog=False, showcons=False, no_bias=False, order_space=False, noisy=False, batch_size=BATCH_SIZE, incremental_combine=False, solver='rc2', anytime_solver=None, anytime_timeout=ANYTIME_TIMEOUT, cache_dir=None, bkcons_workers=BKCONS_WORKERS, stats_json=None, stats_interval=0, trace_file=None, profile_file=None, checkpoint_file=None, checkpoint_interval=CHECKPOINT_INTERVAL, resume=False, on_solution=None, argv=None):
 
         if cmd_line:
-            args = parse_args()
+            args = parse_args(argv)
             self.bk_file, self.ex_file, self.bias_file = load_kbpath(args.kbpath)
             quiet = args.quiet
             debug = args.debug
             show_stats = args.stats
+            stats_json = args.stats_json
+            stats_interval = args.stats_interval
+            trace_file = args.trace
+            profile_file = args.profile
             bkcons = args.bkcons
+            bkcons_workers = args.bkcons_workers
+            bkcons_backend = args.bkcons_backend
             max_literals = args.max_literals
             timeout = args.timeout
             eval_timeout = args.eval_timeout
+            eval_inferences = args.eval_inferences
+            resident_programs = args.resident_programs
             max_examples = MAX_EXAMPLES
             max_body = args.max_body
             max_vars = args.max_vars
@@ -360,9 +559,14 @@ class Settings:
             order_space = args.order_space
             noisy = args.noisy
             batch_size = args.batch_size
+            incremental_combine = args.incremental_combine
             solver = args.solver
             anytime_solver = args.anytime_solver
             anytime_timeout = args.anytime_timeout
+            cache_dir = args.cache_dir
+            checkpoint_file = args.checkpoint
+            checkpoint_interval = args.checkpoint_interval
+            resume = args.resume
         else:
             if kbpath:
                 self.bk_file, self.ex_file, self.bias_file = load_kbpath(kbpath)
@@ -384,10 +588,26 @@ class Settings:
 
         self.info = info
         self.debug = debug
-        self.stats = Stats(info=info, debug=debug)
+        self.stats = Stats(info=info, debug=debug, json_file=stats_json, snapshot_interval=stats_interval)
         self.stats.logger = self.logger
         self.show_stats = show_stats
         self.bkcons = bkcons
+        self.bkcons_workers = bkcons_workers
+        self.bkcons_backend = bkcons_backend
+        self.trace_file = trace_file
+        self.profile_file = profile_file
+        self.tracer = None
+        # called with each new best program and its score
+        self.on_solution = on_solution
+        # the best score found by other processes in a portfolio, see portfolio.py
+        self.shared_bound = None
+        # restarted when learning starts, see timeout
+        self.deadline = Deadline(timeout)
+        self.timed_out = False
+        # the parts of the search space searched by this process and its link to the others, see distribute.py
+        self.assigned_cells = None
+        self.exchange = None
+        self.constraint_bus = None
         self.datalog = datalog
         self.showcons = showcons
         # self.aggressive = aggressive
@@ -395,6 +615,8 @@ class Settings:
         self.functional_test = functional_test
         self.timeout = timeout
         self.eval_timeout = eval_timeout
+        self.eval_inferences = eval_inferences
+        self.resident_programs = resident_programs
         self.max_examples = max_examples
         self.max_body = max_body
         self.max_vars = max_vars
@@ -403,109 +625,72 @@ class Settings:
         self.order_space = order_space
         self.noisy = noisy
         self.batch_size = batch_size
+        self.incremental_combine = incremental_combine
         self.solver = solver
         self.anytime_solver = anytime_solver
         self.anytime_timeout = anytime_timeout
+        self.cache_dir = cache_dir
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
 
         self.recall = {}
+        # the weights of the examples with identical copies, set by the tester
+        self.example_weights = {}
+        # the tester of the current run, which reports the costs of the examples at the end
+        self.tester = None
         self.solution = None
         self.best_prog_score = None
 
-        solver = clingo.Control(['-Wnone'])
-        with open(self.bias_file) as f:
-            solver.add('bias', [], f.read())
-        solver.add('bias', [], """
-            #defined body_literal/4.
-            #defined clause/1.
-            #defined clause_var/2.
-            #defined var_type/3.
-            #defined body_size/2.
-            #defined recursive/0.
-            #defined var_in_literal/4.
-        """)
-        solver.ground([('bias', [])])
-
-        self.recursion_enabled = False
-        for x in solver.symbolic_atoms.by_signature('enable_recursion', arity=0):
-            self.recursion_enabled = True
+        self.bias = Bias(self.bias_file)
+        bias = self.bias
 
-        self.pi_enabled = False
-        for x in solver.symbolic_atoms.by_signature('enable_pi', arity=0):
-            self.pi_enabled = True
+        self.recursion_enabled = bias.recursion_enabled
+        self.pi_enabled = bias.pi_enabled
 
         # read directions from bias file when there is no PI
         if not self.pi_enabled:
             directions = defaultdict(lambda: defaultdict(lambda: '?'))
-            for x in solver.symbolic_atoms.by_signature('direction', arity=2):
-                pred = x.symbol.arguments[0].name
-                for i, y in enumerate(x.symbol.arguments[1].arguments):
-                    y = y.name
-                    if y == 'in':
-                        arg_dir = '+'
-                    elif y == 'out':
-                        arg_dir = '-'
+            for pred, arg_dirs in bias.directions.items():
+                for i, arg_dir in arg_dirs.items():
                     directions[pred][i] = arg_dir
             self.directions = directions
 
         self.max_arity = 0
-        for x in solver.symbolic_atoms.by_signature('head_pred', arity=2):
-            self.max_arity = max(self.max_arity, x.symbol.arguments[1].number)
+        for head_pred, head_arity in bias.head_preds:
+            self.max_arity = max(self.max_arity, head_arity)
 
             if not self.pi_enabled:
-                head_pred = x.symbol.arguments[0].name
-                head_arity = x.symbol.arguments[1].number
                 head_args = tuple(chr(ord('A') + i) for i in range(head_arity))
 
                 head_modes = tuple(self.directions[head_pred][i] for i in range(head_arity))
                 self.head_literal = Literal(head_pred, head_args, head_modes)
 
-        for x in solver.symbolic_atoms.by_signature('max_body', arity=1):
-            self.max_body = x.symbol.arguments[0].number
-
-        for x in solver.symbolic_atoms.by_signature('max_vars', arity=1):
-            self.max_vars = x.symbol.arguments[0].number
+        if bias.max_body != None:
+            self.max_body = bias.max_body
 
-        self.max_rules = None
-        for x in solver.symbolic_atoms.by_signature('max_clauses', arity=1):
-            self.max_rules = x.symbol.arguments[0].number
+        if bias.max_vars != None:
+            self.max_vars = bias.max_vars
 
+        self.max_rules = bias.max_clauses
 
-        self.body_preds = set()
-        for x in solver.symbolic_atoms.by_signature('body_pred', arity=2):
-            pred = x.symbol.arguments[0].name
-            arity = x.symbol.arguments[1].number
-            self.body_preds.add((pred, arity))
+        self.body_preds = set(bias.body_preds)
+        for pred, arity in self.body_preds:
             self.max_arity = max(self.max_arity, arity)
 
-        arg_lookup = {i:chr(ord('A') + i) for i in range(100)}
-        self.cached_atom_args = {}
-        for i in range(1, self.max_arity+1):
-            for args in permutations(range(0, self.max_vars), i):
-                k = tuple(clingo.Number(x) for x in args)
-                v = tuple(arg_lookup[x] for x in args)
-                self.cached_atom_args[k] = v
+        # the lookup tables used by the model parsers are filled on first use rather than built for every permutation of max_vars
+        self.cached_atom_args = LazyCache(build_atom_args)
 
         if not self.pi_enabled:
             self.body_modes = {}
-            self.cached_literals = {}
             for pred, arity in self.body_preds:
                 self.body_modes[pred] = tuple(directions[pred][i] for i in range(arity))
 
-            for pred, arity in self.body_preds:
-                for k, args in self.cached_atom_args.items():
-                    if len(args) != arity:
-                        continue
-                    literal = Literal(pred, args, self.body_modes[pred])
-                    self.cached_literals[(pred, k)] = literal
-
             pred = self.head_literal.predicate
             arity = self.head_literal.arity
             self.body_modes[pred] = tuple(directions[pred][i] for i in range(arity))
-            for k, args in self.cached_atom_args.items():
-                if len(args) != arity:
-                    continue
-                literal = Literal(pred, args, self.body_modes[pred])
-                self.cached_literals[(pred, k)] = literal
+            # literals are compared by identity, so a literal must never be rebuilt, see checkpoint.py
+            self.cached_literals = LazyCache(self.build_literal, maxsize=None)
 
         if self.max_rules == None:
             if self.recursion_enabled or self.pi_enabled:
@@ -525,6 +710,10 @@ class Settings:
         self.single_solve = not (self.recursion_enabled or self.pi_enabled)
 
 
+    def build_literal(self, k):
+        pred, atom_args = k
+        return Literal(pred, self.cached_atom_args[atom_args], self.body_modes[pred])
+
     def print_incomplete_solution2(self, prog, tp, fn, tn, fp, size):
         self.logger.info('*'*20)
         self.logger.info('New best hypothesis:')
@@ -535,6 +724,8 @@ class Settings:
         for rule in order_prog(prog):
             self.logger.info(format_rule(order_rule(rule)))
         self.logger.info('*'*20)
+        if self.on_solution:
+            self.on_solution(prog, (tp, fn, tn, fp, size))
 
 
 
@@ -556,27 +747,12 @@ def theory_subsumes(prog1, prog2):
 
 
 def load_types(settings):
-    enc = """
-#defined clause/1.
-#defined clause_var/2.
-#defined var_type/3."""
-    # solver = clingo.Control()
-    solver = clingo.Control(['-Wnone'])
-    with open(settings.bias_file) as f:
-        solver.add('bias', [], f.read())
-    solver.add('bias', [], enc)
-    solver.ground([('bias', [])])
-
-    for x in solver.symbolic_atoms.by_signature('head_pred', arity=2):
-        head_pred = x.symbol.arguments[0].name
-        head_arity = x.symbol.arguments[1].number
+    bias = settings.bias
+    head_pred = bias.head_pred[0]
 
     head_types = None
     body_types = {}
-    for x in solver.symbolic_atoms.by_signature('type', arity=2):
-        pred = x.symbol.arguments[0].name
-        # xs = (str(t) for t in )
-        xs = [y.name for y in x.symbol.arguments[1].arguments]
+    for pred, xs in bias.types.items():
         if pred == head_pred:
             head_types = xs
         else:
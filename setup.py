@@ -17,7 +17,8 @@ setuptools.setup(
     py_modules=['popper'],
     install_requires=[
         'clingo',
-        'pyswip'
+        'pyswip',
+        'numpy'
     ],
     url="https://github.com/logic-and-learning-lab/Popper",
     scripts=['bin/popper-ilp'],